@@ -0,0 +1,156 @@
+import os
+import asyncio
+import hashlib
+import logging
+from datetime import datetime
+
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+# "wallet" creates a fresh mnemonic per user; "hd" derives deposit addresses from SERVICE_XPUB
+ADDRESS_MODE = os.getenv("ADDRESS_MODE", "wallet")
+# Account-level kpub for m/44'/111111'/0'; print it with `node wasm_rpc.js xpub` and the service mnemonic
+SERVICE_XPUB = os.getenv("SERVICE_XPUB", "")
+ADDRESS_NETWORK = os.getenv("ADDRESS_NETWORK", "mainnet")
+# Addresses derived per round trip to the wallet workers
+ADDRESS_BATCH_SIZE = int(os.getenv("ADDRESS_BATCH_SIZE", "100"))
+# Derive the next batch once fewer than this many unassigned addresses are left
+ADDRESS_LOW_WATER = int(os.getenv("ADDRESS_LOW_WATER", "25"))
+
+
+class AddressAllocationError(Exception):
+    """Raised when no deposit address could be derived or assigned."""
+
+
+class AddressAllocator:
+    """
+    Assigns each user a receive address m/44'/111111'/0'/0/i of the service xpub.
+
+    Indexes come from an atomically incremented counter in Mongo, reserved a batch at
+    a time, and the batch is derived ahead of demand by the wallet workers into
+    `deposit_addresses`, keyed by address. Assigning one is a single
+    find_one_and_update, so any number of bot processes can hand them out without
+    reusing an index. No private keys are stored: funds are swept offline with the
+    service mnemonic, using the `index` recorded for each address (pre-derived
+    batches leave gaps wider than a wallet's usual discovery gap limit).
+    """
+
+    def __init__(
+        self,
+        db,
+        wallet_service,
+        xpub: str = SERVICE_XPUB,
+        network: str = ADDRESS_NETWORK,
+        batch_size: int = ADDRESS_BATCH_SIZE,
+        low_water: int = ADDRESS_LOW_WATER,
+    ):
+        self.addresses = db["deposit_addresses"]
+        self.counters = db["counters"]
+        self.wallet_service = wallet_service
+        self.xpub = xpub
+        self.network = network
+        self.batch_size = max(1, batch_size)
+        self.low_water = low_water
+        # Several xpubs can share the collections, e.g. after a key rotation
+        self.xpub_id = hashlib.sha256(xpub.encode()).hexdigest()[:16]
+        self._refill_lock = asyncio.Lock()
+        self._refill_task = None
+        self.allocated = 0
+        self.derived = 0
+        self.batches = 0
+
+    async def ensure_indexes(self):
+        await self.addresses.create_index([("xpub_id", 1), ("telegram_id", 1), ("index", 1)])
+
+    async def start(self):
+        if not self.xpub:
+            raise AddressAllocationError("ADDRESS_MODE=hd needs SERVICE_XPUB")
+        await self.refill()
+
+    async def stop(self):
+        if self._refill_task:
+            self._refill_task.cancel()
+            await asyncio.gather(self._refill_task, return_exceptions=True)
+            self._refill_task = None
+
+    async def allocate(self, telegram_id: int) -> dict:
+        """
+        Assign a deposit address to a user, or return the one they already have.
+
+        Returns:
+            dict: {"address": str, "index": int}
+        """
+        existing = await self.addresses.find_one({"xpub_id": self.xpub_id, "telegram_id": telegram_id})
+        if existing:
+            return {"address": existing["_id"], "index": existing["index"]}
+
+        for _ in range(3):
+            doc = await self.addresses.find_one_and_update(
+                {"xpub_id": self.xpub_id, "telegram_id": None},
+                {"$set": {"telegram_id": telegram_id, "assigned_at": datetime.utcnow()}},
+                sort=[("index", 1)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if doc:
+                self.allocated += 1
+                self._schedule_refill()
+                return {"address": doc["_id"], "index": doc["index"]}
+            # Demand outran the pre-derived batch; derive one while this user waits
+            await self.refill()
+        raise AddressAllocationError(f"No deposit address available for {telegram_id}")
+
+    def _schedule_refill(self):
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill_quietly(), name="address-refill")
+
+    async def _refill_quietly(self):
+        try:
+            await self.refill()
+        except Exception as e:
+            logger.warning(f"Could not pre-derive deposit addresses: {e}")
+
+    async def refill(self):
+        """Derive the next batch if fewer than `low_water` unassigned addresses are left."""
+        async with self._refill_lock:
+            free = await self.addresses.count_documents(
+                {"xpub_id": self.xpub_id, "telegram_id": None}, limit=max(1, self.low_water)
+            )
+            if free >= max(1, self.low_water):
+                return
+
+            # Reserving the range first means two processes never derive the same indexes
+            counter = await self.counters.find_one_and_update(
+                {"_id": f"hd_address_index:{self.xpub_id}"},
+                {"$inc": {"next": self.batch_size}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            start = counter["next"] - self.batch_size
+            result = await self.wallet_service.call(
+                "deriveAddresses",
+                {"xpub": self.xpub, "network": self.network, "start": start, "count": self.batch_size},
+            )
+            if not result or not result.get("success"):
+                error = result.get("error") if result else "empty response"
+                raise AddressAllocationError(f"Address derivation failed: {error}")
+
+            now = datetime.utcnow()
+            documents = [
+                {"_id": address, "xpub_id": self.xpub_id, "index": start + i, "telegram_id": None, "derived_at": now}
+                for i, address in enumerate(result["addresses"])
+            ]
+            try:
+                await self.addresses.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                logger.warning(f"Some derived addresses already existed: {len(e.details.get('writeErrors', []))}")
+            self.derived += len(documents)
+            self.batches += 1
+            logger.info(f"Derived deposit addresses {start}..{start + len(documents) - 1}")
+
+    def stats(self) -> dict:
+        return {"allocated": self.allocated, "derived": self.derived, "batches": self.batches}
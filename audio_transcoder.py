@@ -0,0 +1,180 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from rate_limiter import AdmissionGate
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", str(os.cpu_count() or 1)))
+TRANSCODE_MAX_QUEUE = int(os.getenv("TRANSCODE_MAX_QUEUE", "32"))
+TRANSCODE_TIMEOUT = float(os.getenv("TRANSCODE_TIMEOUT", "30"))
+OPUS_BITRATE = os.getenv("OPUS_BITRATE", "64k")
+
+OGG_MAGIC = b"OggS"
+
+
+class TranscodeError(Exception):
+    """Raised when ffmpeg fails or times out."""
+
+
+def is_ogg(audio: bytes) -> bool:
+    return audio[:4] == OGG_MAGIC
+
+
+async def spawn_ffmpeg(bitrate: str = OPUS_BITRATE):
+    """Start an ffmpeg process that reads any audio on stdin and writes OGG/Opus to stdout."""
+    return await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY,
+        "-hide_banner", "-loglevel", "error",
+        "-i", "pipe:0",
+        "-vn", "-c:a", "libopus", "-b:a", bitrate,
+        "-f", "ogg", "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+
+class OpusStreamEncoder:
+    """One ffmpeg process fed incrementally; stdout is drained concurrently."""
+
+    def __init__(self, bitrate: str = OPUS_BITRATE, timeout: float = TRANSCODE_TIMEOUT):
+        self.bitrate = bitrate
+        self.timeout = timeout
+        self.process = None
+        self._chunks = []
+        self._reader = None
+
+    async def start(self):
+        self.process = await spawn_ffmpeg(self.bitrate)
+        self._reader = asyncio.create_task(self._read_stdout())
+
+    async def _read_stdout(self):
+        while True:
+            chunk = await self.process.stdout.read(65536)
+            if not chunk:
+                return
+            self._chunks.append(chunk)
+
+    async def feed(self, chunk: bytes):
+        """Write a chunk of input audio; waits while ffmpeg's pipe is full."""
+        self.process.stdin.write(chunk)
+        await self.process.stdin.drain()
+
+    async def finish(self) -> bytes:
+        """Close the input and return the complete OGG file."""
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self._reader, timeout=self.timeout)
+            stderr = await self.process.stderr.read()
+            await asyncio.wait_for(self.process.wait(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise TranscodeError(f"ffmpeg timed out after {self.timeout}s")
+
+        ogg = b"".join(self._chunks)
+        if self.process.returncode != 0 or not ogg:
+            raise TranscodeError(f"ffmpeg exited with {self.process.returncode}: {stderr.decode(errors='replace').strip()}")
+        return ogg
+
+    async def close(self):
+        if self._reader and not self._reader.done():
+            self._reader.cancel()
+        if self.process and self.process.returncode is None:
+            try:
+                self.process.kill()
+                await self.process.wait()
+            except ProcessLookupError:
+                pass
+
+
+class AudioTranscoder:
+    """
+    Converts TTS audio into OGG/Opus voice notes with a bounded set of ffmpeg processes.
+
+    Audio is piped through ffmpeg's stdin/stdout, so nothing touches the disk and the
+    event loop only waits on I/O. At most `workers` encodes run at once (one per core by
+    default) and at most `max_queue` more may wait; beyond that callers get rate_limiter.Busy.
+    Input that is already OGG is passed through untouched.
+    """
+
+    def __init__(
+        self,
+        workers: int = TRANSCODE_WORKERS,
+        max_queue: int = TRANSCODE_MAX_QUEUE,
+        timeout: float = TRANSCODE_TIMEOUT,
+        bitrate: str = OPUS_BITRATE,
+    ):
+        self.gate = AdmissionGate("transcode", workers, max_queue)
+        self.timeout = timeout
+        self.bitrate = bitrate
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.total_seconds = 0.0
+
+    async def to_ogg(self, audio: bytes) -> bytes:
+        """Return OGG/Opus bytes for the given audio."""
+        if is_ogg(audio):
+            self.skipped += 1
+            return audio
+
+        async with self._slot():
+            return await self._run_ffmpeg(audio)
+
+    @asynccontextmanager
+    async def stream(self):
+        """
+        Reserve a worker slot and yield an OpusStreamEncoder.
+
+        Audio fed into the encoder is encoded while it arrives, so the OGG file is
+        complete moments after the last chunk instead of after a full extra pass.
+        """
+        async with self._slot():
+            encoder = OpusStreamEncoder(self.bitrate, self.timeout)
+            await encoder.start()
+            try:
+                yield encoder
+            finally:
+                await encoder.close()
+
+    @asynccontextmanager
+    async def _slot(self):
+        async with self.gate.slot():
+            started = time.perf_counter()
+            try:
+                yield
+                self.completed += 1
+            except Exception:
+                self.failed += 1
+                raise
+            finally:
+                self.total_seconds += time.perf_counter() - started
+
+    async def _run_ffmpeg(self, audio: bytes) -> bytes:
+        process = await spawn_ffmpeg(self.bitrate)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(audio), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise TranscodeError(f"ffmpeg timed out after {self.timeout}s")
+
+        if process.returncode != 0 or not stdout:
+            raise TranscodeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace').strip()}")
+        return stdout
+
+    def stats(self) -> dict:
+        return {
+            **self.gate.stats(),
+            "completed": self.completed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "avg_seconds": self.total_seconds / self.completed if self.completed else 0.0,
+        }
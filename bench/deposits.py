@@ -0,0 +1,206 @@
+"""
+Deposit detection test for the push-based deposit listener.
+
+Seeds users in the memory Mongo, then replays a recording of node notifications
+(bench.fake_rpc) carrying KRC20 transfer reveals to random users, while the fake
+Kasplex starts listing each transfer --index-lag seconds after its block. The bot's
+DepositListener runs unchanged, with bench/fake_listener.js in place of
+`node wasm_rpc.js listen`. With --outage, the node drops every connection for a
+while mid-replay: the transfers announced meanwhile never reach the listener and
+must be credited by the catch-up scan after it resubscribes.
+
+    python -m bench.deposits                                 # 2000 users, 60 deposits in 30s
+    python -m bench.deposits --users 20000 --deposits 300 --duration 60
+    python -m bench.deposits --outage 0                      # no connection loss
+
+Reports how long each deposit took from its block to the credit, and how many
+Kasplex requests that cost, next to what periodic scanning of every wallet costs.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import argparse
+import platform
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fake_rpc import FakeRpcServer, make_recording  # noqa: E402
+from bench.fake_upstreams import FakeUpstreams, FakeUpstreamConfig, Fault  # noqa: E402
+from bench.run import RESULTS_DIR, configure_environment, git_commit, percentile  # noqa: E402
+
+
+def load_bot(args, rpc_url: str):
+    os.environ.update({
+        "DEPOSIT_LISTENER": "1",
+        "DEPOSIT_LISTENER_SCRIPT": os.path.join(ROOT, "bench", "fake_listener.js"),
+        "KASPA_RPC_URL": rpc_url,
+        "DEPOSIT_CATCH_UP_DELAY": str(args.catch_up_delay),
+    })
+    from bench.memory_mongo import MemoryClient
+    import db_manager
+
+    MemoryClient.latency = args.mongo_latency
+    db_manager.AsyncIOMotorClient = MemoryClient
+
+    import kasper_telegram_bot as bot
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    return bot
+
+
+async def wait_until(condition, timeout: float, interval: float = 0.1) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        await asyncio.sleep(interval)
+    return condition()
+
+
+async def run(args) -> dict:
+    random.seed(args.seed)
+    upstreams = FakeUpstreams(FakeUpstreamConfig(
+        faults={"oplist": Fault(latency=0.1, jitter=0.05)}, new_deposits_per_scan=0,
+    )).start()
+    configure_environment(args, upstreams.base_url)
+
+    addresses = [f"kaspa:qbench{i:06d}" for i in range(args.users)]
+    deposits = [
+        {
+            "at": random.uniform(0, args.duration),
+            "address": random.choice(addresses),
+            "transactionId": hashlib.sha256(f"deposit{i}".encode()).hexdigest(),
+            "amount": random.randint(1, 50) * 200,
+        }
+        for i in range(args.deposits)
+    ]
+    outage = (args.duration * 0.4, args.outage) if args.outage > 0 else None
+    server = await FakeRpcServer(make_recording(deposits, args.duration), outages=[outage] if outage else []).start()
+
+    bot = load_bot(args, server.url)
+    listener, scanner = bot.deposit_listener, bot.deposit_scanner
+    credited_at = {}
+    ingest = bot.db_manager.ingest_deposits
+
+    async def timed_ingest(telegram_id, wallet_address, transfers, credit_rate):
+        result = await ingest(telegram_id, wallet_address, transfers, credit_rate)
+        for transfer in result["transactions"]:
+            credited_at[transfer["hashRev"]] = asyncio.get_running_loop().time()
+        return result
+
+    bot.db_manager.ingest_deposits = timed_ingest
+    await bot.db_manager.ensure_indexes()
+    await bot.db_manager.users.insert_many([
+        {"telegram_id": 1000 + i, "wallet_address": address, "credits": 0, "version": 0, "created_at": datetime.utcnow()}
+        for i, address in enumerate(addresses)
+    ])
+
+    await listener.start()
+    if not await wait_until(lambda: listener.addresses_sent >= args.users and server.connections, 30):
+        raise TimeoutError("The deposit listener did not subscribe every address")
+    # The first connection runs a catch-up pass, since the bench has no periodic scans
+    await asyncio.sleep(args.catch_up_delay)
+    await wait_until(lambda: not (listener._catch_up_task and not listener._catch_up_task.done()), 120)
+    scans_before, oplist_before = scanner.scans, upstreams.stats["oplist"].requests
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    async def index(deposit):
+        await asyncio.sleep(max(0.0, started + deposit["at"] - loop.time()))
+        upstreams.add_transfer(deposit["address"], deposit["transactionId"], deposit["amount"], lag=args.index_lag)
+
+    await asyncio.gather(server.replay(started), *(index(deposit) for deposit in deposits))
+    settle = sum(listener.confirm_delays) + args.catch_up_delay + 30
+    await wait_until(lambda: len(credited_at) >= len(deposits), settle)
+    await listener.stop()
+    await server.stop()
+    upstreams.stop()
+
+    in_outage = {d["transactionId"] for d in deposits if outage and outage[0] <= d["at"] < outage[0] + outage[1]}
+    latencies = sorted(credited_at[d["transactionId"]] - (started + d["at"])
+                       for d in deposits if d["transactionId"] in credited_at and d["transactionId"] not in in_outage)
+    recovered = sorted(credited_at[d["transactionId"]] - (started + d["at"])
+                       for d in deposits if d["transactionId"] in credited_at and d["transactionId"] in in_outage)
+    oplist_requests = upstreams.stats["oplist"].requests - oplist_before
+    return {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output",)},
+        },
+        "deposits": len(deposits),
+        "credited": len(credited_at),
+        "during_outage": len(in_outage),
+        "credited_after_outage": len(recovered),
+        "notifications": {"delivered": server.delivered, "lost": server.lost, "connections": server.connections},
+        "block_to_credit_s": {
+            "p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "max": latencies[-1] if latencies else 0.0,
+        },
+        "outage_block_to_credit_s": {"max": recovered[-1] if recovered else 0.0},
+        "kasplex_requests": oplist_requests,
+        "scans": scanner.scans - scans_before,
+        "listener": listener.stats(),
+    }
+
+
+def print_report(report: dict, args):
+    latency = report["block_to_credit_s"]
+    print(f"\n{report['credited']}/{report['deposits']} deposits credited, "
+          f"block to credit p50 {latency['p50']:.2f}s, p95 {latency['p95']:.2f}s, max {latency['max']:.2f}s")
+    if report["during_outage"]:
+        print(f"{report['credited_after_outage']}/{report['during_outage']} deposits announced during the outage "
+              f"credited by catch-up, at most {report['outage_block_to_credit_s']['max']:.2f}s after their block")
+    notifications = report["notifications"]
+    print(f"{notifications['delivered']} notifications delivered, {notifications['lost']} lost, "
+          f"{notifications['connections']} connections")
+    print(f"{report['kasplex_requests']} Kasplex requests for {report['scans']} wallet scans "
+          f"(listener stats: {report['listener']})")
+    # What periodic scanning of every wallet would cost over the same time, at its own latency
+    for interval in (300, 30):
+        requests = args.users * (args.duration / interval)
+        print(f"  scanning every wallet every {interval}s: ~{requests:.0f} requests, p50 latency ~{interval / 2:.0f}s")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000, help="user wallets subscribed to")
+    parser.add_argument("--deposits", type=int, default=60, help="transfers replayed")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds the transfers are spread over")
+    parser.add_argument("--index-lag", type=float, default=2.0, help="seconds before Kasplex lists a transfer")
+    parser.add_argument("--outage", type=float, default=5.0, help="seconds the node is away mid-replay; 0 for none")
+    parser.add_argument("--catch-up-delay", type=float, default=3.0, help="DEPOSIT_CATCH_UP_DELAY")
+    parser.add_argument("--mongo-latency", type=float, default=0.002, help="seconds per Mongo operation")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--output", help="result file (default bench/results/deposits-<timestamp>.json)")
+    args = parser.parse_args(argv)
+    # configure_environment() reads these
+    args.tts_format = ""
+    args.streaming = False
+    args.real_wallet = False
+    args.wallet_latency = 0.0
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    print_report(report, args)
+    output = args.output or os.path.join(RESULTS_DIR, "deposits-" + datetime.utcnow().strftime("%Y%m%dT%H%M%SZ") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
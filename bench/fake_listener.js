@@ -0,0 +1,108 @@
+// Stand-in for `node wasm_rpc.js listen` that needs no WASM build.
+// Runs the real deposit_listener.js against bench/fake_rpc.py, through a minimal
+// RpcClient speaking that server's newline-delimited JSON over TCP. Like the wasm
+// client's default connect strategy, it reconnects every RETRY_INTERVAL_MS after a drop.
+const net = require("net");
+
+const { listen } = require("../deposit_listener");
+
+const RETRY_INTERVAL_MS = 1000;
+
+class FakeRpcClient {
+    constructor(url) {
+        this.url = url;
+        this.listeners = {};
+        this.pending = new Map();
+        this.ids = 1;
+        this.socket = null;
+        this.closing = false;
+    }
+
+    addEventListener(type, callback) {
+        (this.listeners[type] = this.listeners[type] || []).push(callback);
+    }
+
+    emit(type, data) {
+        for (const callback of this.listeners[type] || []) {
+            callback({ type, data });
+        }
+    }
+
+    async connect() {
+        this.open();
+    }
+
+    open() {
+        const { hostname, port } = new URL(this.url);
+        const socket = net.connect(Number(port), hostname);
+        let buffer = "";
+        let opened = false;
+
+        socket.on("connect", () => {
+            opened = true;
+            this.socket = socket;
+            this.emit("connect");
+        });
+        socket.on("data", (chunk) => {
+            buffer += chunk;
+            let newline;
+            while ((newline = buffer.indexOf("\n")) >= 0) {
+                const message = JSON.parse(buffer.slice(0, newline));
+                buffer = buffer.slice(newline + 1);
+                if (message.id !== undefined) {
+                    const request = this.pending.get(message.id);
+                    this.pending.delete(message.id);
+                    if (request) {
+                        request.resolve(message.result);
+                    }
+                } else {
+                    this.emit(message.event, message.data);
+                }
+            }
+        });
+        socket.on("error", () => {});
+        socket.on("close", () => {
+            this.socket = null;
+            for (const request of this.pending.values()) {
+                request.reject(new Error("connection closed"));
+            }
+            this.pending.clear();
+            if (opened) {
+                this.emit("disconnect");
+            }
+            if (!this.closing) {
+                setTimeout(() => this.open(), RETRY_INTERVAL_MS);
+            }
+        });
+    }
+
+    request(method, params) {
+        if (!this.socket) {
+            return Promise.reject(new Error("not connected"));
+        }
+        const id = this.ids++;
+        return new Promise((resolve, reject) => {
+            this.pending.set(id, { resolve, reject });
+            this.socket.write(JSON.stringify({ id, method, params }) + "\n");
+        });
+    }
+
+    subscribeUtxosChanged(addresses) {
+        return this.request("subscribeUtxosChanged", { addresses });
+    }
+
+    subscribeBlockAdded() {
+        return this.request("subscribeBlockAdded", {});
+    }
+
+    async disconnect() {
+        this.closing = true;
+        if (this.socket) {
+            this.socket.end();
+        }
+    }
+}
+
+listen(new FakeRpcClient(process.env.KASPA_RPC_URL), {
+    tick: (process.env.KRC20_TICK || "KASPER").toUpperCase(),
+});
@@ -0,0 +1,218 @@
+"""
+Fake Kaspa node for the deposit listener: replays recorded RPC notifications.
+
+Clients (bench/fake_listener.js) speak newline-delimited JSON over TCP rather than
+wRPC: {"id", "method": "subscribeUtxosChanged" | "subscribeBlockAdded", "params"}
+requests are answered with {"id", "result"}, and notifications arrive as
+{"event": "utxos-changed" | "block-added", "data": ...}, shaped like the events the
+kaspa wasm RpcClient hands to its listeners. As on a real node, a notification only
+reaches connections subscribed at that moment; anything announced during an outage
+is gone, which is what the listener's resubscribe and catch-up must cover.
+
+A recording is a JSON list of {"at": seconds from the start, "event", "data"};
+make_recording() builds one with KRC20 transfer reveals to the given addresses.
+
+    python -m bench.fake_rpc --recording notifications.json --port 17110 --outage 10:5
+"""
+import sys
+import json
+import random
+import asyncio
+import hashlib
+import argparse
+
+
+def push(data: bytes) -> bytes:
+    """A script data push of any length below 64 KiB."""
+    if len(data) < 0x4c:
+        return bytes([len(data)]) + data
+    if len(data) <= 0xff:
+        return b"\x4c" + bytes([len(data)]) + data
+    return b"\x4d" + len(data).to_bytes(2, "little") + data
+
+
+def reveal_script(operation: dict) -> str:
+    """Signature script of a KRC20 reveal input: signature, then the envelope's redeem script."""
+    redeem = (
+        push(random.randbytes(32)) + b"\xac"  # <pubkey> OP_CHECKSIG
+        + b"\x00\x63" + push(b"kasplex") + b"\x00"  # OP_FALSE OP_IF "kasplex" OP_0
+        + push(json.dumps(operation, separators=(",", ":")).encode()) + b"\x68"  # <json> OP_ENDIF
+    )
+    return (push(random.randbytes(65)) + push(redeem)).hex()
+
+
+def transaction(transaction_id: str, inputs: list, outputs: list = ()) -> dict:
+    return {
+        "inputs": [
+            {"previousOutpoint": {"transactionId": hashlib.sha256(script.encode()).hexdigest(), "index": 0},
+             "signatureScript": script, "sequence": "0", "sigOpCount": 1}
+            for script in inputs
+        ],
+        "outputs": [{"value": str(amount), "scriptPublicKey": {"version": 0, "script": ""},
+                     "verboseData": {"scriptPublicKeyAddress": address}} for address, amount in outputs],
+        "verboseData": {"transactionId": transaction_id},
+    }
+
+
+def block_added(at: float, transactions: list) -> dict:
+    block_hash = hashlib.sha256(f"block:{at}:{random.random()}".encode()).hexdigest()
+    return {
+        "at": at,
+        "event": "block-added",
+        "data": {"block": {"header": {"hash": block_hash, "daaScore": str(int(at * 10))}, "transactions": transactions}},
+    }
+
+
+def make_recording(deposits: list, duration: float, tick: str = "KASPER", blocks_per_second: float = 2.0,
+                   dust_share: float = 0.3, seed: int = 1) -> list:
+    """
+    Notifications for `deposits`, a list of {"at", "address", "transactionId", "amount"}.
+
+    Each deposit is a block carrying its reveal transaction; `dust_share` of them also
+    pay the recipient a small output, which shows up as a UTXO change. Filler blocks
+    with plain payments and transfers to other addresses keep the listener filtering.
+    """
+    random.seed(seed)
+    recording = []
+    for deposit in deposits:
+        operation = {"p": "krc-20", "op": "transfer", "tick": tick.lower(), "amt": str(deposit["amount"] * 10 ** 8),
+                     "to": deposit["address"]}
+        recording.append(block_added(deposit["at"], [transaction(deposit["transactionId"], [reveal_script(operation)])]))
+        if random.random() < dust_share:
+            recording.append({"at": deposit["at"], "event": "utxos-changed", "data": {
+                "added": [{"address": deposit["address"], "amount": "20000000",
+                           "outpoint": {"transactionId": deposit["transactionId"], "index": 1}}],
+                "removed": [],
+            }})
+
+    for i in range(int(duration * blocks_per_second)):
+        other = {"p": "krc-20", "op": "transfer", "tick": tick.lower(), "amt": "100", "to": f"kaspa:qother{i}"}
+        recording.append(block_added(i / blocks_per_second, [
+            transaction(hashlib.sha256(f"plain{i}".encode()).hexdigest(), [push(random.randbytes(65)).hex()],
+                        [(f"kaspa:qplain{i}", 100000)]),
+            transaction(hashlib.sha256(f"other{i}".encode()).hexdigest(), [reveal_script(other)]),
+        ]))
+    return sorted(recording, key=lambda entry: entry["at"])
+
+
+class FakeRpcServer:
+    """Serve subscriptions and replay a recording once `replay()` is awaited."""
+
+    def __init__(self, recording: list, host: str = "127.0.0.1", port: int = 0, outages=()):
+        self.recording = sorted(recording, key=lambda entry: entry["at"])
+        self.host = host
+        self.port = port
+        self.outages = list(outages)  # (start, duration) in seconds from the start of the replay
+        self.connections = 0
+        self.delivered = 0
+        self.lost = 0
+        self._subscriptions = {}  # writer -> {"utxos": set of addresses, "blocks": bool}
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f"tcp://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        for writer in list(self._subscriptions):
+            writer.close()
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        subscriptions = self._subscriptions[writer] = {"utxos": set(), "blocks": False}
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                if request["method"] == "subscribeUtxosChanged":
+                    subscriptions["utxos"].update(request["params"]["addresses"])
+                elif request["method"] == "subscribeBlockAdded":
+                    subscriptions["blocks"] = True
+                self._send(writer, {"id": request["id"], "result": {}})
+        except (ConnectionError, json.JSONDecodeError):
+            pass
+        finally:
+            self._subscriptions.pop(writer, None)
+            writer.close()
+
+    def _send(self, writer, message: dict):
+        if not writer.is_closing():
+            writer.write((json.dumps(message) + "\n").encode())
+
+    async def replay(self, started: float = None):
+        """Send every notification at its time; `started` is a loop.time() to count from."""
+        loop = asyncio.get_running_loop()
+        started = loop.time() if started is None else started
+        outages = [asyncio.create_task(self._outage(started + start, duration)) for start, duration in self.outages]
+        try:
+            for entry in self.recording:
+                await asyncio.sleep(max(0.0, started + entry["at"] - loop.time()))
+                self._deliver(entry)
+        finally:
+            await asyncio.gather(*outages)
+
+    async def _outage(self, at: float, duration: float):
+        """The node goes away: every connection drops and new ones are refused for a while."""
+        await asyncio.sleep(max(0.0, at - asyncio.get_running_loop().time()))
+        self._server.close()
+        for writer in list(self._subscriptions):
+            writer.close()
+        await asyncio.sleep(duration)
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+
+    def _deliver(self, entry: dict):
+        sent = False
+        for writer, subscriptions in list(self._subscriptions.items()):
+            data = entry["data"]
+            if entry["event"] == "block-added":
+                if not subscriptions["blocks"]:
+                    continue
+            elif entry["event"] == "utxos-changed":
+                added = [utxo for utxo in data["added"] if utxo["address"] in subscriptions["utxos"]]
+                removed = [utxo for utxo in data["removed"] if utxo["address"] in subscriptions["utxos"]]
+                if not added and not removed:
+                    continue
+                data = {"added": added, "removed": removed}
+            self._send(writer, {"event": entry["event"], "data": data})
+            sent = True
+        if sent:
+            self.delivered += 1
+        else:
+            self.lost += 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recording", required=True, help="JSON list of {at, event, data}")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=17110)
+    parser.add_argument("--delay", type=float, default=2.0, help="seconds to wait for subscribers before replaying")
+    parser.add_argument("--outage", action="append", default=[], help="START:DURATION in seconds; repeatable")
+    args = parser.parse_args(argv)
+
+    with open(args.recording) as f:
+        recording = json.load(f)
+    outages = [tuple(float(part) for part in outage.split(":")) for outage in args.outage]
+
+    async def serve():
+        server = await FakeRpcServer(recording, args.host, args.port, outages).start()
+        print(f"listening {server.url}", flush=True)
+        await asyncio.sleep(args.delay)
+        await server.replay()
+        print(f"replayed {server.delivered} notifications, {server.lost} lost", flush=True)
+        await server.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+"""
+Local stand-ins for OpenAI, ElevenLabs, Kasplex and the Telegram Bot API.
+
+One threaded HTTP/1.1 server answers every route, so the bot's pooled clients,
+retries and streaming code run unchanged against it. Each route has a Fault with
+injected latency, jitter and an error rate.
+"""
+import json
+import time
+import base64
+import random
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from functools import cached_property
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from bench.fixtures import mp3_fixture, ogg_fixture, png_fixture
+
+# Operations per oplist page, as on Kasplex
+OPLIST_PAGE_SIZE = 50
+
+CHAT_REPLY = (
+    "Boo! Kasper here, the friendliest ghost on Kaspa. "
+    "KASPER had a fair launch with no pre-allocations. "
+    "Keep chatting with me and I will tell you more spooky secrets!"
+)
+
+
+@dataclass
+class Fault:
+    latency: float = 0.0  # seconds before the response starts
+    jitter: float = 0.0  # extra uniform random delay, in seconds
+    error_rate: float = 0.0  # fraction of requests answered with `error_status`
+    error_status: int = 500
+    slow_rate: float = 0.0  # fraction of requests that stall for `slow_latency` more, a latency tail
+    slow_latency: float = 0.0
+
+    def delay(self):
+        pause = self.latency + random.uniform(0, self.jitter)
+        if self.slow_rate > 0 and random.random() < self.slow_rate:
+            pause += self.slow_latency
+        if pause > 0:
+            time.sleep(pause)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+@dataclass
+class RouteStats:
+    requests: int = 0
+    errors: int = 0
+
+
+@dataclass
+class FakeUpstreamConfig:
+    faults: dict = field(default_factory=dict)  # route name -> Fault
+    tts_seconds: float = 4.0  # length of the audio fixture
+    stream_chunk_delay: float = 0.01  # pause between streamed chat tokens / audio chunks
+    new_deposits_per_scan: int = 1  # Kasplex transfers that appear per oplist request
+
+
+class FakeUpstreams:
+    """Start with `start()`; `base_url` then serves every upstream."""
+
+    ROUTES = ("chat", "image", "tts", "oplist", "telegram")
+
+    def __init__(self, config: FakeUpstreamConfig = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or FakeUpstreamConfig()
+        self.stats = {route: RouteStats() for route in self.ROUTES}
+        self._lock = threading.Lock()
+        self._operations = {}
+        self._visible_at = {}  # hashRev -> time.monotonic() from which Kasplex lists it
+        self._op_score = 0
+        self._message_id = 0
+        self.png = base64.b64encode(png_fixture()).decode()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    # Made with ffmpeg on first use, so a fake that only serves Kasplex does not need it
+    @cached_property
+    def mp3(self) -> bytes:
+        return mp3_fixture(self.config.tts_seconds)
+
+    @cached_property
+    def ogg(self) -> bytes:
+        return ogg_fixture(self.config.tts_seconds)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-upstreams", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fault(self, route: str) -> Fault:
+        return self.config.faults.get(route) or Fault()
+
+    def next_message_id(self) -> int:
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def new_operations(self, address: str) -> list:
+        """Append fresh transfers to an address and return all of them, newest first."""
+        with self._lock:
+            self._add_operations(address)
+            return self._visible(address)
+
+    def operations(self, address: str, before: int = None) -> list:
+        """The address's listed operations with an opScore below `before`, newest first."""
+        with self._lock:
+            operations = self._visible(address)
+        if before is None:
+            return operations
+        return [op for op in operations if int(op["opScore"]) < before]
+
+    def _add_operations(self, address: str):
+        operations = self._operations.setdefault(address, [])
+        for _ in range(self.config.new_deposits_per_scan):
+            self._op_score += 1
+            operations.append({
+                "op": "transfer",
+                "tick": "KASPER",
+                "to": address,
+                "amt": str(1000 * 10 ** 8),
+                "opAccept": "1",
+                "opScore": str(self._op_score),
+                "hashRev": hashlib.sha256(f"{address}:{self._op_score}".encode()).hexdigest(),
+            })
+
+    def _visible(self, address: str) -> list:
+        now = time.monotonic()
+        operations = self._operations.get(address, [])
+        return [op for op in reversed(operations) if self._visible_at.get(op["hashRev"], 0) <= now]
+
+    def add_transfer(self, address: str, hash_rev: str, amount: int = 1000, lag: float = 0.0, accepted: bool = True):
+        """Record a KASPER transfer that Kasplex starts listing `lag` seconds from now; pending unless `accepted`."""
+        with self._lock:
+            self._op_score += 1
+            self._operations.setdefault(address, []).append({
+                "op": "transfer",
+                "tick": "KASPER",
+                "to": address,
+                "amt": str(amount * 10 ** 8),
+                "opAccept": "1" if accepted else "0",
+                "opScore": str(self._op_score),
+                "hashRev": hash_rev,
+            })
+            self._visible_at[hash_rev] = time.monotonic() + lag
+
+    def accept(self, address: str, hash_rev: str):
+        """Confirm a pending transfer, as Kasplex does once its block is accepted."""
+        with self._lock:
+            for op in self._operations.get(address, []):
+                if op["hashRev"] == hash_rev:
+                    op["opAccept"] = "1"
+
+    def _handler_class(self):
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # The client went away, e.g. a processor killed by the scale-out bench
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_POST(self):
+                self._dispatch()
+
+            def _dispatch(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                route, handler = self._route(url.path)
+                if route is None:
+                    self._send(404, b'{"error": "not found"}')
+                    return
+
+                stats = upstreams.stats[route]
+                fault = upstreams.fault(route)
+                with upstreams._lock:
+                    stats.requests += 1
+                fault.delay()
+                if fault.should_fail():
+                    with upstreams._lock:
+                        stats.errors += 1
+                    self._send(fault.error_status, b'{"error": {"message": "injected failure"}}')
+                    return
+                handler(url, body)
+
+            def _route(self, path):
+                if path == "/v1/chat/completions":
+                    return "chat", self._chat
+                if path == "/v1/images/generations":
+                    return "image", self._image
+                if path.startswith("/v1/text-to-speech/"):
+                    return "tts", self._tts
+                if path == "/v1/krc20/oplist":
+                    return "oplist", self._oplist
+                if path.startswith("/bot"):
+                    return "telegram", self._telegram
+                return None, None
+
+            def _send(self, status, payload: bytes, content_type="application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _json(self, data):
+                self._send(200, json.dumps(data).encode())
+
+            def _stream(self, chunks, content_type):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for chunk in chunks:
+                    self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                    self.wfile.flush()
+                    if upstreams.config.stream_chunk_delay:
+                        time.sleep(upstreams.config.stream_chunk_delay)
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _chat(self, url, body):
+                request = json.loads(body or b"{}")
+                if not request.get("stream"):
+                    self._json({
+                        "choices": [{"message": {"role": "assistant", "content": CHAT_REPLY}}],
+                        "usage": {"prompt_tokens": len(json.dumps(request)) // 4, "completion_tokens": 40},
+                    })
+                    return
+                events = [
+                    b"data: " + json.dumps({"choices": [{"delta": {"content": word + " "}}]}).encode() + b"\n\n"
+                    for word in CHAT_REPLY.split()
+                ]
+                self._stream(events + [b"data: [DONE]\n\n"], "text/event-stream")
+
+            def _image(self, url, body):
+                self._json({"data": [{"b64_json": upstreams.png}]})
+
+            def _tts(self, url, body):
+                output_format = parse_qs(url.query).get("output_format", [""])[0]
+                audio = upstreams.ogg if output_format.startswith("opus") else upstreams.mp3
+                if url.path.endswith("/stream"):
+                    self._stream([audio[i:i + 4096] for i in range(0, len(audio), 4096)], "audio/mpeg")
+                else:
+                    self._send(200, audio, "audio/mpeg")
+
+            def _oplist(self, url, body):
+                query = parse_qs(url.query)
+                address = query["address"][0]
+                if "next" in query:
+                    # Like Kasplex, `next` is the opScore the previous page ended at, so transfers
+                    # arriving in between do not shift later pages
+                    operations = upstreams.operations(address, before=int(query["next"][0]))
+                else:
+                    operations = upstreams.new_operations(address)
+                page = operations[:OPLIST_PAGE_SIZE]
+                self._json({
+                    "message": "successful",
+                    "result": page,
+                    "next": page[-1]["opScore"] if len(operations) > len(page) else None,
+                })
+
+            def _telegram(self, url, body):
+                method = url.path.rsplit("/", 1)[-1]
+                if method == "getMe":
+                    self._json({"ok": True, "result": {
+                        "id": 1, "is_bot": True, "first_name": "Kasper", "username": "kasper_bench_bot",
+                    }})
+                    return
+                message_id = upstreams.next_message_id()
+                message = {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": 1, "type": "private"},
+                    "text": "ok",
+                }
+                if method == "sendVoice":
+                    message["voice"] = {"file_id": f"voice{message_id}", "file_unique_id": f"v{message_id}", "duration": 4}
+                elif method == "sendPhoto":
+                    message["photo"] = [{"file_id": f"photo{message_id}", "file_unique_id": f"p{message_id}",
+                                         "width": 256, "height": 256}]
+                self._json({"ok": True, "result": message})
+
+        return Handler
+
+    def route_stats(self) -> dict:
+        return {route: vars(stats) for route, stats in self.stats.items()}
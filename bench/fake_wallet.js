@@ -0,0 +1,53 @@
+// Stand-in for `node wasm_rpc.js serve` that needs no WASM build.
+// Speaks the same newline-delimited JSON protocol and answers createWallet with a
+// random, clearly fake wallet after FAKE_WALLET_LATENCY_MS milliseconds; deriveAddresses
+// returns deterministic fake addresses for the xpub and index range.
+const crypto = require("crypto");
+const readline = require("readline");
+
+const latencyMs = Number(process.env.FAKE_WALLET_LATENCY_MS || "20");
+
+function send(message) {
+    process.stdout.write(JSON.stringify(message) + "\n");
+}
+
+function createWallet() {
+    const id = crypto.randomBytes(16).toString("hex");
+    return {
+        success: true,
+        mnemonic: "bench ".repeat(12).trim(),
+        receivingAddress: "kaspa:bench" + id,
+        changeAddress: "kaspa:benchchange" + id,
+        xPrv: "xprvbench" + id,
+    };
+}
+
+function deriveAddresses({ xpub, start = 0, count = 1 }) {
+    const addresses = [];
+    for (let i = start; i < start + count; i++) {
+        addresses.push("kaspa:benchhd" + crypto.createHash("sha256").update(xpub + ":" + i).digest("hex").slice(0, 40));
+    }
+    return { success: true, start, addresses };
+}
+
+const rl = readline.createInterface({ input: process.stdin });
+rl.on("line", (line) => {
+    let request;
+    try {
+        request = JSON.parse(line);
+    } catch (err) {
+        return;
+    }
+    setTimeout(() => {
+        if (request.method === "createWallet") {
+            send({ id: request.id, result: createWallet() });
+        } else if (request.method === "deriveAddresses") {
+            send({ id: request.id, result: deriveAddresses(request.params || {}) });
+        } else {
+            send({ id: request.id, error: "Unknown method: " + request.method });
+        }
+    }, latencyMs);
+});
+rl.on("close", () => process.exit(0));
+
+send({ ready: true, pid: process.pid });
@@ -0,0 +1,51 @@
+"""Audio and image fixtures for the fake upstreams, generated locally on first use."""
+import os
+import zlib
+import struct
+import subprocess
+
+from audio_transcoder import FFMPEG_BINARY
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def _ffmpeg_tone(path: str, seconds: float, codec_args: list):
+    if os.path.exists(path):
+        return path
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    subprocess.run(
+        [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-y",
+         "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}"] + codec_args + [path],
+        check=True,
+    )
+    return path
+
+
+def mp3_fixture(seconds: float = 4.0) -> bytes:
+    """A real MP3 voice-note-sized clip, like ElevenLabs' default output."""
+    path = _ffmpeg_tone(os.path.join(FIXTURE_DIR, f"tone_{seconds:g}s.mp3"), seconds,
+                        ["-c:a", "libmp3lame", "-b:a", "64k", "-ar", "44100"])
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def ogg_fixture(seconds: float = 4.0) -> bytes:
+    """OGG/Opus, as returned when the bot asks ElevenLabs for opus_48000_64."""
+    path = _ffmpeg_tone(os.path.join(FIXTURE_DIR, f"tone_{seconds:g}s.ogg"), seconds,
+                        ["-c:a", "libopus", "-b:a", "64k", "-f", "ogg"])
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def png_fixture(size: int = 256) -> bytes:
+    """A flat-colour PNG built with zlib, standing in for a DALL-E image."""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    row = b"\x00" + b"\x20\x40\xff" * size
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * size))
+        + chunk(b"IEND", b"")
+    )
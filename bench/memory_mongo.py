@@ -0,0 +1,273 @@
+"""
+In-memory stand-in for the parts of Motor the bot uses.
+
+It behaves like a standalone mongod: unique indexes are enforced, and sessions raise
+IllegalOperation (code 20), so DBManager takes its no-transaction path. Every
+operation waits `MemoryClient.latency` seconds to model the network round trip.
+"""
+import asyncio
+import itertools
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+
+class MemoryClient:
+    latency = 0.0
+
+    def __init__(self, uri=None, **kwargs):
+        self._databases = {}
+
+    def __getitem__(self, name):
+        if name not in self._databases:
+            self._databases[name] = MemoryDatabase(name)
+        return self._databases[name]
+
+    async def start_session(self):
+        raise OperationFailure("Transaction numbers are only allowed on a replica set member or mongos", code=20)
+
+    def close(self):
+        pass
+
+
+class MemoryDatabase:
+    def __init__(self, name):
+        self.name = name
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(name)
+        return self._collections[name]
+
+
+def _get(doc, field):
+    for part in field.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _matches(doc, query) -> bool:
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(_matches(doc, sub) for sub in condition):
+                return False
+            continue
+        value = _get(doc, field)
+        if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+            for op, arg in condition.items():
+                if op == "$in" and value not in arg:
+                    return False
+                if op == "$ne" and value == arg:
+                    return False
+                if op in ("$gt", "$gte", "$lt", "$lte"):
+                    if value is None:
+                        return False
+                    if op == "$gt" and not value > arg:
+                        return False
+                    if op == "$gte" and not value >= arg:
+                        return False
+                    if op == "$lt" and not value < arg:
+                        return False
+                    if op == "$lte" and not value <= arg:
+                        return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if doc is None or not projection:
+        return dict(doc) if doc is not None else None
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if include:
+        result = {k: doc[k] for k in include if k in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+    return {k: v for k, v in doc.items() if projection.get(k, 1)}
+
+
+def _apply(doc, update, inserting=False):
+    for op, fields in update.items():
+        for field, value in fields.items():
+            if op == "$set" or (op == "$setOnInsert" and inserting):
+                doc[field] = value
+            elif op == "$inc":
+                doc[field] = doc.get(field, 0) + value
+            elif op == "$max":
+                if doc.get(field) is None or value > doc[field]:
+                    doc[field] = value
+
+
+class MemoryCursor:
+    def __init__(self, documents):
+        self._documents = iter(documents)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._documents)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        return list(itertools.islice(self._documents, length))
+
+
+class UpdateResult:
+    def __init__(self, matched, modified, upserted_id=None):
+        self.matched_count = matched
+        self.modified_count = modified
+        self.upserted_id = upserted_id
+
+
+class InsertResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class MemoryCollection:
+    def __init__(self, name):
+        self.name = name
+        self._documents = {}
+        self._unique = set()
+        self.operations = 0
+
+    async def _round_trip(self):
+        self.operations += 1
+        # Always yield, like a real driver call would
+        await asyncio.sleep(MemoryClient.latency)
+
+    def _check_unique(self, doc, ignore_id=None):
+        for field in self._unique:
+            value = doc.get(field)
+            if value is None:
+                continue
+            for other in self._documents.values():
+                if other["_id"] != ignore_id and other.get(field) == value:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {field}_1")
+
+    def _find(self, query, sort=None):
+        documents = [doc for doc in self._documents.values() if _matches(doc, query)]
+        for field, direction in reversed(sort or []):
+            documents.sort(key=lambda d: (_get(d, field) is None, _get(d, field)), reverse=direction < 0)
+        return documents
+
+    async def create_index(self, keys, unique=False, **kwargs):
+        await self._round_trip()
+        if unique and isinstance(keys, str):
+            self._unique.add(keys)
+        return keys if isinstance(keys, str) else "_".join(f"{k}_{d}" for k, d in keys)
+
+    async def find_one(self, query=None, projection=None, session=None, **kwargs):
+        await self._round_trip()
+        documents = self._find(query or {}, kwargs.get("sort"))
+        return _project(documents[0], projection) if documents else None
+
+    def find(self, query=None, projection=None, batch_size=None, session=None, **kwargs):
+        self.operations += 1
+        return MemoryCursor([_project(doc, projection) for doc in self._find(query or {}, kwargs.get("sort"))])
+
+    async def count_documents(self, query, limit=0, session=None, **kwargs):
+        await self._round_trip()
+        count = len(self._find(query))
+        return min(count, limit) if limit else count
+
+    async def distinct(self, field, query=None, session=None):
+        await self._round_trip()
+        return list({_get(doc, field) for doc in self._find(query or {})})
+
+    async def insert_one(self, document, session=None):
+        await self._round_trip()
+        document.setdefault("_id", ObjectId())
+        if document["_id"] in self._documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_")
+        self._check_unique(document)
+        self._documents[document["_id"]] = dict(document)
+        return InsertResult(document["_id"])
+
+    async def insert_many(self, documents, ordered=True, session=None):
+        await self._round_trip()
+        errors = []
+        for index, document in enumerate(documents):
+            document.setdefault("_id", ObjectId())
+            try:
+                if document["_id"] in self._documents:
+                    raise DuplicateKeyError("E11000 duplicate key error")
+                self._check_unique(document)
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+                continue
+            self._documents[document["_id"]] = dict(document)
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+    async def update_one(self, query, update, upsert=False, session=None):
+        await self._round_trip()
+        documents = self._find(query)
+        if documents:
+            updated = dict(documents[0])
+            _apply(updated, update)
+            self._check_unique(updated, ignore_id=updated["_id"])
+            self._documents[updated["_id"]] = updated
+            return UpdateResult(1, 1)
+        if not upsert:
+            return UpdateResult(0, 0)
+        document = {k: v for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)}
+        document.setdefault("_id", ObjectId())
+        _apply(document, update, inserting=True)
+        self._check_unique(document)
+        self._documents[document["_id"]] = document
+        return UpdateResult(0, 0, document["_id"])
+
+    async def update_many(self, query, update, session=None):
+        await self._round_trip()
+        documents = self._find(query)
+        for document in documents:
+            updated = dict(document)
+            _apply(updated, update)
+            self._documents[updated["_id"]] = updated
+        return UpdateResult(len(documents), len(documents))
+
+    async def replace_one(self, query, replacement, upsert=False, session=None):
+        await self._round_trip()
+        documents = self._find(query)
+        if not documents and not upsert:
+            return UpdateResult(0, 0)
+        _id = documents[0]["_id"] if documents else query.get("_id", ObjectId())
+        self._documents[_id] = dict(replacement, _id=_id)
+        return UpdateResult(len(documents), len(documents), None if documents else _id)
+
+    async def find_one_and_update(self, query, update, projection=None, sort=None, upsert=False,
+                                  return_document=False, session=None):
+        await self._round_trip()
+        documents = self._find(query, sort)
+        if not documents:
+            if not upsert:
+                return None
+            document = {k: v for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)}
+            document.setdefault("_id", ObjectId())
+            _apply(document, update, inserting=True)
+            self._documents[document["_id"]] = document
+            return _project(document, projection) if return_document else None
+        before = documents[0]
+        after = dict(before)
+        _apply(after, update)
+        self._check_unique(after, ignore_id=after["_id"])
+        self._documents[after["_id"]] = after
+        # ReturnDocument.AFTER is True
+        return _project(after if return_document else before, projection)
+
+    async def delete_one(self, query, session=None):
+        await self._round_trip()
+        documents = self._find(query)
+        if documents:
+            del self._documents[documents[0]["_id"]]
+        return UpdateResult(len(documents[:1]), len(documents[:1]))
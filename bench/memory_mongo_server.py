@@ -0,0 +1,232 @@
+"""
+Shares one bench.memory_mongo store between processes, for the scale-out bench.
+
+The server runs the store on its own event loop, so every operation stays atomic as
+in the single-process bench; clients send BSON requests over one pipelined TCP
+connection and get Motor-like results back. Errors the bot handles (duplicate keys,
+bulk write errors, the standalone "no transactions" failure) are re-raised client side.
+
+    python -m bench.memory_mongo_server --port 27999 --latency 0.002
+"""
+import sys
+import struct
+import asyncio
+import argparse
+import itertools
+
+import bson
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from bench.memory_mongo import MemoryClient, MemoryCursor, UpdateResult, InsertResult
+
+RESULT_TYPES = {"update": UpdateResult, "insert": InsertResult}
+
+
+async def read_document(reader) -> dict:
+    header = await reader.readexactly(4)
+    (length,) = struct.unpack("<i", header)
+    return bson.decode(header + await reader.readexactly(length - 4))
+
+
+def encode_result(result):
+    if isinstance(result, UpdateResult):
+        return "update", {"matched": result.matched_count, "modified": result.modified_count,
+                          "upserted_id": result.upserted_id}
+    if isinstance(result, InsertResult):
+        return "insert", {"inserted_id": result.inserted_id}
+    return "value", result
+
+
+def decode_result(kind: str, value):
+    if kind == "update":
+        return UpdateResult(value["matched"], value["modified"], value["upserted_id"])
+    if kind == "insert":
+        return InsertResult(value["inserted_id"])
+    return value
+
+
+class MemoryMongoServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.client = MemoryClient()
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request = await read_document(reader)
+                # Answered concurrently, like a real server with many in-flight operations
+                asyncio.create_task(self._answer(request, writer))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    async def _answer(self, request: dict, writer):
+        reply = {"id": request["id"]}
+        try:
+            if request["op"] == "reset":
+                self.client = MemoryClient()
+                result = None
+            else:
+                collection = self.client[request["db"]][request["collection"]]
+                result = getattr(collection, request["op"])(*request["args"], **request["kwargs"])
+                result = await (result.to_list() if isinstance(result, MemoryCursor) else result)
+            reply["kind"], reply["result"] = encode_result(result)
+        except BulkWriteError as e:
+            reply["error"] = {"type": "BulkWriteError", "details": e.details}
+        except DuplicateKeyError as e:
+            reply["error"] = {"type": "DuplicateKeyError", "message": str(e)}
+        except OperationFailure as e:
+            reply["error"] = {"type": "OperationFailure", "message": str(e), "code": e.code}
+        except Exception as e:
+            reply["error"] = {"type": "OperationFailure", "message": repr(e), "code": None}
+        if not writer.is_closing():
+            writer.write(bson.encode(reply))
+
+
+class RemoteClient:
+    """Drop-in for AsyncIOMotorClient; set `RemoteClient.address` before DBManager is created."""
+
+    address = ("127.0.0.1", 27999)
+
+    def __init__(self, uri=None, **kwargs):
+        self._ids = itertools.count()
+        self._pending = {}
+        self._writer = None
+        self._reader_task = None
+        self._connecting = None
+
+    def __getitem__(self, name):
+        return RemoteDatabase(self, name)
+
+    async def start_session(self):
+        raise OperationFailure("Transaction numbers are only allowed on a replica set member or mongos", code=20)
+
+    async def _connect(self):
+        if self._writer is None:
+            if self._connecting is None:
+                self._connecting = asyncio.ensure_future(asyncio.open_connection(*self.address))
+            reader, writer = await self._connecting
+            if self._writer is None:
+                self._writer = writer
+                self._reader_task = asyncio.create_task(self._read_replies(reader))
+        return self._writer
+
+    async def _read_replies(self, reader):
+        try:
+            while True:
+                reply = await read_document(reader)
+                future = self._pending.pop(reply["id"], None)
+                if future and not future.done():
+                    future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Memory Mongo server went away: {e}"))
+
+    async def call(self, db: str, collection: str, op: str, *args, **kwargs):
+        writer = await self._connect()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        writer.write(bson.encode({
+            "id": request_id, "db": db, "collection": collection, "op": op, "args": list(args), "kwargs": kwargs,
+        }))
+        reply = await future
+        error = reply.get("error")
+        if error:
+            if error["type"] == "BulkWriteError":
+                raise BulkWriteError(error["details"])
+            if error["type"] == "DuplicateKeyError":
+                raise DuplicateKeyError(error["message"])
+            raise OperationFailure(error["message"], code=error.get("code"))
+        return decode_result(reply["kind"], reply["result"])
+
+    async def reset(self):
+        await self.call("", "", "reset")
+
+    def close(self):
+        if self._reader_task:
+            self._reader_task.cancel()
+        if self._writer:
+            self._writer.close()
+
+
+class RemoteDatabase:
+    def __init__(self, client: RemoteClient, name: str):
+        self.client = client
+        self.name = name
+
+    def __getitem__(self, name):
+        return RemoteCollection(self.client, self.name, name)
+
+
+class RemoteCursor:
+    def __init__(self, fetch):
+        self._fetch = fetch
+        self._documents = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._documents is None:
+            self._documents = iter(await self._fetch())
+        try:
+            return next(self._documents)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        documents = await self._fetch()
+        return documents[:length] if length else documents
+
+
+class RemoteCollection:
+    def __init__(self, client: RemoteClient, db: str, name: str):
+        self.client = client
+        self.db = db
+        self.name = name
+
+    def find(self, query=None, projection=None, **kwargs):
+        kwargs.pop("batch_size", None)
+        kwargs.pop("session", None)
+        return RemoteCursor(lambda: self.client.call(self.db, self.name, "find", query or {}, projection, **kwargs))
+
+    def __getattr__(self, op):
+        async def call(*args, session=None, **kwargs):
+            return await self.client.call(self.db, self.name, op, *args, **kwargs)
+
+        return call
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=27999)
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds per operation")
+    args = parser.parse_args(argv)
+
+    async def serve():
+        MemoryClient.latency = args.latency
+        server = await MemoryMongoServer(args.host, args.port).start()
+        print(f"listening {server.port}", flush=True)
+        await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,460 @@
+"""
+Offline load test for the Kasper bot.
+
+Drives the real handlers (text messages, /start, /endtopup, /generateimage) through
+Application.process_update with synthetic updates. The upstreams are replaced with
+local stand-ins:
+  - OpenAI, ElevenLabs, Kasplex and the Telegram Bot API by bench.fake_upstreams;
+  - MongoDB by bench.memory_mongo;
+  - the wasm wallet worker by bench/fake_wallet.js.
+No network is needed, only node and ffmpeg.
+
+    python -m bench.run                                    # defaults: 500 updates, 32 concurrent
+    python -m bench.run --updates 2000 --rate 50           # open loop at 50 updates/s
+    python -m bench.run --fault chat=latency:1.5,error_rate:0.05
+    python -m bench.run --fault chat=slow_rate:0.03,slow_latency:5   # a latency tail for hedging
+    python -m bench.run --fault tts=latency:3 --concurrency 64       # TTS overload, text-first replies
+    python -m bench.run --no-latency                       # pure bot overhead
+    python -m bench.run --compare bench/results/baseline.json
+
+Throughput and p50/p95/p99 latency are reported per stage and written as JSON to
+bench/results/, so two runs can be compared with --compare.
+"""
+import os
+import sys
+import json
+import time
+import math
+import random
+import signal
+import asyncio
+import logging
+import argparse
+import platform
+import subprocess
+from functools import wraps
+from datetime import datetime
+from collections import Counter, defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fake_upstreams import FakeUpstreams, FakeUpstreamConfig, Fault  # noqa: E402
+
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+
+DEFAULT_FAULTS = {
+    "chat": Fault(latency=0.6, jitter=0.4),
+    "tts": Fault(latency=0.4, jitter=0.3),
+    "image": Fault(latency=2.0, jitter=1.0),
+    "oplist": Fault(latency=0.1, jitter=0.05),
+    "telegram": Fault(latency=0.03, jitter=0.02),
+}
+
+QUESTIONS = [
+    "What is Kasper?",
+    "When did KASPER launch?",
+    "Where can I buy KASPER?",
+    "What is the total supply?",
+    "Who founded Kasper?",
+    "Tell me about the roadmap",
+    "Which wallets support KASPER?",
+    "Why is Kaspa fast?",
+    "Is KASPER the best KRC20 token?",
+    "Tell me a ghost story",
+]
+
+
+def percentile(sorted_samples: list, q: float) -> float:
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[max(0, math.ceil(q / 100 * len(sorted_samples)) - 1)]
+
+
+class StageTimings:
+    """Latency samples and error counts per stage name."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+
+    def record(self, stage: str, seconds: float, ok: bool = True):
+        self.samples[stage].append(seconds)
+        if not ok:
+            self.errors[stage] += 1
+
+    def wrap(self, stage: str, func):
+        @wraps(func)
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            ok = False
+            try:
+                result = await func(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                self.record(stage, time.perf_counter() - started, ok)
+
+        return timed
+
+    def summary(self, duration: float) -> dict:
+        result = {}
+        for stage in sorted(self.samples):
+            samples = sorted(self.samples[stage])
+            result[stage] = {
+                "count": len(samples),
+                "errors": self.errors[stage],
+                "per_second": len(samples) / duration if duration else 0.0,
+                "mean_ms": 1000 * sum(samples) / len(samples),
+                "p50_ms": 1000 * percentile(samples, 50),
+                "p95_ms": 1000 * percentile(samples, 95),
+                "p99_ms": 1000 * percentile(samples, 99),
+                "max_ms": 1000 * samples[-1],
+            }
+        return result
+
+
+def parse_fault(spec: str):
+    """"chat=latency:1.5,jitter:0.2,error_rate:0.05,error_status:429" -> ("chat", Fault)."""
+    route, _, options = spec.partition("=")
+    values = {}
+    for option in filter(None, options.split(",")):
+        key, _, value = option.partition(":")
+        values[key] = int(value) if key == "error_status" else float(value)
+    return route, values
+
+
+def configure_environment(args, base_url: str):
+    """Point the bot at the stand-ins. Must run before kasper_telegram_bot is imported."""
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456:bench",
+        "OPENAI_API_KEY": "bench",
+        "ELEVEN_LABS_API_KEY": "bench",
+        "ELEVEN_LABS_VOICE_ID": "bench-voice",
+        "ELEVEN_LABS_OUTPUT_FORMAT": args.tts_format,
+        "MONGO_URI": "mongodb://memory",
+        "OPENAI_BASE_URL": base_url,
+        "ELEVEN_LABS_BASE_URL": base_url,
+        "KASPLEX_BASE_URL": base_url,
+        "STREAMING_REPLIES": "1" if args.streaming else "0",
+        # Periodic scans would compete with the measured /endtopup scans
+        "DEPOSIT_SCAN_INTERVAL": "0",
+        # The bench measures capacity, not the per-user token bucket
+        "MAX_MESSAGES_PER_USER": "1000000000",
+        "HTTP2_ENABLED": "0",
+        "COALESCE_WINDOW": str(getattr(args, "coalesce_window", 0.0)),
+        "HEDGE_PERCENTILE": str(getattr(args, "hedge_percentile", 95.0)),
+        "DEGRADATION": "0" if getattr(args, "no_degradation", False) else "1",
+    })
+    if not args.real_wallet:
+        os.environ["WALLET_SCRIPT"] = os.path.join(ROOT, "bench", "fake_wallet.js")
+        os.environ["FAKE_WALLET_LATENCY_MS"] = str(int(args.wallet_latency * 1000))
+
+
+def load_bot(args, timings: StageTimings):
+    from bench.memory_mongo import MemoryClient
+    import db_manager
+
+    MemoryClient.latency = args.mongo_latency
+    db_manager.AsyncIOMotorClient = MemoryClient
+
+    import kasper_telegram_bot as bot
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    # Handlers look these up as module globals at call time, so wrapping them here times every call
+    for name, stage in [
+        ("generate_openai_response", "chat"),
+        ("stream_text_and_voice", "chat_tts_stream"),
+        ("elevenlabs_tts", "tts"),
+        ("convert_to_ogg", "transcode"),
+        ("create_wallet", "wallet"),
+        ("generate_image_with_openai", "image_generate"),
+    ]:
+        setattr(bot, name, timings.wrap(stage, getattr(bot, name)))
+    for name in ("get_user", "reserve_credits", "refund_credits", "create_user", "get_credits", "ingest_deposits"):
+        setattr(bot.db_manager, name, timings.wrap(f"db.{name}", getattr(bot.db_manager, name)))
+    bot.deposit_scanner.scan_wallet = timings.wrap("deposit_scan", bot.deposit_scanner.scan_wallet)
+    return bot
+
+
+def timed_request_class(timings: StageTimings):
+    from telegram.request import HTTPXRequest
+
+    class TimedRequest(HTTPXRequest):
+        """Times every Bot API call by method name (sendMessage, sendVoice, ...)."""
+
+        async def do_request(self, url, method, *args, **kwargs):
+            started = time.perf_counter()
+            ok = False
+            try:
+                result = await super().do_request(url, method, *args, **kwargs)
+                ok = True
+                return result
+            finally:
+                timings.record(f"telegram.{url.rsplit('/', 1)[-1]}", time.perf_counter() - started, ok)
+
+    return TimedRequest
+
+
+def make_update(bot_api, update_id: int, user_id: int, text: str):
+    from telegram import Update
+
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": update_id, "message": message}, bot_api)
+
+
+def build_workload(args) -> list:
+    """[(kind, user_id, text)] following the --mix weights."""
+    rng = random.Random(args.seed)
+    kinds, weights = zip(*args.mix.items())
+    workload = []
+    new_users = 0
+    while len(workload) < args.updates:
+        i = len(workload)
+        kind = rng.choices(kinds, weights)[0]
+        user_id = 1000 + rng.randrange(args.users)
+        if kind == "text":
+            text = rng.choice(QUESTIONS)
+            if rng.random() >= args.repeat_ratio:
+                # Unique wording keeps the reply cache from answering
+                text = f"{text} #{i}"
+        elif kind == "start":
+            new_users += 1
+            user_id = 10 ** 9 + new_users
+            text = "/start"
+        elif kind == "endtopup":
+            text = "/endtopup"
+        elif kind == "generateimage":
+            text = f"/generateimage a ghost surfing wave {rng.randrange(args.image_prompts)}"
+        else:
+            raise ValueError(f"Unknown update kind: {kind}")
+        workload.append((kind, user_id, text))
+        if kind == "text":
+            # The rest of a burst follows right behind, from the same user
+            workload.extend(("burst", user_id, f"{rng.choice(QUESTIONS)} #{i}.{part}") for part in range(1, args.burst))
+    return workload[:args.updates]
+
+
+async def seed_users(bot, count: int):
+    for i in range(count):
+        await bot.db_manager.create_user(1000 + i, f"kaspa:benchseed{i}", "bench", "bench", credits=10 ** 9)
+
+
+async def drive(app, workload: list, args, timings: StageTimings):
+    """Run the workload closed-loop (--concurrency) or open-loop (--rate); returns the wall time."""
+    updates = [(kind, make_update(app.bot, i + 1, user_id, text)) for i, (kind, user_id, text) in enumerate(workload)]
+
+    async def process(kind, update, scheduled):
+        ok = False
+        try:
+            await app.process_update(update)
+            ok = True
+        finally:
+            timings.record(f"update.{kind}", time.perf_counter() - scheduled, ok)
+
+    started = time.perf_counter()
+    if args.rate > 0:
+        rng = random.Random(args.seed)
+        tasks = []
+        due = started
+        for kind, update in updates:
+            due += args.burst_gap if kind == "burst" else rng.expovariate(args.rate)
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            # Latency is measured from the scheduled arrival, so queueing delay counts
+            tasks.append(asyncio.create_task(process(kind, update, due)))
+        await asyncio.gather(*tasks, return_exceptions=True)
+    else:
+        queue = iter(updates)
+
+        async def worker():
+            for kind, update in queue:
+                await process(kind, update, time.perf_counter())
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return time.perf_counter() - started
+
+
+async def wait_for_image_jobs(bot, expected: int, timeout: float):
+    deadline = time.monotonic() + timeout
+    while bot.image_jobs.completed + bot.image_jobs.failed < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+
+
+async def wait_for_deferred_voice(bot, timeout: float):
+    deadline = time.monotonic() + timeout
+    while bot.degradation.pending and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+
+
+async def run(args) -> dict:
+    config = FakeUpstreamConfig(faults=args.faults, tts_seconds=args.tts_seconds)
+    upstreams = FakeUpstreams(config).start()
+    timings = StageTimings()
+    configure_environment(args, upstreams.base_url)
+    bot = load_bot(args, timings)
+
+    from telegram.ext import ApplicationBuilder
+
+    builder = ApplicationBuilder().base_url(f"{upstreams.base_url}/bot").request(
+        timed_request_class(timings)(connection_pool_size=args.concurrency + 8)
+    )
+    app = bot.build_application(builder)
+    await app.initialize()
+    await bot.on_startup(app)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        # Ctrl-C should stop the bench, not drain it like a production worker
+        loop.remove_signal_handler(sig)
+
+    deliver = bot.image_jobs.deliver
+
+    async def timed_deliver(job, photo):
+        file_id = await deliver(job, photo)
+        timings.record("image_job", (datetime.utcnow() - job["created_at"]).total_seconds())
+        return file_id
+
+    bot.image_jobs.deliver = timed_deliver
+
+    await seed_users(bot, args.users)
+    workload = build_workload(args)
+    try:
+        duration = await drive(app, workload, args, timings)
+        images = sum(1 for kind, _, _ in workload if kind == "generateimage")
+        await wait_for_image_jobs(bot, images, args.image_timeout)
+        await wait_for_deferred_voice(bot, bot.degradation.deadline)
+        components = {
+            "upstream": bot.upstream.stats(),
+            "transcoder": bot.transcoder.stats(),
+            "reply_cache": bot.reply_cache.stats(),
+            "user_cache": bot.db_manager.user_cache.stats(),
+            "rate_limiter": bot.rate_limiter.stats(),
+            "image_jobs": bot.image_jobs.stats(),
+            "dispatcher": bot.dispatcher.stats(),
+            "coalescer": bot.message_coalescer.stats(),
+            "request_policy": bot.request_policy_stats(),
+            "degradation": bot.degradation.stats(),
+            "deposit_scanner": bot.deposit_scanner.stats(),
+        }
+    finally:
+        await bot.on_shutdown(app)
+        await app.shutdown()
+        upstreams.stop()
+
+    return {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("faults", "compare", "output")},
+            "faults": {route: vars(fault) for route, fault in args.faults.items()},
+        },
+        "totals": {
+            "updates": len(workload),
+            "duration_s": duration,
+            "updates_per_second": len(workload) / duration if duration else 0.0,
+        },
+        "stages": timings.summary(duration),
+        "fake_upstreams": upstreams.route_stats(),
+        "components": components,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def print_report(result: dict, baseline: dict = None):
+    totals = result["totals"]
+    print(f"\n{totals['updates']} updates in {totals['duration_s']:.2f}s = {totals['updates_per_second']:.1f} updates/s")
+    if baseline:
+        before = baseline["totals"]["updates_per_second"]
+        print(f"baseline {before:.1f} updates/s ({_change(before, totals['updates_per_second'])})")
+    print(f"\n{'stage':<28} {'count':>6} {'err':>4} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage, row in result["stages"].items():
+        line = (f"{stage:<28} {row['count']:>6} {row['errors']:>4} "
+                f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+        old = (baseline or {}).get("stages", {}).get(stage)
+        if old:
+            line += f"   p50 {_change(old['p50_ms'], row['p50_ms'])}, p99 {_change(old['p99_ms'], row['p99_ms'])}"
+        print(line)
+
+
+def _change(before: float, after: float) -> str:
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=500, help="synthetic updates to send")
+    parser.add_argument("--users", type=int, default=100, help="pre-registered users sending them")
+    parser.add_argument("--concurrency", type=int, default=32, help="closed loop: updates in flight")
+    parser.add_argument("--rate", type=float, default=0, help="open loop: Poisson arrivals per second")
+    parser.add_argument("--mix", default="text=85,start=5,endtopup=5,generateimage=5",
+                        help="relative weights of update kinds")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0,
+                        help="fraction of texts repeated verbatim (reply cache hits)")
+    parser.add_argument("--burst", type=int, default=1, help="text messages each user sends back to back")
+    parser.add_argument("--burst-gap", type=float, default=0.3, help="open loop: seconds between messages of a burst")
+    parser.add_argument("--coalesce-window", type=float, default=0.0, help="COALESCE_WINDOW; 0 answers every message")
+    parser.add_argument("--hedge-percentile", type=float, default=95.0, help="HEDGE_PERCENTILE; 0 disables hedging")
+    parser.add_argument("--no-degradation", action="store_true", help="DEGRADATION=0: every reply waits for its voice")
+    parser.add_argument("--image-prompts", type=int, default=20, help="distinct image prompts")
+    parser.add_argument("--fault", action="append", default=[], metavar="ROUTE=KEY:VALUE,...",
+                        help="override latency/jitter/error_rate/error_status for chat, tts, image, oplist or telegram")
+    parser.add_argument("--no-latency", action="store_true", help="zero every injected latency")
+    parser.add_argument("--mongo-latency", type=float, default=0.002, help="seconds per Mongo operation")
+    parser.add_argument("--wallet-latency", type=float, default=0.02, help="seconds per fake wallet creation")
+    parser.add_argument("--real-wallet", action="store_true", help="use wasm_rpc.js instead of the fake wallet")
+    parser.add_argument("--streaming", action="store_true", help="run with STREAMING_REPLIES=1")
+    parser.add_argument("--tts-format", default="", help="ELEVEN_LABS_OUTPUT_FORMAT; empty means MP3 + transcode")
+    parser.add_argument("--tts-seconds", type=float, default=4.0, help="length of the TTS audio fixture")
+    parser.add_argument("--image-timeout", type=float, default=120, help="seconds to wait for image jobs")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="result file (default bench/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logging")
+    args = parser.parse_args(argv)
+
+    args.mix = {kind: float(weight) for kind, weight in (item.split("=") for item in args.mix.split(","))}
+    faults = {} if args.no_latency else {route: Fault(**vars(fault)) for route, fault in DEFAULT_FAULTS.items()}
+    for spec in args.fault:
+        route, values = parse_fault(spec)
+        faults[route] = Fault(**dict(vars(faults.get(route) or Fault()), **values))
+    args.faults = faults
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    output = args.output or os.path.join(RESULTS_DIR, datetime.utcnow().strftime("%Y%m%dT%H%M%SZ") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2, default=str)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
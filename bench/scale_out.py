@@ -0,0 +1,240 @@
+"""
+Multi-process throughput test for the ingress/processor mode.
+
+Starts the fake upstreams and a memory Mongo server shared by every process, then for
+each processor count:
+  1. starts N `kasper_telegram_bot.run_processor()` processes and waits until the
+     shards are spread over all of them;
+  2. queues synthetic text messages exactly as the ingress does (UpdateQueue);
+  3. times how long the processors take to drain the queue.
+
+With --crash, one processor is killed with SIGKILL halfway through; its shards and
+leased updates must move to the survivors once their leases expire.
+
+    python -m bench.scale_out                                  # 1, 2 and 4 processors
+    python -m bench.scale_out --processors 1,2,4,8 --updates 800 --workers 8
+    python -m bench.scale_out --processors 2 --crash
+
+Each processor runs at most --workers updates at once, like UPDATE_WORKERS in
+production, so one process is the bottleneck being scaled out. Speedup is only
+near-linear while the host has idle cores; the report prints the CPU count.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fake_upstreams import FakeUpstreams, FakeUpstreamConfig, Fault  # noqa: E402
+from bench.run import DEFAULT_FAULTS, QUESTIONS, RESULTS_DIR, configure_environment, git_commit  # noqa: E402
+
+# Short leases so shards settle quickly between runs
+QUEUE_ENVIRONMENT = {
+    "UPDATE_HEARTBEAT": "0.5",
+    "SHARD_LEASE": "3",
+    "UPDATE_POLL_INTERVAL": "0.05",
+    "UPDATE_LEASE": "5",
+}
+
+
+def start_mongo_server(latency: float):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "bench.memory_mongo_server", "--port", "0", "--latency", str(latency)],
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    port = int(process.stdout.readline().split()[-1])
+    return process, port
+
+
+def start_processor(args, base_url: str, mongo_port: int):
+    command = [
+        sys.executable, "-m", "bench.scale_out", "--child",
+        "--base-url", base_url, "--mongo-port", str(mongo_port),
+        "--tts-format", args.tts_format, "--wallet-latency", str(args.wallet_latency),
+    ]
+    env = dict(os.environ, UPDATE_WORKERS=str(args.workers), **QUEUE_ENVIRONMENT)
+    return subprocess.Popen(command, cwd=ROOT, env=env)
+
+
+def run_child(args):
+    """One processor process, pointed at the shared store and the fake upstreams."""
+    configure_environment(args, args.base_url)
+    from bench.memory_mongo_server import RemoteClient
+    import db_manager
+
+    RemoteClient.address = ("127.0.0.1", args.mongo_port)
+    db_manager.AsyncIOMotorClient = RemoteClient
+
+    import logging
+    import kasper_telegram_bot as bot
+    from telegram.ext import ApplicationBuilder
+
+    logging.getLogger().setLevel(logging.WARNING)
+    builder = ApplicationBuilder().base_url(f"{args.base_url}/bot")
+    asyncio.run(bot.run_processor(builder))
+
+
+async def wait_for_shards(queue, processors: int, timeout: float = 30):
+    """Until every shard is owned and spread over exactly `processors` processes."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        owners = [doc.get("owner") async for doc in queue.shards.find({})]
+        if None not in owners and len(set(owners)) == processors:
+            counts = [owners.count(owner) for owner in set(owners)]
+            if max(counts) - min(counts) <= 1:
+                return
+        await asyncio.sleep(0.2)
+    raise TimeoutError(f"Shards did not settle over {processors} processors")
+
+
+async def measure(args, base_url: str, mongo_port: int, processors: int) -> dict:
+    from bench.memory_mongo_server import RemoteClient
+    from bench.run import make_update
+    import db_manager
+    from update_queue import UpdateQueue, DONE
+
+    RemoteClient.address = ("127.0.0.1", mongo_port)
+    db_manager.AsyncIOMotorClient = RemoteClient
+    db = db_manager.DBManager("mongodb://memory")
+    await db.client.reset()
+    await db.ensure_indexes()
+    queue = UpdateQueue(db.db)
+    await queue.ensure_indexes()
+    await db.users.insert_many([
+        {"telegram_id": 1000 + i, "wallet_address": f"kaspa:benchseed{i}", "private_key": "bench",
+         "mnemonic": "bench", "credits": 10 ** 9, "version": 0}
+        for i in range(args.users)
+    ])
+
+    children = [start_processor(args, base_url, mongo_port) for _ in range(processors)]
+    try:
+        await wait_for_shards(queue, processors)
+        documents = [
+            queue.document(make_update(None, i + 1, 1000 + i % args.users, f"{QUESTIONS[i % len(QUESTIONS)]} #{i}"))
+            for i in range(args.updates)
+        ]
+        started = time.perf_counter()
+        await queue.updates.insert_many(documents)
+        crashed = False
+        while await queue.pending():
+            if args.crash and not crashed and processors > 1:
+                if await queue.updates.count_documents({"status": DONE}) >= args.updates // 2:
+                    children[-1].kill()
+                    crashed = True
+                    print(f"Killed processor pid {children[-1].pid}", flush=True)
+            await asyncio.sleep(0.05)
+        duration = time.perf_counter() - started
+        done = await queue.updates.count_documents({"status": DONE})
+        retried = await queue.updates.count_documents({"attempts": {"$gt": 1}})
+    finally:
+        for child in children:
+            child.send_signal(signal.SIGTERM)
+        for child in children:
+            try:
+                child.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                child.kill()
+        db.close()
+
+    return {
+        "processors": processors,
+        "updates": args.updates,
+        "done": done,
+        "retried": retried,
+        "duration_s": duration,
+        "updates_per_second": args.updates / duration if duration else 0.0,
+    }
+
+
+async def run(args) -> dict:
+    config = FakeUpstreamConfig(faults=args.faults, tts_seconds=args.tts_seconds)
+    upstreams = FakeUpstreams(config).start()
+    configure_environment(args, upstreams.base_url)
+    mongo, mongo_port = start_mongo_server(args.mongo_latency)
+    results = []
+    try:
+        for processors in args.processors:
+            result = await measure(args, upstreams.base_url, mongo_port, processors)
+            results.append(result)
+            print(f"{processors} processor(s): {result['updates_per_second']:.1f} updates/s "
+                  f"({result['done']}/{result['updates']} done, {result['retried']} retried, "
+                  f"in {result['duration_s']:.2f}s)", flush=True)
+    finally:
+        mongo.terminate()
+        mongo.wait()
+        upstreams.stop()
+    return {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("faults", "output")},
+        },
+        "results": results,
+    }
+
+
+def print_report(report: dict):
+    results = report["results"]
+    base = results[0]["updates_per_second"] / results[0]["processors"] if results else 0
+    print(f"\n{'processors':>10} {'updates/s':>10} {'speedup':>8} {'efficiency':>10}   ({report['meta']['cpus']} CPUs)")
+    for row in results:
+        speedup = row["updates_per_second"] / base if base else 0.0
+        print(f"{row['processors']:>10} {row['updates_per_second']:>10.1f} {speedup:>7.2f}x "
+              f"{speedup / row['processors']:>10.0%}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processors", default="1,2,4", help="comma-separated processor counts to measure")
+    parser.add_argument("--updates", type=int, default=400, help="text messages queued per measurement")
+    parser.add_argument("--users", type=int, default=200, help="distinct users sending them")
+    parser.add_argument("--workers", type=int, default=8, help="UPDATE_WORKERS per processor")
+    parser.add_argument("--crash", action="store_true", help="SIGKILL one processor halfway through")
+    parser.add_argument("--no-latency", action="store_true", help="zero every injected latency")
+    parser.add_argument("--mongo-latency", type=float, default=0.002, help="seconds per Mongo operation")
+    parser.add_argument("--wallet-latency", type=float, default=0.02, help="seconds per fake wallet creation")
+    parser.add_argument("--tts-format", default="opus_48000_64", help="ELEVEN_LABS_OUTPUT_FORMAT; empty means MP3 + transcode")
+    parser.add_argument("--tts-seconds", type=float, default=4.0, help="length of the TTS audio fixture")
+    parser.add_argument("--output", help="result file (default bench/results/scale-out-<timestamp>.json)")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    parser.add_argument("--mongo-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    args.processors = [int(count) for count in args.processors.split(",")]
+    args.faults = {} if args.no_latency else {route: Fault(**vars(fault)) for route, fault in DEFAULT_FAULTS.items()}
+    # configure_environment() reads these
+    args.streaming = False
+    args.real_wallet = False
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        run_child(args)
+        return
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    output = args.output or os.path.join(RESULTS_DIR, "scale-out-" + datetime.utcnow().strftime("%Y%m%dT%H%M%SZ") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,67 +1,135 @@
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
 import os
+import asyncio
+import logging
 from datetime import datetime
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+# Hot paths never need the wallet secrets, so they are left out of user reads
+USER_PROJECTION = {"private_key": 0, "mnemonic": 0}
 
 class DBManager:
-    def __init__(self):
-        mongo_uri = os.getenv("MONGO_URI")
-        self.client = MongoClient(mongo_uri)
+    def __init__(self, mongo_uri=None, user_cache=None):
+        mongo_uri = mongo_uri or os.getenv("MONGO_URI")
+        self.user_cache = user_cache
+        self._watch_task = None
+        self.client = AsyncIOMotorClient(mongo_uri)
         self.db = self.client["kasper_bot"]
         self.users = self.db["users"]
+        self.transactions = self.db["transactions"]
+        self.deposit_checkpoints = self.db["deposit_checkpoints"]
+        # Flipped off the first time the server turns out to be a standalone mongod
+        self.transactions_supported = True
 
-    def get_user(self, telegram_id):
-        """Retrieve a user by their Telegram ID."""
-        return self.users.find_one({"telegram_id": telegram_id})
-        
-    def is_transaction_processed(self, hash_rev: str) -> bool:
-        """
-        Check if a transaction with the given hashRev is already processed.
-        """
-        return self.db["transactions"].find_one({"hashRev": hash_rev}) is not None
-
-    def save_transaction(self, hash_rev: str, amount: float, wallet_address: str):
-        transaction = {
-            "hashRev": hash_rev,
-            "amount": amount,
-            "walletAddress": wallet_address,
-            "timestamp": datetime.utcnow()
-        }
-        self.db["transactions"].insert_one(transaction)
-        
-    def create_user(self, telegram_id, wallet_address, private_key, mnemonic, credits=0):
+    async def ensure_indexes(self):
+        """Create the indexes the bot relies on. Safe to call on every startup."""
+        indexes = [
+            (self.users, "telegram_id"),
+            (self.transactions, "hashRev"),
+        ]
+        for collection, field in indexes:
+            try:
+                await collection.create_index(field, unique=True)
+            except PyMongoError as e:
+                # Usually pre-existing duplicates; the bot still works, just without the guarantee
+                logger.error(f"Could not create unique index on {collection.name}.{field}: {e}")
+        # Deposit matching goes from an address to its user in one lookup
+        try:
+            await self.users.create_index("wallet_address")
+        except PyMongoError as e:
+            logger.error(f"Could not create index on users.wallet_address: {e}")
+
+    async def get_user(self, telegram_id):
+        """Retrieve a user by their Telegram ID, without wallet secrets."""
+        if self.user_cache is not None:
+            cached = self.user_cache.get(telegram_id)
+            if cached is not None:
+                return cached
+        return self._remember(await self.users.find_one({"telegram_id": telegram_id}, USER_PROJECTION))
+
+    def _remember(self, user):
+        """Write a freshly read or updated user document through to the cache."""
+        if user is None or self.user_cache is None:
+            return user
+        return self.user_cache.put(user)
+
+    def _forget(self, telegram_id):
+        if self.user_cache is not None:
+            self.user_cache.invalidate(telegram_id)
+
+    async def get_user_by_address(self, wallet_address: str):
+        """Retrieve the user a deposit address belongs to, without wallet secrets."""
+        return await self.users.find_one({"wallet_address": wallet_address}, USER_PROJECTION)
+
+    async def create_user(self, telegram_id, wallet_address, private_key, mnemonic, credits=0, derivation_index=None):
         """
         Create a new user in the database with their wallet information.
 
         Args:
             telegram_id (int): Telegram user ID.
             wallet_address (str): The wallet address associated with the user.
-            private_key (str): The private key for the user's wallet.
-            mnemonic (str): The mnemonic phrase for the user's wallet.
+            private_key (str): The private key for the user's wallet; None for HD-derived addresses.
+            mnemonic (str): The mnemonic phrase for the user's wallet; None for HD-derived addresses.
             credits (int, optional): Initial credits for the user. Defaults to 0.
+            derivation_index (int, optional): Index i of an HD address m/44'/111111'/0'/0/i.
         """
         user = {
             "telegram_id": telegram_id,
             "wallet_address": wallet_address,
-            "private_key": private_key,
-            "mnemonic": mnemonic,
             "credits": credits,
+            "version": 0,
             "created_at": datetime.utcnow(),
         }
-        self.users.insert_one(user)
+        if derivation_index is not None:
+            user["derivation_index"] = derivation_index
+        else:
+            user["private_key"] = private_key
+            user["mnemonic"] = mnemonic
+        await self.users.insert_one(user)
+        self._remember(user)
 
-    def transaction_exists(self, hashRev: str) -> bool:
-        """Check if a transaction already exists in the database."""
-        return self.transactions.find_one({"hashRev": hashRev}) is not None
+    async def update_credits(self, telegram_id: int, credits: int):
+        """Update the user's credit balance."""
+        user = await self.users.find_one_and_update(
+            {"telegram_id": telegram_id},
+            {"$inc": {"credits": credits, "version": 1}},
+            projection=USER_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+        )
+        self._remember(user)
 
-    def add_transaction(self, transaction: dict):
-        """Add a new transaction to the database."""
-        self.transactions.insert_one(transaction)
+    async def reserve_credits(self, telegram_id: int, cost: int):
+        """
+        Atomically take `cost` credits from a user who has at least that many.
 
-    def update_credits(self, telegram_id: int, credits: int):
-        """Update the user's credit balance."""
-        self.users.update_one({"telegram_id": telegram_id}, {"$inc": {"credits": credits}})
+        This is the only round trip a paid action needs before it starts: the balance
+        check and the deduction happen in one conditional update, so concurrent
+        messages can never drive credits negative.
 
-    def get_credits(self, telegram_id):
+        Returns:
+            dict or None: The updated user (without wallet secrets), or None if the user
+            does not exist or does not have enough credits.
+        """
+        user = await self.users.find_one_and_update(
+            {"telegram_id": telegram_id, "credits": {"$gte": cost}},
+            {"$inc": {"credits": -cost, "version": 1}},
+            projection=USER_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+        )
+        if user is None:
+            # Whatever the cache says about this user's balance is stale
+            self._forget(telegram_id)
+        return self._remember(user)
+
+    async def refund_credits(self, telegram_id: int, cost: int):
+        """Give back credits taken by `reserve_credits` when the paid action failed."""
+        await self.update_credits(telegram_id, cost)
+
+    async def get_credits(self, telegram_id):
         """
         Retrieve the number of credits for a user.
 
@@ -71,5 +139,146 @@ class DBManager:
         Returns:
             int: Number of credits the user has, or 0 if the user does not exist.
         """
-        user = self.get_user(telegram_id)
+        user = await self.users.find_one({"telegram_id": telegram_id}, {"_id": 0, "credits": 1})
         return user.get("credits", 0) if user else 0
+
+    async def ingest_deposits(self, telegram_id: int, wallet_address: str, transfers: list, credit_rate: float):
+        """
+        Record a batch of deposits and credit the user for the new ones.
+
+        Already-known hashRevs are filtered with one `$in` query, new ones are written
+        with one `insert_many`, and the credit increment is applied in the same
+        transaction, so a crash can neither lose nor double-count credits. The unique
+        index on hashRev makes a concurrent ingestion of the same transfer fail cleanly.
+
+        Args:
+            telegram_id (int): Telegram user ID to credit.
+            wallet_address (str): The wallet the transfers were sent to.
+            transfers (list): Dicts with "hashRev" and "amount".
+            credit_rate (float): KASPER per credit.
+
+        Returns:
+            dict: {"transactions": [...new transfers], "duplicates": int, "credits_added": int}
+        """
+        batch = {t["hashRev"]: t for t in transfers if t.get("hashRev")}
+        result = {"transactions": [], "duplicates": len(transfers) - len(batch), "credits_added": 0}
+        if not batch:
+            return result
+
+        for _ in range(3):
+            try:
+                if self.transactions_supported:
+                    async with await self.client.start_session() as session:
+                        # Retries on TransientTransactionError (e.g. a write conflict with a credit
+                        # reservation for the same user) and on UnknownTransactionCommitResult
+                        result = await session.with_transaction(
+                            partial(self._ingest, telegram_id, wallet_address, batch, credit_rate, result)
+                        )
+                else:
+                    result = await self._ingest(telegram_id, wallet_address, batch, credit_rate, result, None)
+                if result["credits_added"]:
+                    self._forget(telegram_id)
+                return result
+            except (BulkWriteError, DuplicateKeyError):
+                # Someone else stored one of these transfers first; re-read and try again
+                logger.warning(f"Concurrent deposit ingestion for {wallet_address}, retrying")
+            except OperationFailure as e:
+                if e.code != 20:  # IllegalOperation: transactions need a replica set
+                    raise
+                logger.warning("MongoDB transactions are not available; ingesting deposits without them")
+                self.transactions_supported = False
+        raise RuntimeError(f"Could not ingest deposits for {wallet_address}")
+
+    async def _ingest(self, telegram_id, wallet_address, batch, credit_rate, result, session):
+        existing = set(await self.transactions.distinct(
+            "hashRev", {"hashRev": {"$in": list(batch)}}, session=session
+        ))
+        new = [t for hash_rev, t in batch.items() if hash_rev not in existing]
+        result = dict(result, duplicates=result["duplicates"] + len(existing))
+        if not new:
+            return result
+
+        now = datetime.utcnow()
+        documents = [
+            {"hashRev": t["hashRev"], "amount": t["amount"], "walletAddress": wallet_address, "timestamp": now}
+            for t in new
+        ]
+        try:
+            await self.transactions.insert_many(documents, ordered=False, session=session)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            # Inside a transaction nothing was written, so the caller retries the whole batch
+            if session is not None or any(err.get("code") != 11000 for err in errors):
+                raise
+            # Without a transaction the other documents were stored and must be credited now
+            lost = {documents[err["index"]]["hashRev"] for err in errors}
+            new = [t for t in new if t["hashRev"] not in lost]
+            result["duplicates"] += len(lost)
+        credits_added = int(sum(t["amount"] for t in new) / credit_rate)
+        if credits_added:
+            await self.users.update_one(
+                {"telegram_id": telegram_id}, {"$inc": {"credits": credits_added, "version": 1}}, session=session
+            )
+        result.update(transactions=new, credits_added=credits_added)
+        return result
+
+    def iter_wallets(self, batch_size: int = 100, created_since: datetime = None):
+        """Async cursor over (telegram_id, wallet_address) documents for every user, or those created since."""
+        query = {"wallet_address": {"$ne": None}}
+        if created_since is not None:
+            query["created_at"] = {"$gte": created_since}
+        return self.users.find(
+            query,
+            {"_id": 0, "telegram_id": 1, "wallet_address": 1},
+            batch_size=batch_size,
+        )
+
+    async def get_deposit_checkpoint(self, wallet_address: str) -> dict:
+        """
+        Retrieve how far a wallet's KRC20 operations have been scanned.
+
+        Returns:
+            dict: {"last_op_score": int or None, "resume": dict or None}. `last_op_score`
+            is the highest opScore below which everything was scanned, None if the
+            wallet never was. `resume` is {"next", "upper"} while a walk down to it
+            is unfinished: the oplist cursor to continue from, and the opScore down
+            to which newer operations were already seen.
+        """
+        checkpoint = await self.deposit_checkpoints.find_one({"_id": wallet_address}, {"last_op_score": 1, "resume": 1})
+        checkpoint = checkpoint or {}
+        return {"last_op_score": checkpoint.get("last_op_score"), "resume": checkpoint.get("resume")}
+
+    async def save_deposit_checkpoint(self, wallet_address: str, last_op_score: int = None, resume: dict = None):
+        """Advance a wallet's checkpoint, never backwards, and record or clear its unfinished walk."""
+        update = {"$set": {"resume": resume, "updated_at": datetime.utcnow()}}
+        if last_op_score is not None:
+            update["$max"] = {"last_op_score": last_op_score}
+        await self.deposit_checkpoints.update_one({"_id": wallet_address}, update, upsert=True)
+
+    def start_user_watch(self):
+        """Follow the users change stream so writes from other bot processes reach the cache."""
+        if self.user_cache is not None and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch_users(), name="user-cache-watch")
+
+    async def _watch_users(self):
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+        while True:
+            try:
+                async with self.users.watch(pipeline, full_document="updateLookup") as stream:
+                    async for change in stream:
+                        user = change.get("fullDocument")
+                        if user:
+                            self.user_cache.refresh(user)
+                        elif change["operationType"] == "delete":
+                            # Deletes only carry the _id, so drop everything to be safe
+                            self.user_cache.clear()
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError as e:
+                logger.error(f"User change stream failed, restarting: {e}")
+                await asyncio.sleep(5)
+
+    def close(self):
+        if self._watch_task:
+            self._watch_task.cancel()
+        self.client.close()
@@ -0,0 +1,264 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+from metrics import registry, observe
+from rate_limiter import Busy, TTS_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+# Adapt voice notes to load; with 0 every reply waits for its voice note, as before
+DEGRADATION = os.getenv("DEGRADATION", "1") == "1"
+# Text-first replies (voice note sent later) once a TTS/transcode wait queue is this full
+# or voice notes take this many seconds, queueing included
+DEGRADE_DEFER_QUEUE = float(os.getenv("DEGRADE_DEFER_QUEUE", "0.25"))
+DEGRADE_DEFER_LATENCY = float(os.getenv("DEGRADE_DEFER_LATENCY", "6"))
+# Text-only replies (voice note skipped, partly refunded) past these
+DEGRADE_SKIP_QUEUE = float(os.getenv("DEGRADE_SKIP_QUEUE", "0.75"))
+DEGRADE_SKIP_LATENCY = float(os.getenv("DEGRADE_SKIP_LATENCY", "20"))
+# Seconds without load before voice notes go back inline, so the level does not flap
+DEGRADE_HOLD = float(os.getenv("DEGRADE_HOLD", "10"))
+# Seconds of voice note latencies the level is judged on
+DEGRADE_WINDOW = float(os.getenv("DEGRADE_WINDOW", "30"))
+# A deferred voice note not sent this many seconds after its text is skipped
+VOICE_DEADLINE = float(os.getenv("VOICE_DEADLINE", "30"))
+# Fraction of a reply's cost given back when its voice note is skipped, paid out in whole credits
+VOICE_SKIP_REFUND = float(os.getenv("VOICE_SKIP_REFUND", "0.5"))
+DEFERRED_VOICE_WORKERS = int(os.getenv("DEFERRED_VOICE_WORKERS", str(TTS_CONCURRENCY)))
+
+NORMAL = "normal"
+TEXT_FIRST = "text_first"
+TEXT_ONLY = "text_only"
+LEVELS = (NORMAL, TEXT_FIRST, TEXT_ONLY)
+
+REPLIES_BY_LEVEL = registry.counter(
+    "degradation_replies_total", "Text replies, by the degradation level they were answered at.", ("level",)
+)
+VOICE_NOTES = registry.counter(
+    "voice_notes_total", "Voice notes, by how they were delivered or why they were skipped.", ("outcome",)
+)
+
+
+class DeferredVoice:
+    __slots__ = ("deliver", "skip", "queued_at", "deadline")
+
+    def __init__(self, deliver, skip, queued_at: float, deadline: float):
+        self.deliver = deliver
+        self.skip = skip
+        self.queued_at = queued_at
+        self.deadline = deadline
+
+
+class DegradationController:
+    """
+    Keeps replies flowing when TTS or transcoding cannot keep up.
+
+    The level is chosen per reply from live load: how full the TTS and transcode
+    wait queues are, how long recent voice notes took (their queueing included),
+    and how long the deferred voice backlog would take to clear.
+      - normal: the voice note is made before the reply is sent, as always.
+      - text_first: the text goes out at once and the voice note is queued for
+        DEFERRED_VOICE_WORKERS to make and send when there is capacity, or to skip
+        once it is VOICE_DEADLINE seconds late.
+      - text_only: the voice note is skipped.
+    A skipped voice note refunds VOICE_SKIP_REFUND of the reply's cost, in whole
+    credits; the fraction left over is carried to the user's next skipped voice note.
+    Voice notes go back inline only after DEGRADE_HOLD seconds without load.
+    """
+
+    def __init__(
+        self,
+        gates: list,
+        enabled: bool = DEGRADATION,
+        defer_queue: float = DEGRADE_DEFER_QUEUE,
+        defer_latency: float = DEGRADE_DEFER_LATENCY,
+        skip_queue: float = DEGRADE_SKIP_QUEUE,
+        skip_latency: float = DEGRADE_SKIP_LATENCY,
+        hold: float = DEGRADE_HOLD,
+        window: float = DEGRADE_WINDOW,
+        deadline: float = VOICE_DEADLINE,
+        skip_refund: float = VOICE_SKIP_REFUND,
+        workers: int = DEFERRED_VOICE_WORKERS,
+    ):
+        self.gates = gates
+        self.enabled = enabled
+        self.defer_queue = defer_queue
+        self.defer_latency = defer_latency
+        self.skip_queue = skip_queue
+        self.skip_latency = skip_latency
+        self.hold = hold
+        self.window = window
+        self.deadline = deadline
+        self.skip_refund = skip_refund
+        self.workers = max(1, workers)
+        self._level = NORMAL
+        self._held_at = 0.0
+        self._latencies = deque()  # (monotonic time, seconds) of recent voice notes
+        self._queue = deque()
+        self._ready = asyncio.Event()
+        self._tasks = []
+        self._refund_remainders = {}  # user_id -> fraction of a credit owed, kept in memory only
+        self.active = 0
+        self.transitions = 0
+        self.replies = {level: 0 for level in LEVELS}
+        self.deferred = 0
+        self.delivered_late = 0
+        self.skipped = 0
+        self.refunded = 0
+
+    def level(self) -> str:
+        """The level to answer the next reply at; counts the reply towards it."""
+        level = self._update_level() if self.enabled else NORMAL
+        self.replies[level] += 1
+        REPLIES_BY_LEVEL.inc(level=level)
+        return level
+
+    def _update_level(self) -> str:
+        now = time.monotonic()
+        target = self._target(now)
+        if target != NORMAL:
+            self._held_at = now
+        elif now - self._held_at < self.hold:
+            return self._level
+        if target != self._level:
+            self.transitions += 1
+            log = logger.warning if LEVELS.index(target) > LEVELS.index(self._level) else logger.info
+            log(f"Reply degradation {self._level} -> {target} (queues {self.queue_pressure():.2f}, "
+                f"voice latency {self.voice_latency(now):.1f}s, {len(self._queue)} deferred)")
+            self._level = target
+        return target
+
+    def _target(self, now: float) -> str:
+        pressure = self.queue_pressure()
+        latency = self.voice_latency(now)
+        # Deferred voice notes that would only start after their deadline are not worth queueing
+        backlog_wait = len(self._queue) * latency / self.workers
+        if pressure >= self.skip_queue or latency >= self.skip_latency or backlog_wait >= self.deadline:
+            return TEXT_ONLY
+        if pressure >= self.defer_queue or latency >= self.defer_latency or self._queue:
+            return TEXT_FIRST
+        return NORMAL
+
+    def queue_pressure(self) -> float:
+        """How full the fullest gate's wait queue is, from 0 to 1."""
+        pressure = 0.0
+        for gate in self.gates:
+            if gate.max_waiting > 0:
+                pressure = max(pressure, gate.waiting / gate.max_waiting)
+        return pressure
+
+    def voice_latency(self, now: float = None) -> float:
+        """Mean seconds per voice note over the last `window` seconds, 0 if there were none."""
+        now = time.monotonic() if now is None else now
+        while self._latencies and now - self._latencies[0][0] > self.window:
+            self._latencies.popleft()
+        if not self._latencies:
+            return 0.0
+        return sum(seconds for _, seconds in self._latencies) / len(self._latencies)
+
+    def record_voice(self, seconds: float):
+        self._latencies.append((time.monotonic(), seconds))
+
+    def voice_refund(self, user_id: int, cost) -> int:
+        """Whole credits given back to `user_id` for a reply of `cost` whose voice note was skipped."""
+        if not self.enabled:
+            return 0
+        owed = self._refund_remainders.pop(user_id, 0.0) + cost * self.skip_refund
+        # The epsilon keeps float error from turning e.g. 0.3 + 0.7 into 0 credits
+        refund = int(owed + 1e-9)
+        if owed - refund > 1e-9:
+            self._refund_remainders[user_id] = owed - refund
+        self.refunded += refund
+        return refund
+
+    def skipped_voice(self, reason: str):
+        self.skipped += 1
+        VOICE_NOTES.inc(outcome=f"skipped_{reason}")
+
+    @property
+    def pending(self) -> int:
+        """Deferred voice notes queued or being made."""
+        return len(self._queue) + self.active
+
+    def defer(self, deliver, skip):
+        """
+        Queue a voice note to be made and sent when there is capacity.
+
+        Args:
+            deliver: Coroutine function that makes and sends the voice note.
+            skip: Coroutine function called with the reason if it is skipped instead.
+        """
+        now = time.monotonic()
+        self._queue.append(DeferredVoice(deliver, skip, now, now + self.deadline))
+        self.deferred += 1
+        self._ready.set()
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker(), name="deferred-voice") for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop the workers; voice notes still pending are skipped, with their refunds."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while self._queue:
+            await self._skip(self._queue.popleft(), "shutdown")
+
+    async def _worker(self):
+        while True:
+            while not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+            job = self._queue.popleft()
+            remaining = job.deadline - time.monotonic()
+            if remaining <= 0:
+                await self._skip(job, "deadline")
+                continue
+            self.active += 1
+            try:
+                await asyncio.wait_for(job.deliver(), remaining)
+            except asyncio.CancelledError:
+                await self._skip(job, "shutdown")
+                raise
+            except asyncio.TimeoutError:
+                await self._skip(job, "deadline")
+            except Busy:
+                await self._skip(job, "busy")
+            except Exception as e:
+                logger.error(f"Deferred voice note failed: {e}")
+                await self._skip(job, "error")
+            else:
+                self.delivered_late += 1
+                VOICE_NOTES.inc(outcome="deferred")
+                observe("voice_deferred", time.monotonic() - job.queued_at, "ok")
+            finally:
+                self.active -= 1
+
+    async def _skip(self, job: DeferredVoice, reason: str):
+        self.skipped_voice(reason)
+        observe("voice_deferred", time.monotonic() - job.queued_at, reason)
+        try:
+            await job.skip(reason)
+        except Exception as e:
+            logger.error(f"Could not settle skipped voice note: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "level": LEVELS.index(self._level),
+            "queue_pressure": self.queue_pressure(),
+            "voice_latency_seconds": self.voice_latency(),
+            "backlog": len(self._queue),
+            "active": self.active,
+            "transitions": self.transitions,
+            "replies": dict(self.replies),
+            "deferred": self.deferred,
+            "delivered_late": self.delivered_late,
+            "skipped": self.skipped,
+            "refunded_credits": self.refunded,
+        }
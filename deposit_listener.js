@@ -0,0 +1,154 @@
+// Deposit listener behind `node wasm_rpc.js listen`; bench/fake_listener.js drives it
+// with a stand-in RpcClient.
+//
+// Subscribes the RpcClient to UTXO changes of every watched address and to added
+// blocks, and reports to the Python side on stdout, one JSON object per line:
+//   {"ready": true, "pid": ...}                               once, at startup
+//   {"event": "connected", "url": ..., "watched": n}          after every (re)connect and resubscribe
+//   {"event": "disconnected"}
+//   {"event": "utxos", "addresses": [...]}                    new outputs paid to watched addresses
+//   {"event": "krc20", "addresses": [...], "transactionId": ..., "blockHash": ...}
+//                                                             KRC20 transfer reveals naming them
+// Watched addresses arrive on stdin as {"method": "watch", "params": {"addresses": [...]}}.
+const readline = require("readline");
+
+// Addresses per subscribeUtxosChanged call, to keep each request well below the message size limit
+const SUBSCRIBE_CHUNK = 1000;
+
+// A KRC20 operation is JSON pushed inside the reveal transaction's signature script
+const INSCRIPTION = /\{[^{}]*"p"\s*:\s*"krc-20"[^{}]*\}/gi;
+
+function send(message) {
+    process.stdout.write(JSON.stringify(message) + "\n");
+}
+
+// Recipients of `tick` transfers inscribed in a transaction's inputs
+function krc20Recipients(transaction, tick) {
+    const recipients = [];
+    for (const input of transaction.inputs || []) {
+        if (!input.signatureScript) {
+            continue;
+        }
+        const script = Buffer.from(input.signatureScript, "hex").toString("latin1");
+        for (const match of script.matchAll(INSCRIPTION)) {
+            let operation;
+            try {
+                operation = JSON.parse(match[0]);
+            } catch (err) {
+                continue;
+            }
+            if (
+                String(operation.op).toLowerCase() === "transfer" &&
+                String(operation.tick).toUpperCase() === tick &&
+                operation.to
+            ) {
+                recipients.push(operation.to);
+            }
+        }
+    }
+    return recipients;
+}
+
+function listen(rpc, { tick = "KASPER", connectOptions } = {}) {
+    const watched = new Set();
+    let connected = false;
+
+    async function subscribe(addresses) {
+        for (let i = 0; i < addresses.length; i += SUBSCRIBE_CHUNK) {
+            await rpc.subscribeUtxosChanged(addresses.slice(i, i + SUBSCRIBE_CHUNK));
+        }
+    }
+
+    // Fires on the first connect and after every reconnect. The node drops our
+    // subscriptions with the connection, so all of them are made again; anything
+    // announced while we were away is caught up by the Python side on "connected".
+    rpc.addEventListener("connect", async () => {
+        // Set first so addresses watched while resubscribing are subscribed directly
+        connected = true;
+        try {
+            await rpc.subscribeBlockAdded();
+            await subscribe([...watched]);
+        } catch (err) {
+            // Half-subscribed is worse than restarting; the supervisor respawns us
+            send({ event: "error", error: "Subscribe failed: " + err.message });
+            process.exit(1);
+        }
+        send({ event: "connected", url: rpc.url, watched: watched.size });
+    });
+
+    rpc.addEventListener("disconnect", () => {
+        connected = false;
+        send({ event: "disconnected" });
+    });
+
+    rpc.addEventListener("utxos-changed", (event) => {
+        const addresses = new Set();
+        for (const entry of event.data.added || []) {
+            const address = entry.address && entry.address.toString();
+            if (watched.has(address)) {
+                addresses.add(address);
+            }
+        }
+        if (addresses.size) {
+            send({ event: "utxos", addresses: [...addresses] });
+        }
+    });
+
+    rpc.addEventListener("block-added", (event) => {
+        const block = event.data.block;
+        for (const transaction of block.transactions || []) {
+            const addresses = krc20Recipients(transaction, tick).filter((address) => watched.has(address));
+            if (addresses.length) {
+                send({
+                    event: "krc20",
+                    addresses: [...new Set(addresses)],
+                    transactionId: transaction.verboseData && transaction.verboseData.transactionId,
+                    blockHash: block.header && block.header.hash,
+                });
+            }
+        }
+    });
+
+    const rl = readline.createInterface({ input: process.stdin, terminal: false });
+    rl.on("line", async (line) => {
+        if (!line.trim()) {
+            return;
+        }
+        let request;
+        try {
+            request = JSON.parse(line);
+        } catch (err) {
+            send({ event: "error", error: "Invalid JSON request: " + err.message });
+            return;
+        }
+        if (request.method !== "watch") {
+            send({ event: "error", error: "Unknown method: " + request.method });
+            return;
+        }
+        const added = ((request.params || {}).addresses || []).filter((address) => !watched.has(address));
+        added.forEach((address) => watched.add(address));
+        if (connected && added.length) {
+            try {
+                await subscribe(added);
+            } catch (err) {
+                send({ event: "error", error: "Subscribe failed: " + err.message });
+                process.exit(1);
+            }
+        }
+    });
+
+    // The parent closed our stdin, so nobody is left to report to
+    rl.on("close", async () => {
+        try {
+            await rpc.disconnect();
+        } finally {
+            process.exit(0);
+        }
+    });
+
+    send({ ready: true, pid: process.pid });
+    // The default connect strategy keeps retrying, and reconnects after a drop
+    return rpc.connect(connectOptions);
+}
+
+module.exports = { listen, krc20Recipients };
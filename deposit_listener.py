@@ -0,0 +1,214 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from metrics import observe
+from node_process import NodeProcess
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+# Push-based deposit detection through `node wasm_rpc.js listen`; turns periodic scans off unless
+# DEPOSIT_SCAN_INTERVAL is set
+DEPOSIT_LISTENER = os.getenv("DEPOSIT_LISTENER", "0") == "1"
+DEPOSIT_LISTENER_SCRIPT = os.getenv("DEPOSIT_LISTENER_SCRIPT", "wasm_rpc.js")
+# Pauses before each Kasplex check after an event, in seconds; the indexer trails the chain
+DEPOSIT_CONFIRM_DELAYS = [float(d) for d in os.getenv("DEPOSIT_CONFIRM_DELAYS", "1,2,4,8,15").split(",")]
+# Pause before the catch-up scan after a reconnect, so Kasplex has indexed what was missed
+DEPOSIT_CATCH_UP_DELAY = float(os.getenv("DEPOSIT_CATCH_UP_DELAY", "10"))
+# How often addresses of users created by other processes are added to the subscription
+DEPOSIT_WATCH_REFRESH = float(os.getenv("DEPOSIT_WATCH_REFRESH", "30"))
+DEPOSIT_WATCH_BATCH_SIZE = int(os.getenv("DEPOSIT_WATCH_BATCH_SIZE", "1000"))
+LISTENER_START_TIMEOUT = 15.0
+
+
+class DepositListener(NodeProcess):
+    """
+    Credits deposits within seconds of them reaching the chain, without polling every wallet.
+
+    A supervised `node wasm_rpc.js listen` process holds the RPC subscriptions for
+    every user address and reports UTXO changes and KRC20 transfer reveals to them.
+    Each reported address is then confirmed against Kasplex with the scanner's
+    `scan_wallet()`, retried on a short schedule while the indexer catches up. Events
+    are lost while the node connection is down, so every reconnect (and respawn)
+    triggers one catch-up `scan_all()` once the indexer has had time to see them.
+    """
+
+    def __init__(
+        self,
+        db_manager,
+        scanner,
+        enabled: bool = DEPOSIT_LISTENER,
+        script: str = DEPOSIT_LISTENER_SCRIPT,
+        confirm_delays: list = DEPOSIT_CONFIRM_DELAYS,
+        catch_up_delay: float = DEPOSIT_CATCH_UP_DELAY,
+        refresh_interval: float = DEPOSIT_WATCH_REFRESH,
+        batch_size: int = DEPOSIT_WATCH_BATCH_SIZE,
+    ):
+        super().__init__("Deposit listener", script, "listen", LISTENER_START_TIMEOUT)
+        self.db_manager = db_manager
+        self.scanner = scanner
+        self.enabled = enabled
+        self.confirm_delays = confirm_delays
+        self.catch_up_delay = catch_up_delay
+        self.refresh_interval = refresh_interval
+        self.batch_size = max(1, batch_size)
+        self._tasks = []
+        self._confirming = {}  # address -> monotonic time of its latest event
+        self._confirm_tasks = set()
+        self._catch_up_task = None
+        self._catch_up_again = False
+        self._synced_at = None
+        self._connections = 0
+        self.addresses_sent = 0
+        self.events = 0
+        self.confirmations = 0
+        self.credited_transactions = 0
+        self.reconnects = 0
+        self.catch_ups = 0
+
+    async def start(self):
+        if not self.enabled:
+            return
+        self._closing = False
+        self._tasks = [
+            asyncio.create_task(self.run(), name="deposit-listener"),
+            asyncio.create_task(self._refresh_loop(), name="deposit-listener-refresh"),
+        ]
+
+    async def stop(self):
+        await super().stop()
+        tasks = self._tasks + list(self._confirm_tasks) + ([self._catch_up_task] if self._catch_up_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def on_ready(self):
+        await self._watch_wallets()
+
+    async def _watch_wallets(self, created_since: datetime = None):
+        """Send every user address, or those created since `created_since`, to the listener."""
+        synced_at = datetime.utcnow()
+        batch = []
+        async for user in self.db_manager.iter_wallets(self.batch_size, created_since=created_since):
+            batch.append(user["wallet_address"])
+            if len(batch) >= self.batch_size:
+                await self.watch(batch)
+                batch = []
+        if batch:
+            await self.watch(batch)
+        self._synced_at = synced_at
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            if not self.running or self._synced_at is None:
+                continue
+            try:
+                # Overlap the previous sync a little, for clock skew between bot processes
+                await self._watch_wallets(created_since=self._synced_at - timedelta(seconds=10))
+            except Exception as e:
+                logger.warning(f"Could not refresh watched deposit addresses: {e}")
+
+    async def watch(self, addresses: list):
+        """Subscribe to deposits for these addresses; a no-op while the listener is down."""
+        if not addresses or not self.running:
+            return
+        try:
+            await self.send({"method": "watch", "params": {"addresses": addresses}})
+            self.addresses_sent += len(addresses)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            # The respawned listener is sent every address again
+            logger.warning(f"Deposit listener is gone: {e}")
+
+    def handle(self, message: dict):
+        event = message.get("event")
+        if event in ("utxos", "krc20"):
+            self.events += 1
+            for address in message.get("addresses", []):
+                self._schedule_confirm(address)
+        elif event == "connected":
+            logger.info(f"Deposit listener subscribed {message.get('watched')} addresses at {message.get('url')}")
+            self._connections += 1
+            # Periodic scans start with a full pass, so only later connections need a catch-up
+            if self._connections > 1 or self.scanner.interval <= 0:
+                self._schedule_catch_up()
+            if self._connections > 1:
+                self.reconnects += 1
+        elif event == "disconnected":
+            logger.warning("Deposit listener lost its node connection")
+        elif event == "error":
+            logger.error(f"Deposit listener error: {message.get('error')}")
+
+    def _schedule_confirm(self, address: str):
+        pending = address in self._confirming
+        self._confirming[address] = time.monotonic()
+        if not pending:
+            task = asyncio.create_task(self._confirm(address), name="deposit-confirm")
+            self._confirm_tasks.add(task)
+            task.add_done_callback(self._confirm_tasks.discard)
+
+    async def _confirm(self, address: str):
+        """Scan one address on the confirm schedule until a scan newer than its last event credits it."""
+        first_event = self._confirming[address]
+        outcome = "miss"
+        try:
+            user = await self.db_manager.get_user_by_address(address)
+            if not user:
+                logger.warning(f"Deposit event for unknown address {address}")
+                return
+            for delay in self.confirm_delays:
+                await asyncio.sleep(delay)
+                started = time.monotonic()
+                self.confirmations += 1
+                result = await self.scanner.scan_wallet(user["telegram_id"], address)
+                if result["transactions"]:
+                    self.credited_transactions += len(result["transactions"])
+                    outcome = "ok"
+                    # A later event may be for a transfer the indexer has not reached yet
+                    if started > self._confirming[address]:
+                        return
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except Exception as e:
+            outcome = "error"
+            logger.error(f"Could not confirm deposit to {address}: {e}")
+        finally:
+            self._confirming.pop(address, None)
+            observe("deposit_confirm", time.monotonic() - first_event, outcome)
+
+    def _schedule_catch_up(self):
+        if self._catch_up_task and not self._catch_up_task.done():
+            # Events may have been lost after the running pass went by their wallets
+            self._catch_up_again = True
+            return
+        self._catch_up_task = asyncio.create_task(self._catch_up(), name="deposit-catch-up")
+
+    async def _catch_up(self):
+        await asyncio.sleep(self.catch_up_delay)
+        self._catch_up_again = True
+        while self._catch_up_again:
+            self._catch_up_again = False
+            self.catch_ups += 1
+            try:
+                await self.scanner.scan_all()
+            except Exception as e:
+                logger.error(f"Deposit catch-up scan failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "running": int(self.running),
+            "addresses_sent": self.addresses_sent,
+            "events": self.events,
+            "confirmations": self.confirmations,
+            "credited_transactions": self.credited_transactions,
+            "reconnects": self.reconnects,
+            "restarts": self.restarts,
+            "catch_ups": self.catch_ups,
+        }
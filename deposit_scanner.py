@@ -0,0 +1,227 @@
+import os
+import asyncio
+import logging
+
+from metrics import stage
+from deposit_listener import DEPOSIT_LISTENER
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+# Seconds between full scans; off by default with the deposit listener, whose reconnects trigger catch-up scans
+DEPOSIT_SCAN_INTERVAL = float(os.getenv("DEPOSIT_SCAN_INTERVAL", "0" if DEPOSIT_LISTENER else "300"))
+DEPOSIT_SCAN_CONCURRENCY = int(os.getenv("DEPOSIT_SCAN_CONCURRENCY", "8"))
+DEPOSIT_SCAN_BATCH_SIZE = int(os.getenv("DEPOSIT_SCAN_BATCH_SIZE", "100"))
+# Safety cap on pages walked per wallet per scan (Kasplex returns up to 50 ops per page)
+DEPOSIT_SCAN_MAX_PAGES = int(os.getenv("DEPOSIT_SCAN_MAX_PAGES", "100"))
+KRC20_TICK = os.getenv("KRC20_TICK", "KASPER")
+KRC20_OPLIST_PATH = "/v1/krc20/oplist"
+
+
+class DepositScanner:
+    """
+    Finds KASPER transfers to user wallets and credits them.
+
+    Each wallet has a checkpoint holding the highest opScore already seen. Kasplex
+    returns operations newest first, so a scan walks pages through the `next` cursor
+    only until it reaches the checkpoint; a wallet without new transfers costs a
+    single request. A walk stopped by `max_pages` saves its cursor, and later scans
+    first catch up on what is newer still, then continue the walk from there.
+    `run()` scans every wallet periodically, `scan_wallet()` scans one on demand for
+    /endtopup.
+    """
+
+    def __init__(
+        self,
+        db_manager,
+        upstream,
+        credit_rate: float,
+        notify=None,
+        interval: float = DEPOSIT_SCAN_INTERVAL,
+        concurrency: int = DEPOSIT_SCAN_CONCURRENCY,
+        batch_size: int = DEPOSIT_SCAN_BATCH_SIZE,
+        max_pages: int = DEPOSIT_SCAN_MAX_PAGES,
+    ):
+        self.db_manager = db_manager
+        self.upstream = upstream
+        self.credit_rate = credit_rate
+        self.notify = notify
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pages = max_pages
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._locks = {}
+        self._task = None
+        self.scans = 0
+        self.pages = 0
+        self.credited_transactions = 0
+
+    async def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self.run(), name="deposit-scanner")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.scan_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Deposit scan failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def scan_all(self):
+        """Scan every user wallet, `batch_size` at a time within the concurrency budget."""
+        batch = []
+        async for user in self.db_manager.iter_wallets(self.batch_size):
+            batch.append(user)
+            if len(batch) >= self.batch_size:
+                await self._scan_batch(batch)
+                batch = []
+        if batch:
+            await self._scan_batch(batch)
+
+    async def _scan_batch(self, users):
+        results = await asyncio.gather(
+            *(self.scan_wallet(user["telegram_id"], user["wallet_address"]) for user in users),
+            return_exceptions=True,
+        )
+        for user, result in zip(users, results):
+            if isinstance(result, Exception):
+                logger.error(f"Deposit scan failed for wallet {user['wallet_address']}: {result}")
+
+    async def scan_wallet(self, telegram_id: int, wallet_address: str, notify: bool = True) -> dict:
+        """
+        Credit any transfers newer than the wallet's checkpoint.
+
+        Args:
+            notify: Tell the user through `self.notify` when something was credited;
+                off for callers that report the result themselves, like /endtopup.
+
+        Returns:
+            dict: {"transactions": [...], "credits_added": int}
+        """
+        lock = self._locks.setdefault(wallet_address, asyncio.Lock())
+        async with lock, self._semaphore, stage("deposit_scan"):
+            self.scans += 1
+            state = await self.db_manager.get_deposit_checkpoint(wallet_address)
+            operations, checkpoint, resume = await self._fetch_unseen_operations(wallet_address, state)
+
+            transfers = [t for t in (parse_transfer(tx, wallet_address) for tx in operations) if t]
+            ingested = await self.db_manager.ingest_deposits(telegram_id, wallet_address, transfers, self.credit_rate)
+            transactions, credits_added = ingested["transactions"], ingested["credits_added"]
+            if transactions:
+                self.credited_transactions += len(transactions)
+                logger.info(f"Credited {credits_added} credits to {telegram_id} from {len(transactions)} transfers")
+
+            if (checkpoint, resume) != (state["last_op_score"], state["resume"]):
+                await self.db_manager.save_deposit_checkpoint(wallet_address, checkpoint, resume)
+
+        result = {"transactions": transactions, "credits_added": credits_added}
+        if transactions and notify and self.notify:
+            try:
+                await self.notify(telegram_id, result)
+            except Exception as e:
+                logger.warning(f"Could not notify {telegram_id} about deposit: {e}")
+        return result
+
+    async def _fetch_unseen_operations(self, wallet_address: str, state: dict):
+        """
+        Fetch the operations not scanned yet, within `max_pages` requests.
+
+        Returns:
+            tuple: (operations, new checkpoint or None, resume state or None)
+        """
+        checkpoint, resume = state["last_op_score"], state["resume"]
+        # Newest first, down to where an unfinished walk already started
+        operations, newest, cursor, pages = await self._fetch_new_operations(
+            wallet_address, resume["upper"] if resume else checkpoint, None, self.max_pages
+        )
+        if newest is None:
+            newest = resume["upper"] if resume else checkpoint
+        upper = pending_floor(operations, newest)
+        if cursor is not None:
+            logger.warning(f"Stopped scanning {wallet_address} after {self.max_pages} pages; resuming from there next scan")
+            if resume:
+                # The older walk still has to finish; this one is repeated next scan
+                return operations, None, resume
+            return operations, None, {"next": cursor, "upper": upper}
+        if not resume:
+            return operations, upper, None
+
+        # At least one page, or a scan whose head walk used up the budget would never get further
+        older, _, cursor, _ = await self._fetch_new_operations(
+            wallet_address, checkpoint, resume["next"], max(1, self.max_pages - pages)
+        )
+        operations += older
+        upper = pending_floor(older, upper)
+        if cursor is not None:
+            logger.warning(f"Stopped scanning {wallet_address} after {self.max_pages} pages; resuming from there next scan")
+            return operations, None, {"next": cursor, "upper": upper}
+        # Everything down to the old checkpoint has been seen now
+        return operations, upper, None
+
+    async def _fetch_new_operations(self, wallet_address: str, stop, cursor, max_pages: int):
+        """
+        Walk oplist pages newest first from `cursor` until opScore `stop`.
+
+        Returns:
+            tuple: (operations, newest opScore, cursor to continue from or None once done, pages fetched)
+        """
+        operations = []
+        newest = None
+        for pages in range(1, max_pages + 1):
+            params = {"address": wallet_address, "tick": KRC20_TICK}
+            if cursor:
+                params["next"] = cursor
+            response = await self.upstream.request("kasplex", "GET", KRC20_OPLIST_PATH, params=params)
+            response.raise_for_status()
+            data = response.json()
+            self.pages += 1
+
+            if data.get("message") != "successful":
+                raise ValueError(f"Unexpected response: {data}")
+
+            page = data.get("result") or []
+            for tx in page:
+                op_score = int(tx.get("opScore") or 0)
+                if stop is not None and op_score <= stop:
+                    return operations, newest, None, pages
+                newest = op_score if newest is None else max(newest, op_score)
+                operations.append(tx)
+
+            cursor = data.get("next")
+            if not page or not cursor:
+                return operations, newest, None, pages
+        return operations, newest, cursor, max(0, max_pages)
+
+    def stats(self) -> dict:
+        return {"scans": self.scans, "pages": self.pages, "credited_transactions": self.credited_transactions}
+
+
+def pending_floor(operations: list, op_score):
+    """Lower `op_score` below any unconfirmed operation, so it is looked at again."""
+    pending = [int(tx.get("opScore") or 0) for tx in operations if tx.get("opAccept", "1") not in ("1", "-1")]
+    if pending and op_score is not None:
+        return min(op_score, min(pending) - 1)
+    return op_score
+
+
+def parse_transfer(tx: dict, wallet_address: str):
+    """Return {"hashRev", "amount"} for an accepted KASPER transfer to `wallet_address`, else None."""
+    op_type = (tx.get("op") or "").lower()
+    if op_type != "transfer" or tx.get("to") != wallet_address:
+        return None
+    # opAccept is "1" once the operation is confirmed; pending or rejected ops are skipped
+    if tx.get("opAccept", "1") != "1":
+        return None
+    amount = int(tx.get("amt", "0")) / 1e8  # Convert amount from sompi to KAS
+    return {"hashRev": tx.get("hashRev"), "amount": amount}
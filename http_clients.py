@@ -0,0 +1,202 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import importlib.util
+from contextlib import asynccontextmanager
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+# Base URLs can be pointed at local stand-in servers for testing
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com")
+ELEVEN_LABS_BASE_URL = os.getenv("ELEVEN_LABS_BASE_URL", "https://api.elevenlabs.io")
+KASPLEX_BASE_URL = os.getenv("KASPLEX_BASE_URL", "https://api.kasplex.org")
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "8"))
+# HTTP/2 needs the optional `h2` package (httpx[http2])
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1" and importlib.util.find_spec("h2") is not None
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+UPSTREAMS = {
+    "openai": OPENAI_BASE_URL,
+    "elevenlabs": ELEVEN_LABS_BASE_URL,
+    "kasplex": KASPLEX_BASE_URL,
+}
+
+
+class HostStats:
+    """Request counters for one upstream host."""
+
+    __slots__ = ("requests", "errors", "retries", "total_seconds")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "avg_seconds": self.total_seconds / self.requests if self.requests else 0.0,
+        }
+
+
+def backoff_delay(attempt: int, base: float = HTTP_BACKOFF_BASE, cap: float = HTTP_BACKOFF_MAX) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class UpstreamClients:
+    """
+    One pooled `httpx.AsyncClient` per upstream host, shared by every handler.
+
+    Clients are created on first use and closed together by `close()`, which the bot
+    calls from the Application's shutdown hook.
+    """
+
+    def __init__(
+        self,
+        base_urls: dict = None,
+        limits: httpx.Limits = None,
+        timeout: httpx.Timeout = None,
+        retries: int = HTTP_RETRIES,
+        http2: bool = HTTP2_ENABLED,
+    ):
+        self.base_urls = dict(UPSTREAMS, **(base_urls or {}))
+        self.limits = limits or httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+        self.timeout = timeout or httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        self.retries = retries
+        self.http2 = http2
+        self._clients = {}
+        self._stats = {}
+
+    def client(self, upstream: str) -> httpx.AsyncClient:
+        """Return the shared client for an upstream, creating it on first use."""
+        client = self._clients.get(upstream)
+        if client is None or client.is_closed:
+            if upstream not in self.base_urls:
+                raise KeyError(f"Unknown upstream: {upstream}")
+            client = httpx.AsyncClient(
+                base_url=self.base_urls[upstream],
+                limits=self.limits,
+                timeout=self.timeout,
+                http2=self.http2,
+            )
+            self._clients[upstream] = client
+            self._stats.setdefault(upstream, HostStats())
+        return client
+
+    async def request(
+        self,
+        upstream: str,
+        method: str,
+        path: str,
+        *,
+        retries: int = None,
+        **kwargs,
+    ) -> httpx.Response:
+        """
+        Send a request with retries on transport errors and retryable status codes.
+
+        The last response is returned as-is, so callers still decide when to `raise_for_status()`.
+        """
+        client = self.client(upstream)
+        stats = self._stats[upstream]
+        retries = self.retries if retries is None else retries
+
+        for attempt in range(retries + 1):
+            response = None
+            stats.requests += 1
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                stats.errors += 1
+                if attempt >= retries:
+                    raise
+                logger.warning(f"{upstream} {method} {path} failed ({e!r}), retrying (attempt {attempt + 1})")
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    return response
+                stats.errors += 1
+                if attempt >= retries:
+                    return response
+                logger.warning(f"{upstream} {method} {path} returned {response.status_code}, retrying (attempt {attempt + 1})")
+            finally:
+                stats.total_seconds += time.perf_counter() - started
+
+            stats.retries += 1
+            await asyncio.sleep(self._retry_delay(attempt, response))
+
+    @asynccontextmanager
+    async def stream(self, upstream: str, method: str, path: str, **kwargs):
+        """
+        Open a streaming response on the shared client.
+
+        Streams are not retried: once bytes have been handed to the caller the request
+        cannot be replayed transparently.
+        """
+        client = self.client(upstream)
+        stats = self._stats[upstream]
+        stats.requests += 1
+        started = time.perf_counter()
+        try:
+            async with client.stream(method, path, **kwargs) as response:
+                yield response
+        except RETRYABLE_ERRORS:
+            stats.errors += 1
+            raise
+        finally:
+            stats.total_seconds += time.perf_counter() - started
+
+    @staticmethod
+    def _retry_delay(attempt: int, response: httpx.Response = None) -> float:
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), HTTP_BACKOFF_MAX)
+            except ValueError:
+                pass
+        return backoff_delay(attempt)
+
+    def stats(self) -> dict:
+        """Per-host request counters plus the number of pooled connections."""
+        result = {}
+        for upstream, stats in self._stats.items():
+            entry = stats.as_dict()
+            entry["connections"] = self._pool_size(self._clients.get(upstream))
+            result[upstream] = entry
+        return result
+
+    @staticmethod
+    def _pool_size(client: httpx.AsyncClient) -> int:
+        # httpx does not expose its pool publicly, so read it defensively
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        return len(getattr(pool, "connections", ()) or ())
+
+    async def close(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
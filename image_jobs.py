@@ -0,0 +1,308 @@
+import os
+import uuid
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timedelta
+
+import httpx
+from bson import Binary
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from http_clients import backoff_delay, RETRYABLE_STATUS_CODES
+from metrics import stage, observe, outcome_for
+from rate_limiter import Busy
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "4"))
+IMAGE_QUEUE_MAX = int(os.getenv("IMAGE_QUEUE_MAX", "100"))
+IMAGE_JOB_ATTEMPTS = int(os.getenv("IMAGE_JOB_ATTEMPTS", "3"))
+# A running job whose lease expires (e.g. the process died) is picked up again; a live
+# worker renews its lease every third of this, however long the generation takes
+IMAGE_JOB_LEASE = float(os.getenv("IMAGE_JOB_LEASE", "300"))
+IMAGE_JOB_BACKOFF_BASE = float(os.getenv("IMAGE_JOB_BACKOFF_BASE", "5"))
+IMAGE_JOB_BACKOFF_MAX = float(os.getenv("IMAGE_JOB_BACKOFF_MAX", "120"))
+IMAGE_JOB_POLL_INTERVAL = float(os.getenv("IMAGE_JOB_POLL_INTERVAL", "5"))
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", str(7 * 24 * 3600)))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(" ".join(prompt.lower().split()).encode("utf-8")).hexdigest()
+
+
+def is_permanent(error: Exception) -> bool:
+    """Client errors such as a content policy rejection will fail the same way again."""
+    return isinstance(error, httpx.HTTPStatusError) and error.response.status_code not in RETRYABLE_STATUS_CODES
+
+
+class ImageJobQueue:
+    """
+    Persistent queue of /generateimage jobs with its own worker pool.
+
+    Jobs live in the `image_jobs` collection, so a restart picks up queued work and
+    re-runs jobs whose lease expired mid-flight. Credits are reserved by the caller
+    before `enqueue()` and refunded here if the job finally fails.
+
+    Images are cached by prompt hash in `image_cache`, first as PNG bytes and then as
+    the Telegram file_id once delivered, so a repeated prompt is never generated
+    twice. Identical prompts running at the same time share a single generation.
+
+    `generate(prompt) -> bytes`, `deliver(job, photo) -> file_id` and `fail(job)` are
+    supplied by the bot; `deliver` gets either the bytes or a cached file_id.
+    """
+
+    def __init__(
+        self,
+        db_manager,
+        generate,
+        deliver=None,
+        fail=None,
+        cost: int = 0,
+        workers: int = IMAGE_WORKERS,
+        max_queued: int = IMAGE_QUEUE_MAX,
+        max_attempts: int = IMAGE_JOB_ATTEMPTS,
+        lease: float = IMAGE_JOB_LEASE,
+    ):
+        self.db_manager = db_manager
+        self.jobs = db_manager.db["image_jobs"]
+        self.cache = db_manager.db["image_cache"]
+        self.generate = generate
+        self.deliver = deliver
+        self.fail = fail
+        self.cost = cost
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._generating = {}
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+
+    async def ensure_indexes(self):
+        try:
+            await self.jobs.create_index([("status", 1), ("next_attempt_at", 1)])
+            await self.cache.create_index("created_at", expireAfterSeconds=IMAGE_CACHE_TTL)
+        except PyMongoError as e:
+            logger.error(f"Could not create image job indexes: {e}")
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._work(), name=f"image-worker-{i}") for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def enqueue(self, telegram_id: int, chat_id: int, prompt: str, caption: str, progress_message_id: int = None):
+        """
+        Persist a job and wake a worker.
+
+        Raises:
+            Busy: if too many jobs are already waiting.
+        """
+        waiting = await self.jobs.count_documents({"status": {"$in": [QUEUED, RUNNING]}}, limit=self.max_queued)
+        if waiting >= self.max_queued:
+            raise Busy(f"{waiting} image jobs already queued")
+
+        now = datetime.utcnow()
+        job = {
+            "telegram_id": telegram_id,
+            "chat_id": chat_id,
+            "prompt": prompt,
+            "prompt_hash": prompt_hash(prompt),
+            "caption": caption,
+            "progress_message_id": progress_message_id,
+            "cost": self.cost,
+            "status": QUEUED,
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+        }
+        result = await self.jobs.insert_one(job)
+        job["_id"] = result.inserted_id
+        self._wakeup.set()
+        return job
+
+    async def _work(self):
+        while True:
+            try:
+                job = await self._claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Could not claim image job: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=IMAGE_JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Image job {job['_id']} crashed: {e}")
+
+    async def _claim(self):
+        """Lease the oldest due job, including running ones whose lease has run out."""
+        now = datetime.utcnow()
+        return await self.jobs.find_one_and_update(
+            {
+                "$or": [
+                    {"status": QUEUED, "next_attempt_at": {"$lte": now}},
+                    {"status": RUNNING, "lease_until": {"$lt": now}},
+                ]
+            },
+            {
+                "$set": {
+                    "status": RUNNING,
+                    "lease_id": uuid.uuid4().hex,
+                    "lease_until": now + timedelta(seconds=self.lease),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _run(self, job: dict):
+        if job["attempts"] == 1:
+            observe("image_queue_wait", (datetime.utcnow() - job["created_at"]).total_seconds())
+        if job["attempts"] > self.max_attempts:
+            # Reclaimed after its lease ran out once too often: it keeps killing or hanging its worker
+            await self._retry_or_fail(job, RuntimeError("too many interrupted attempts"))
+            return
+        heartbeat = asyncio.create_task(self._renew_lease(job), name="image-job-lease")
+        with stage("image_job") as timing:
+            try:
+                photo, cached_file_id = await self._image_for(job)
+                file_id = await self.deliver(job, photo) if self.deliver else None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                timing.outcome = outcome_for(e)
+                await self._retry_or_fail(job, e)
+                return
+            finally:
+                heartbeat.cancel()
+                await asyncio.gather(heartbeat, return_exceptions=True)
+
+        if file_id and not cached_file_id:
+            try:
+                await self.cache.update_one({"_id": job["prompt_hash"]}, {"$set": {"file_id": file_id}})
+            except PyMongoError as e:
+                logger.warning(f"Could not cache image file_id: {e}")
+        if await self._finish(job, DONE):
+            self.completed += 1
+
+    async def _renew_lease(self, job: dict):
+        """Extend the job's lease while it runs, so another worker does not run it too."""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                result = await self.jobs.update_one(
+                    {"_id": job["_id"], "lease_id": job["lease_id"]},
+                    {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=self.lease)}},
+                )
+            except PyMongoError as e:
+                logger.warning(f"Could not renew the lease of image job {job['_id']}: {e}")
+                continue
+            if result.matched_count == 0:
+                logger.warning(f"Image job {job['_id']} lost its lease to another worker")
+                return
+
+    async def _image_for(self, job: dict):
+        """Return (photo, cached file_id); photo is a cached file_id or freshly generated bytes."""
+        key = job["prompt_hash"]
+        cached = await self.cache.find_one({"_id": key})
+        if cached and cached.get("file_id"):
+            self.cache_hits += 1
+            return cached["file_id"], cached["file_id"]
+        if cached and cached.get("image"):
+            self.cache_hits += 1
+            return bytes(cached["image"]), None
+
+        task = self._generating.get(key)
+        if task is None:
+            task = asyncio.create_task(self._generate(key, job["prompt"]))
+            self._generating[key] = task
+            task.add_done_callback(lambda _: self._generating.pop(key, None))
+        else:
+            self.coalesced += 1
+        # Shielded so one job being cancelled doesn't cancel the others waiting on it
+        return await asyncio.shield(task), None
+
+    async def _generate(self, key: str, prompt: str) -> bytes:
+        image = await self.generate(prompt)
+        try:
+            await self.cache.replace_one(
+                {"_id": key},
+                {"image": Binary(image), "created_at": datetime.utcnow()},
+                upsert=True,
+            )
+        except PyMongoError as e:
+            logger.warning(f"Could not cache generated image: {e}")
+        return image
+
+    async def _retry_or_fail(self, job: dict, error: Exception):
+        if job["attempts"] < self.max_attempts and not is_permanent(error):
+            delay = backoff_delay(job["attempts"] - 1, IMAGE_JOB_BACKOFF_BASE, IMAGE_JOB_BACKOFF_MAX)
+            logger.warning(f"Image job {job['_id']} attempt {job['attempts']} failed ({error!r}), retrying in {delay:.1f}s")
+            self.retried += 1
+            await self.jobs.update_one(
+                {"_id": job["_id"], "lease_id": job["lease_id"]},
+                {"$set": {
+                    "status": QUEUED,
+                    "next_attempt_at": datetime.utcnow() + timedelta(seconds=delay),
+                    "error": repr(error),
+                }},
+            )
+            return
+
+        logger.error(f"Image job {job['_id']} failed after {job['attempts']} attempts: {error!r}")
+        # Only the worker that still holds the lease refunds, so credits go back once
+        if not await self._finish(job, FAILED, repr(error)):
+            return
+        self.failed += 1
+        await self.db_manager.refund_credits(job["telegram_id"], job["cost"])
+        if self.fail:
+            try:
+                await self.fail(job)
+            except Exception as e:
+                logger.warning(f"Could not report failed image job to {job['telegram_id']}: {e}")
+
+    async def _finish(self, job: dict, status: str, error: str = None) -> bool:
+        update = {"status": status, "finished_at": datetime.utcnow()}
+        if error:
+            update["error"] = error
+        result = await self.jobs.update_one({"_id": job["_id"], "lease_id": job["lease_id"]}, {"$set": update})
+        return result.modified_count == 1
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "generating": len(self._generating),
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "coalesced": self.coalesced,
+            "cache_hits": self.cache_hits,
+        }
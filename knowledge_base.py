@@ -0,0 +1,210 @@
+import os
+import re
+import hashlib
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+KNOWLEDGE_DIR = os.getenv("KNOWLEDGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge"))
+KNOWLEDGE_CORPUS = os.getenv("KNOWLEDGE_CORPUS", os.path.join(KNOWLEDGE_DIR, "kasper.md"))
+KNOWLEDGE_PERSONA = os.getenv("KNOWLEDGE_PERSONA", os.path.join(KNOWLEDGE_DIR, "persona.txt"))
+KNOWLEDGE_INDEX = os.getenv("KNOWLEDGE_INDEX", os.path.join(KNOWLEDGE_DIR, "index.npz"))
+# Approximate tokens of retrieved knowledge per request, on top of the persona header
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "600"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+# Sections sent with every request regardless of the question
+ALWAYS_INCLUDE = ("Core facts",)
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Part of the index key; bump it whenever tokenize() or the weighting changes
+INDEX_FORMAT = "bm25-1"
+
+_WORD = re.compile(r"\w+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it its me my of on or "
+    "our so that the their there this to u ur was we what when where which who why will "
+    "with you your".split()
+)
+
+
+def stem(word: str) -> str:
+    """Crude suffix stripping so "founded", "founder" and "founders" share a term."""
+    for suffix in ("ing", "ers", "ed", "er", "es", "s"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[: -len(suffix)]
+    return word
+
+
+def tokenize(text: str) -> list:
+    return [stem(w) for w in _WORD.findall(text.lower()) if w not in _STOPWORDS]
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), good enough for budgeting."""
+    return len(text) // 4 + 1
+
+
+def parse_corpus(text: str) -> list:
+    """
+    Split the corpus into (section, paragraph) chunks.
+
+    "## " lines start a section, blank lines separate paragraphs and "#" lines
+    outside a section are comments.
+    """
+    chunks = []
+    section = None
+    paragraph = []
+
+    def flush():
+        if section and paragraph:
+            chunks.append((section, " ".join(paragraph)))
+        paragraph.clear()
+
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("## "):
+            flush()
+            section = line[3:].strip()
+        elif not line or (line.startswith("#") and section is None):
+            flush()
+        else:
+            paragraph.append(line)
+    flush()
+    return chunks
+
+
+class KnowledgeBase:
+    """
+    BM25 index over the chunked Kasper corpus.
+
+    The chunk-by-term weight matrix is computed once and saved next to the corpus
+    together with a hash of the corpus text; later startups load it as long as the
+    corpus is unchanged. A query scores every chunk with one column sum.
+    """
+
+    def __init__(self, chunks: list, persona: str, vocabulary: list, weights: np.ndarray):
+        self.chunks = chunks
+        self.persona = persona
+        self.vocabulary = {term: i for i, term in enumerate(vocabulary)}
+        self.weights = weights
+        self.searches = 0
+        self.context_tokens = 0
+
+    @classmethod
+    def load(cls, corpus_path: str = KNOWLEDGE_CORPUS, persona_path: str = KNOWLEDGE_PERSONA,
+             index_path: str = KNOWLEDGE_INDEX):
+        with open(corpus_path, encoding="utf-8") as f:
+            corpus = f.read()
+        with open(persona_path, encoding="utf-8") as f:
+            persona = f.read().strip()
+        chunks = parse_corpus(corpus)
+        corpus_hash = hashlib.sha256(f"{INDEX_FORMAT}\n{corpus}".encode("utf-8")).hexdigest()
+
+        try:
+            with np.load(index_path) as index:
+                if str(index["corpus_hash"]) == corpus_hash:
+                    return cls(chunks, persona, index["vocabulary"].tolist(), index["weights"])
+            logger.info("Knowledge index is stale; rebuilding.")
+        except FileNotFoundError:
+            logger.info("No knowledge index found; building one.")
+        except Exception as e:
+            logger.warning(f"Could not read knowledge index {index_path}: {e}")
+
+        vocabulary, weights = build_index(chunks)
+        try:
+            np.savez(index_path, corpus_hash=np.array(corpus_hash), vocabulary=np.array(vocabulary), weights=weights)
+        except OSError as e:
+            logger.warning(f"Could not save knowledge index {index_path}: {e}")
+        return cls(chunks, persona, vocabulary, weights)
+
+    def search(self, query: str, k: int = RETRIEVAL_TOP_K) -> list:
+        """
+        Rank chunks against the query.
+
+        Returns:
+            list: Up to `k` (chunk index, score) pairs with a positive score, best first.
+        """
+        columns = [self.vocabulary[t] for t in set(tokenize(query)) if t in self.vocabulary]
+        if not columns or k <= 0:
+            return []
+        scores = self.weights[:, columns].sum(axis=1)
+        top = np.argsort(-scores, kind="stable")[:k]
+        return [(int(i), float(scores[i])) for i in top if scores[i] > 0]
+
+    def build_context(self, query: str, token_budget: int = PROMPT_TOKEN_BUDGET, k: int = RETRIEVAL_TOP_K) -> str:
+        """The always-included sections plus the best matching chunks that fit the budget."""
+        self.searches += 1
+        selected = [i for i, (section, _) in enumerate(self.chunks) if section in ALWAYS_INCLUDE]
+        used = sum(estimate_tokens(self.chunks[i][1]) for i in selected)
+        for i, _ in self.search(query, k):
+            if i in selected:
+                continue
+            cost = estimate_tokens(self.chunks[i][1])
+            if used + cost > token_budget:
+                continue
+            selected.append(i)
+            used += cost
+        self.context_tokens += used
+        # Corpus order keeps related chunks of a section together
+        return format_chunks(self.chunks[i] for i in sorted(selected))
+
+    def full_context(self) -> str:
+        """Every chunk, i.e. what was sent before retrieval."""
+        return format_chunks(self.chunks)
+
+    def system_prompt(self, query: str, retrieval: bool = True, token_budget: int = PROMPT_TOKEN_BUDGET,
+                      k: int = RETRIEVAL_TOP_K) -> str:
+        context = self.build_context(query, token_budget, k) if retrieval else self.full_context()
+        return f"{self.persona}\n\nKasper facts (use them when relevant):\n{context}"
+
+    def stats(self) -> dict:
+        return {
+            "chunks": len(self.chunks),
+            "terms": len(self.vocabulary),
+            "searches": self.searches,
+            "avg_context_tokens": self.context_tokens / self.searches if self.searches else 0.0,
+        }
+
+
+def format_chunks(chunks) -> str:
+    lines = []
+    current = None
+    for section, text in chunks:
+        if section != current:
+            lines.append(f"[{section}]")
+            current = section
+        lines.append(text)
+    return "\n".join(lines)
+
+
+def build_index(chunks: list):
+    """
+    Compute BM25 weights for every (chunk, term) pair.
+
+    Returns:
+        tuple: (vocabulary list, float32 matrix of shape (len(chunks), len(vocabulary)))
+    """
+    # The section title is part of the chunk so "roadmap" finds every roadmap item
+    documents = [tokenize(f"{section} {text}") for section, text in chunks]
+    vocabulary = sorted({term for doc in documents for term in doc})
+    columns = {term: i for i, term in enumerate(vocabulary)}
+
+    tf = np.zeros((len(documents), len(vocabulary)), dtype=np.float32)
+    for row, doc in enumerate(documents):
+        for term in doc:
+            tf[row, columns[term]] += 1
+
+    lengths = tf.sum(axis=1, keepdims=True)
+    avg_length = float(lengths.mean()) if len(documents) else 0.0
+    df = (tf > 0).sum(axis=0)
+    idf = np.log(1 + (len(documents) - df + 0.5) / (df + 0.5)).astype(np.float32)
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(avg_length, 1.0))
+    weights = idf * tf * (BM25_K1 + 1) / (tf + norm)
+    return vocabulary, weights.astype(np.float32)
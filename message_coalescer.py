@@ -0,0 +1,148 @@
+import os
+import asyncio
+import logging
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+# Text messages a user sends within this many seconds of each other get one reply; 0 disables merging
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "0"))
+# Longest a first message waits for others, however quickly they keep coming
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", "4"))
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", "5"))
+# "message" charges every merged message as if answered alone, "reply" charges once per reply
+COALESCE_CHARGE = os.getenv("COALESCE_CHARGE", "message")
+CHARGE_POLICIES = ("message", "reply")
+
+# The batch the current task answers; set by collect() for the message that leads it
+_current_batch = contextvars.ContextVar("coalesced_batch", default=None)
+
+
+class Batch:
+    __slots__ = ("leader", "texts", "deadline", "cap", "closed", "wake", "released")
+
+    def __init__(self, leader, text: str, now: float, window: float, max_wait: float):
+        self.leader = leader
+        self.texts = [text]
+        self.cap = now + max(window, max_wait)
+        self.deadline = min(now + window, self.cap)
+        self.closed = False
+        self.wake = asyncio.Event()
+        self.released = asyncio.Event()
+
+    def close(self):
+        self.closed = True
+        self.wake.set()
+
+
+class MessageCoalescer:
+    """
+    Merges a user's burst of text messages into one prompt and one reply.
+
+    The first message of a burst leads it: it waits until COALESCE_WINDOW seconds
+    pass without another message (at most COALESCE_MAX_WAIT in total), and every
+    message arriving meanwhile joins its batch and is answered by it. Collecting
+    happens before the user's dispatcher lock is taken, or the later messages could
+    not arrive; any other update from the user closes the open batch first, so the
+    merged reply still comes before whatever was sent after it.
+    """
+
+    def __init__(
+        self,
+        window: float = COALESCE_WINDOW,
+        max_wait: float = COALESCE_MAX_WAIT,
+        max_messages: int = COALESCE_MAX_MESSAGES,
+        charge: str = COALESCE_CHARGE,
+    ):
+        if charge not in CHARGE_POLICIES:
+            raise ValueError(f"COALESCE_CHARGE must be one of {CHARGE_POLICIES}, not {charge!r}")
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max(1, max_messages)
+        self.charge = charge
+        self._open = {}  # serialization key -> Batch
+        self.replies = 0
+        self.merged_replies = 0
+        self.merged_messages = 0
+        self.flushes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    async def collect(self, key, update):
+        """
+        Add a text message to its user's open batch, or open one and wait for the burst to end.
+
+        Returns:
+            The update to answer, or None if `update` joined an earlier message's batch.
+        """
+        loop = asyncio.get_running_loop()
+        text = update.message.text if update.message else None
+        if not text:
+            return update
+        while key in self._open:
+            batch = self._open[key]
+            if not batch.closed:
+                batch.texts.append(text)
+                self.merged_messages += 1
+                if len(batch.texts) >= self.max_messages:
+                    batch.close()
+                else:
+                    batch.deadline = min(loop.time() + self.window, batch.cap)
+                    batch.wake.set()
+                return None
+            # A full batch is on its way to the lock; this message starts the next one behind it
+            await batch.released.wait()
+
+        batch = self._open[key] = Batch(update, text, loop.time(), self.window, self.max_wait)
+        try:
+            while not batch.closed and loop.time() < batch.deadline:
+                batch.wake.clear()
+                try:
+                    await asyncio.wait_for(batch.wake.wait(), batch.deadline - loop.time())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            del self._open[key]
+            # The caller takes the user's lock right after this, before a flushing update can
+            batch.released.set()
+
+        self.replies += 1
+        if len(batch.texts) > 1:
+            self.merged_replies += 1
+        _current_batch.set(batch)
+        return update
+
+    async def flush(self, key):
+        """Stop collecting for `key` and wait until its batch has been handed on."""
+        batch = self._open.get(key)
+        if batch is None:
+            return
+        if not batch.closed:
+            self.flushes += 1
+            batch.close()
+        await batch.released.wait()
+
+    def texts(self, update) -> list:
+        """Every text `update` answers, its own first; just its own when nothing was merged."""
+        batch = _current_batch.get()
+        if batch is not None and batch.leader is update:
+            return batch.texts
+        return [update.message.text]
+
+    def cost(self, messages: int, unit_cost: int) -> int:
+        """Credits for one reply to `messages` merged messages, under the charging policy."""
+        return unit_cost * messages if self.charge == "message" else unit_cost
+
+    def stats(self) -> dict:
+        return {
+            "open": len(self._open),
+            "replies": self.replies,
+            "merged_replies": self.merged_replies,
+            "merged_messages": self.merged_messages,
+            "flushes": self.flushes,
+        }
@@ -0,0 +1,430 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import Counter as Tally
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qs
+
+import httpx
+from pymongo import monitoring
+
+from rate_limiter import Busy
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+# Port for the Prometheus text endpoint; 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+# Also serve /debug/profile and /debug/trace on the metrics port
+METRICS_DEBUG = os.getenv("METRICS_DEBUG", "0") == "1"
+# Fraction of text messages that log their stage breakdown; can be changed at runtime via /debug/trace
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# Seconds between stack samples while the profiler runs
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = 120.0
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                labels = dict(zip(self.labelnames, key))
+                for bound, count in zip(self.buckets, series):
+                    bucket_labels = _format_labels({**labels, "le": _format_value(bound)})
+                    lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {series[-2]!r}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    """
+    Counters and histograms recorded by the bot, plus collectors that turn the
+    components' existing `stats()` dicts into gauges at scrape time.
+    """
+
+    def __init__(self, namespace: str = "kasper"):
+        self.namespace = namespace
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name: str, help: str, labelnames=()) -> Counter:
+        metric = Counter(f"{self.namespace}_{name}", help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(f"{self.namespace}_{name}", help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, name: str, stats, label: str = "key"):
+        """
+        Export `stats()` as gauges named <namespace>_<name>_<field>.
+
+        A dict whose values are all dicts becomes a label: the top level uses `label`,
+        nested ones the field name without its plural "s" (gates -> gate).
+        """
+        self._collectors.append((name, stats, label))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, stats, label in self._collectors:
+            try:
+                samples = {}
+                for metric, labels, value in _flatten(f"{self.namespace}_{name}", stats(), {}, label):
+                    samples.setdefault(metric, []).append((labels, value))
+            except Exception as e:
+                logger.warning(f"Metrics collector {name} failed: {e}")
+                continue
+            for metric, values in samples.items():
+                lines.append(f"# TYPE {metric} gauge")
+                lines.extend(f"{metric}{_format_labels(labels)} {_format_value(value)}" for labels, value in values)
+        return "\n".join(lines) + "\n"
+
+
+def _flatten(name: str, value, labels: dict, label: str):
+    if isinstance(value, bool):
+        yield name, labels, int(value)
+    elif isinstance(value, (int, float)):
+        yield name, labels, value
+    elif isinstance(value, dict):
+        if value and all(isinstance(item, dict) for item in value.values()):
+            for key, item in value.items():
+                yield from _flatten(name, item, {**labels, label: key}, label)
+            return
+        for key, item in value.items():
+            yield from _flatten(f"{name}_{key}", item, labels, key[:-1] if key.endswith("s") else key)
+
+
+#######################################
+# Stage Timings
+#######################################
+registry = Registry()
+STAGE_SECONDS = registry.histogram(
+    "stage_seconds", "Time spent in each stage of handling a request.", ("stage", "outcome"),
+)
+MONGO_COMMAND_SECONDS = registry.histogram(
+    "mongo_command_seconds", "Round trip of each MongoDB command.", ("command", "outcome"),
+)
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+def outcome_for(error: BaseException = None) -> str:
+    """The `outcome` label for a stage that ended with `error` (None when it succeeded)."""
+    if error is None:
+        return "ok"
+    if isinstance(error, asyncio.CancelledError):
+        return "cancelled"
+    if isinstance(error, Busy):
+        return "busy"
+    if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException)):
+        return "timeout"
+    return "error"
+
+
+class Stage:
+    """
+    Times a `with` (or `async with`) block into kasper_stage_seconds and the current
+    trace. The outcome comes from the exception leaving the block; code that swallows
+    its errors sets `outcome` itself.
+    """
+
+    __slots__ = ("name", "outcome", "started")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.outcome = None
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        outcome = self.outcome or outcome_for(exc)
+        STAGE_SECONDS.observe(elapsed, stage=self.name, outcome=outcome)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.stages.append((self.name, elapsed, outcome))
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+def stage(name: str) -> Stage:
+    return Stage(name)
+
+
+def observe(name: str, seconds: float, outcome: str = "ok"):
+    """Record a duration measured elsewhere, e.g. time spent waiting in a queue."""
+    STAGE_SECONDS.observe(seconds, stage=name, outcome=outcome)
+
+
+class Trace:
+    __slots__ = ("name", "fields", "started", "stages")
+
+    def __init__(self, name: str, fields: dict):
+        self.name = name
+        self.fields = fields
+        self.started = time.perf_counter()
+        self.stages = []
+
+    def summary(self) -> str:
+        total = (time.perf_counter() - self.started) * 1000
+        fields = " ".join(f"{key}={value}" for key, value in self.fields.items())
+        stages = ", ".join(f"{name}={seconds * 1000:.0f}ms {outcome}" for name, seconds, outcome in self.stages)
+        return f"Trace {self.name} {fields} total={total:.0f}ms: {stages or 'no stages'}"
+
+
+@contextmanager
+def trace(name: str, **fields):
+    """Log the stage breakdown of the enclosed request for TRACE_SAMPLE_RATE of calls."""
+    if not TRACE_SAMPLE_RATE or random.random() >= TRACE_SAMPLE_RATE:
+        yield None
+        return
+    current = Trace(name, fields)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+        logger.info(current.summary())
+
+
+def set_trace_sample_rate(rate: float):
+    global TRACE_SAMPLE_RATE
+    TRACE_SAMPLE_RATE = min(max(rate, 0.0), 1.0)
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Feeds every driver command into kasper_mongo_command_seconds; runs on driver threads."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name, outcome="ok")
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name, outcome="error")
+
+
+def instrument_mongo():
+    """Register the command timer; only clients created afterwards are instrumented."""
+    monitoring.register(MongoCommandTimer())
+
+
+#######################################
+# Sampling Profiler
+#######################################
+class SamplingProfiler:
+    """
+    Samples one thread's Python stack every `interval` seconds from a helper thread.
+
+    Pointed at the event loop thread it shows where the loop spends its CPU time
+    (handlers, JSON, BM25 scoring) without the overhead of a tracing profiler. The
+    result is in collapsed-stack format, ready for flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = Tally()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, thread_id: int = None):
+        if self.running:
+            raise RuntimeError("Profiler is already running")
+        target = thread_id or threading.get_ident()
+        self.samples = Tally()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, args=(target,), name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def _sample(self, target: int):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    async def profile(self, seconds: float) -> str:
+        """Profile the calling event loop for `seconds` and return the collapsed stacks."""
+        self.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            result = self.stop()
+        return result
+
+
+#######################################
+# HTTP Endpoint
+#######################################
+class MetricsServer:
+    """
+    Minimal HTTP/1.0 server on the bot's event loop.
+
+    GET /metrics returns the registry in Prometheus text format. With METRICS_DEBUG=1,
+    GET /debug/profile?seconds=N profiles the event loop for N seconds and
+    GET /debug/trace?rate=R changes the trace sample rate.
+    """
+
+    def __init__(self, registry: Registry = registry, host: str = METRICS_HOST, port: int = METRICS_PORT,
+                 debug: bool = METRICS_DEBUG):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.debug = debug
+        self.profiler = SamplingProfiler()
+        self._server = None
+
+    async def start(self):
+        if not self.port:
+            return
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Metrics endpoint listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self.profiler.running:
+            self.profiler.stop()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            while True:
+                header = await asyncio.wait_for(reader.readline(), timeout=10)
+                if header in (b"\r\n", b"\n", b""):
+                    break
+            method, target = request_line.decode("latin-1").split()[:2]
+            status, body = await self._route(method, target)
+        except (ValueError, asyncio.TimeoutError):
+            status, body = "400 Bad Request", "bad request\n"
+        except Exception as e:
+            logger.error(f"Metrics request failed: {e}")
+            status, body = "500 Internal Server Error", "error\n"
+
+        payload = body.encode()
+        writer.write(
+            f"HTTP/1.0 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + payload
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _route(self, method: str, target: str):
+        if method != "GET":
+            return "405 Method Not Allowed", "method not allowed\n"
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        if url.path == "/metrics":
+            return "200 OK", self.registry.render()
+        if self.debug and url.path == "/debug/profile":
+            if self.profiler.running:
+                return "409 Conflict", "a profile is already running\n"
+            seconds = min(float(query.get("seconds", ["10"])[0]), PROFILE_MAX_SECONDS)
+            return "200 OK", await self.profiler.profile(seconds)
+        if self.debug and url.path == "/debug/trace":
+            set_trace_sample_rate(float(query.get("rate", ["1"])[0]))
+            return "200 OK", f"trace sample rate {TRACE_SAMPLE_RATE}\n"
+        return "404 Not Found", "not found\n"
@@ -0,0 +1,124 @@
+import os
+import json
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+NODE_BINARY = os.getenv("NODE_BINARY", "node")
+
+# Restart backoff for crashed processes, in seconds
+RESTART_BACKOFF_MIN = 0.5
+RESTART_BACKOFF_MAX = 30.0
+
+
+class NodeProcess:
+    """
+    A supervised long-lived `node <script> <mode>` process speaking newline-delimited JSON.
+
+    `run()` starts the process, waits for its {"ready": true} banner and hands every
+    later stdout line to `handle()`. Whenever the process exits or fails it is killed
+    and started again with exponential backoff, until `stop()` is called. Subclasses
+    implement `handle()` and may override `on_ready()` and `on_exit()`.
+    """
+
+    # Raised when the process does not come up
+    error = RuntimeError
+
+    def __init__(self, label: str, script: str, mode: str, start_timeout: float):
+        self.label = label
+        self.script = script
+        self.mode = mode
+        self.start_timeout = start_timeout
+        self.process = None
+        self.restarts = 0
+        self._closing = False
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def run(self):
+        """Keep the process alive until `stop()` is called."""
+        backoff = RESTART_BACKOFF_MIN
+        while not self._closing:
+            try:
+                await self._spawn()
+                await self.on_ready()
+                backoff = RESTART_BACKOFF_MIN
+                await self._read_loop()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"{self.label} failed: {e}")
+            finally:
+                self.on_exit()
+                await self.kill()
+
+            if self._closing:
+                break
+            self.restarts += 1
+            logger.warning(f"{self.label} exited; restarting it in {backoff:.1f}s (restart #{self.restarts})")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, RESTART_BACKOFF_MAX)
+
+    async def _spawn(self):
+        self.process = await asyncio.create_subprocess_exec(
+            NODE_BINARY, self.script, self.mode,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=None,
+        )
+        # The first line is the readiness banner, sent once kaspa.js and the WASM module are loaded
+        line = await asyncio.wait_for(self.process.stdout.readline(), timeout=self.start_timeout)
+        banner = json.loads(line) if line else {}
+        if not banner.get("ready"):
+            raise self.error(f"{self.label} did not start: {line!r}")
+        logger.info(f"{self.label} ready (pid {self.process.pid})")
+
+    async def _read_loop(self):
+        stdout = self.process.stdout
+        while True:
+            line = await stdout.readline()
+            if not line:
+                return
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                logger.error(f"{self.label} sent invalid JSON: {line!r}")
+                continue
+            self.handle(message)
+
+    async def send(self, message: dict):
+        """Write one message to the process; raises BrokenPipeError or ConnectionResetError if it is gone."""
+        self.process.stdin.write((json.dumps(message) + "\n").encode())
+        await self.process.stdin.drain()
+
+    def handle(self, message: dict):
+        raise NotImplementedError
+
+    async def on_ready(self):
+        """Called after each start, once the process has sent its banner."""
+
+    def on_exit(self):
+        """Called each time the process is gone, before it is restarted."""
+
+    async def kill(self):
+        process, self.process = self.process, None
+        if process is None or process.returncode is not None:
+            return
+        try:
+            process.kill()
+            await process.wait()
+        except ProcessLookupError:
+            pass
+
+    async def stop(self):
+        self._closing = True
+        if self.process and self.process.stdin:
+            # Closing stdin lets the process exit on its own
+            self.process.stdin.close()
+        await self.kill()
@@ -0,0 +1,177 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+MAX_MESSAGES_PER_USER = int(os.getenv("MAX_MESSAGES_PER_USER", "20"))
+COOLDOWN_SECONDS = int(os.getenv("COOLDOWN_SECONDS", "15"))
+USER_MAX_IN_FLIGHT = int(os.getenv("USER_MAX_IN_FLIGHT", "2"))
+CHAT_CONCURRENCY = int(os.getenv("CHAT_CONCURRENCY", "16"))
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "8"))
+GATE_MAX_WAITING = int(os.getenv("GATE_MAX_WAITING", "32"))
+GATE_MAX_WAIT_SECONDS = float(os.getenv("GATE_MAX_WAIT_SECONDS", "10"))
+# Buckets are pruned once this many users are tracked
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "100000"))
+
+
+class Busy(Exception):
+    """Raised when a request cannot be admitted right now; the user should try again."""
+
+
+class AdmissionGate:
+    """
+    Concurrency limit for one kind of upstream work, with a bounded wait queue.
+
+    At most `limit` callers hold a slot. Up to `max_waiting` more may wait, for at most
+    `max_wait` seconds; anyone beyond that gets Busy immediately instead of piling up.
+    """
+
+    def __init__(self, name: str, limit: int, max_waiting: int = GATE_MAX_WAITING,
+                 max_wait: float = GATE_MAX_WAIT_SECONDS):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self._semaphore = asyncio.Semaphore(self.limit)
+        self.waiting = 0
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        if not self._semaphore.locked():
+            # A slot is free, so this returns without suspending
+            await self._semaphore.acquire()
+        else:
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise Busy(f"{self.name} queue is full ({self.waiting} waiting)")
+
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_wait)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise Busy(f"Waited {self.max_wait}s for {self.name}")
+            finally:
+                self.waiting -= 1
+
+        self.active += 1
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    """
+    Per-user token bucket and in-flight cap, plus the global upstream gates.
+
+    Each user may burst up to MAX_MESSAGES_PER_USER messages; after that one message
+    is allowed every COOLDOWN_SECONDS. Independently, a user never has more than
+    USER_MAX_IN_FLIGHT paid requests running at once.
+    """
+
+    def __init__(
+        self,
+        capacity: int = MAX_MESSAGES_PER_USER,
+        cooldown: float = COOLDOWN_SECONDS,
+        max_in_flight: int = USER_MAX_IN_FLIGHT,
+        gates: dict = None,
+    ):
+        self.capacity = capacity
+        self.cooldown = cooldown
+        self.max_in_flight = max_in_flight
+        self._buckets = {}
+        self._in_flight = {}
+        self.limited = 0
+        self.gates = gates or {
+            "chat": AdmissionGate("chat", CHAT_CONCURRENCY),
+            "tts": AdmissionGate("tts", TTS_CONCURRENCY),
+        }
+
+    def take(self, user_id, tokens: int = 1) -> tuple:
+        """
+        Take up to `tokens` tokens for this user at once, e.g. one per message merged into a reply.
+
+        Returns:
+            tuple: (tokens taken, seconds until the next token if none could be taken, else 0)
+        """
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= RATE_LIMIT_MAX_USERS:
+                self._prune(now)
+            bucket = self._buckets[user_id] = TokenBucket(self.capacity, now)
+        elif self.cooldown > 0:
+            bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.updated) / self.cooldown)
+            bucket.updated = now
+
+        taken = min(tokens, int(bucket.tokens))
+        bucket.tokens -= taken
+        if taken < tokens:
+            self.limited += 1
+        if taken:
+            return taken, 0.0
+        return 0, (1 - bucket.tokens) * self.cooldown
+
+    def _prune(self, now: float):
+        # Users whose bucket would be full again are indistinguishable from new ones
+        full_after = self.capacity * self.cooldown
+        for user_id in [u for u, b in self._buckets.items() if now - b.updated >= full_after]:
+            del self._buckets[user_id]
+
+    @asynccontextmanager
+    async def user_slot(self, user_id):
+        """Hold one of the user's in-flight slots for the duration of a paid request."""
+        if self._in_flight.get(user_id, 0) >= self.max_in_flight:
+            self.limited += 1
+            raise Busy(f"User {user_id} already has {self.max_in_flight} requests in flight")
+        self._in_flight[user_id] = self._in_flight.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            remaining = self._in_flight[user_id] - 1
+            if remaining:
+                self._in_flight[user_id] = remaining
+            else:
+                del self._in_flight[user_id]
+
+    def gate(self, name: str) -> AdmissionGate:
+        return self.gates[name]
+
+    def stats(self) -> dict:
+        return {
+            "tracked_users": len(self._buckets),
+            "users_in_flight": len(self._in_flight),
+            "limited": self.limited,
+            "gates": {name: gate.stats() for name, gate in self.gates.items()},
+        }
@@ -0,0 +1,206 @@
+import os
+import re
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+REPLY_CACHE_TTL = int(os.getenv("REPLY_CACHE_TTL", str(6 * 3600)))
+REPLY_CACHE_MAX_ENTRIES = int(os.getenv("REPLY_CACHE_MAX_ENTRIES", "512"))
+REPLY_CACHE_MAX_BYTES = int(os.getenv("REPLY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Jaccard similarity of word sets needed for a near-duplicate hit; 0 disables fuzzy matching
+REPLY_CACHE_FUZZY_THRESHOLD = float(os.getenv("REPLY_CACHE_FUZZY_THRESHOLD", "0"))
+
+_NON_WORD = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace: "What is KASPER??" -> "what is kasper"."""
+    return _SPACES.sub(" ", _NON_WORD.sub(" ", text.lower())).strip()
+
+
+class CachedReply:
+    """A generated reply plus its voice note, as bytes and as a Telegram file_id."""
+
+    __slots__ = ("key", "words", "text", "ogg", "file_id", "created_at")
+
+    def __init__(self, key: str, text: str, ogg: bytes, file_id: str = None, created_at: float = None):
+        self.key = key
+        self.words = frozenset(key.split())
+        self.text = text
+        self.ogg = ogg or b""
+        self.file_id = file_id
+        self.created_at = created_at or time.time()
+
+    @property
+    def size(self) -> int:
+        return len(self.ogg) + len(self.text)
+
+    def expired(self, ttl: float) -> bool:
+        return time.time() - self.created_at > ttl
+
+
+class ReplyCache:
+    """
+    LRU cache of replies keyed on normalized user text.
+
+    Entries expire after `ttl` seconds and the least recently used ones are evicted
+    when either `max_entries` or `max_bytes` is exceeded. When a Mongo collection is
+    given it is used as a shared second tier, so several bot processes reuse each
+    other's replies and file_ids.
+    """
+
+    def __init__(
+        self,
+        ttl: float = REPLY_CACHE_TTL,
+        max_entries: int = REPLY_CACHE_MAX_ENTRIES,
+        max_bytes: int = REPLY_CACHE_MAX_BYTES,
+        fuzzy_threshold: float = REPLY_CACHE_FUZZY_THRESHOLD,
+        collection=None,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.fuzzy_threshold = fuzzy_threshold
+        self.collection = collection
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.fuzzy_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def ensure_indexes(self):
+        if self.collection is None:
+            return
+        try:
+            await self.collection.create_index("created_at", expireAfterSeconds=int(self.ttl))
+        except PyMongoError as e:
+            logger.error(f"Could not create reply cache TTL index: {e}")
+
+    async def get(self, user_text: str):
+        """Return a CachedReply for this text, or None."""
+        key = normalize_text(user_text)
+        if not key:
+            return None
+
+        entry = self._get_local(key) or self._get_similar(key)
+        if entry is None:
+            entry = await self._get_shared(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    async def put(self, user_text: str, text: str, ogg: bytes, file_id: str = None):
+        key = normalize_text(user_text)
+        if not key:
+            return
+        entry = CachedReply(key, text, ogg, file_id)
+        self._store(entry)
+        if self.collection is not None:
+            try:
+                await self.collection.replace_one(
+                    {"_id": key},
+                    {
+                        "text": text,
+                        "ogg": entry.ogg,
+                        "file_id": file_id,
+                        "created_at": datetime.fromtimestamp(entry.created_at, timezone.utc),
+                    },
+                    upsert=True,
+                )
+            except PyMongoError as e:
+                logger.warning(f"Could not write shared reply cache: {e}")
+
+    async def set_file_id(self, entry: CachedReply, file_id: str):
+        """Remember the Telegram file_id once a cached voice note has been uploaded."""
+        entry.file_id = file_id
+        if self.collection is not None:
+            try:
+                await self.collection.update_one({"_id": entry.key}, {"$set": {"file_id": file_id}})
+            except PyMongoError as e:
+                logger.warning(f"Could not update shared reply cache: {e}")
+
+    def _get_local(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expired(self.ttl):
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _get_similar(self, key: str):
+        if self.fuzzy_threshold <= 0:
+            return None
+        words = frozenset(key.split())
+        best, best_score = None, self.fuzzy_threshold
+        for entry in self._entries.values():
+            union = len(words | entry.words)
+            score = len(words & entry.words) / union if union else 0.0
+            if score >= best_score and not entry.expired(self.ttl):
+                best, best_score = entry, score
+        if best is not None:
+            self.fuzzy_hits += 1
+            self._entries.move_to_end(best.key)
+        return best
+
+    async def _get_shared(self, key: str):
+        if self.collection is None:
+            return None
+        try:
+            doc = await self.collection.find_one({"_id": key})
+        except PyMongoError as e:
+            logger.warning(f"Could not read shared reply cache: {e}")
+            return None
+        if not doc:
+            return None
+        # pymongo returns naive datetimes that are in UTC
+        created_at = doc["created_at"].replace(tzinfo=timezone.utc).timestamp()
+        entry = CachedReply(key, doc["text"], bytes(doc.get("ogg") or b""), doc.get("file_id"), created_at)
+        if entry.expired(self.ttl):
+            return None
+        self.shared_hits += 1
+        self._store(entry)
+        return entry
+
+    def _store(self, entry: CachedReply):
+        if entry.size > self.max_bytes:
+            return
+        self._remove(entry.key)
+        self._entries[entry.key] = entry
+        self._bytes += entry.size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "fuzzy_hits": self.fuzzy_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,266 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+# Seconds a whole stage may take, fallbacks included, and one target's share of it
+CHAT_BUDGET = float(os.getenv("CHAT_BUDGET", "30"))
+CHAT_ATTEMPT_TIMEOUT = float(os.getenv("CHAT_ATTEMPT_TIMEOUT", "15"))
+TTS_BUDGET = float(os.getenv("TTS_BUDGET", "20"))
+TTS_ATTEMPT_TIMEOUT = float(os.getenv("TTS_ATTEMPT_TIMEOUT", "10"))
+# A duplicate request goes out once the first is slower than this percentile of recent ones; 0 disables hedging
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.5"))
+# Hedges never exceed this fraction of requests, which bounds the extra upstream cost
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+# Successful requests needed before the percentile is trusted
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+# Consecutive failures that open a target's circuit, and how long it then stays skipped
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+
+DECISIONS = registry.counter(
+    "policy_decisions_total", "Request policy decisions, by policy and decision.", ("policy", "decision")
+)
+
+
+class PolicyError(Exception):
+    """Raised when every target of a policy failed, was skipped or ran out of budget."""
+
+
+class CircuitBreaker:
+    """
+    Skips a target after `failures` consecutive failures, for `cooldown` seconds.
+
+    After the cooldown one request is let through as a trial: success closes the
+    circuit again, failure reopens it for another cooldown.
+    """
+
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = max(1, failures)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.opens = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.trial or time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.trial or time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        self.trial = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial or (self.opened_at is None and self.failures >= self.threshold):
+            self.opened_at = time.monotonic()
+            self.opens += 1
+        self.trial = False
+
+    def release(self):
+        """Give the trial slot back when a trial request was cancelled rather than answered."""
+        self.trial = False
+
+
+class LatencyWindow:
+    """The last `size` successful request durations of one target."""
+
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, q: float):
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class RequestPolicy:
+    """
+    Latency budget, hedging, fallback and circuit breaking for one upstream stage.
+
+    `run()` takes targets in order of preference, e.g. the configured model and then
+    a fallback model, each as (name, factory) where the factory starts one request
+    and raises on failure. A target whose circuit is open is skipped. Otherwise it is
+    tried for up to `attempt_timeout` (the last one for whatever budget is left), and
+    if it is still running after the HEDGE_PERCENTILE of its recent latencies, a
+    duplicate request races it; whichever answers first wins and the other is
+    cancelled. A failure or timeout moves on to the next target.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        budget: float,
+        attempt_timeout: float,
+        hedge_percentile: float = HEDGE_PERCENTILE,
+        hedge_min_delay: float = HEDGE_MIN_DELAY,
+        hedge_max_ratio: float = HEDGE_MAX_RATIO,
+        breaker_failures: int = BREAKER_FAILURES,
+        breaker_cooldown: float = BREAKER_COOLDOWN,
+    ):
+        self.name = name
+        self.budget = budget
+        self.attempt_timeout = attempt_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_ratio = hedge_max_ratio
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self._breakers = {}
+        self._latencies = {}
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+        self.skipped = 0
+        self.failures = 0
+
+    def breaker(self, target: str) -> CircuitBreaker:
+        breaker = self._breakers.get(target)
+        if breaker is None:
+            breaker = self._breakers[target] = CircuitBreaker(self.breaker_failures, self.breaker_cooldown)
+        return breaker
+
+    def _decide(self, decision: str):
+        DECISIONS.inc(policy=self.name, decision=decision)
+
+    async def run(self, targets: list):
+        """Return the first successful result of `targets`, a list of (name, factory) pairs."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.budget
+        self.requests += 1
+        last_error = None
+        for i, (target, factory) in enumerate(targets):
+            last = i == len(targets) - 1
+            breaker = self.breaker(target)
+            if not breaker.allow():
+                self.skipped += 1
+                self._decide("breaker_open")
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                breaker.release()
+                self._decide("budget_exceeded")
+                break
+            if i > 0:
+                self.fallbacks += 1
+                self._decide("fallback")
+            try:
+                result = await self._hedged(target, factory, remaining if last else min(remaining, self.attempt_timeout))
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except Exception as e:
+                breaker.record_failure()
+                self._decide("attempt_failed")
+                logger.warning(f"{self.name} request to {target} failed: {e!r}")
+                last_error = e
+                continue
+            breaker.record_success()
+            self._decide("ok" if i == 0 else "fallback_ok")
+            return result
+
+        self.failures += 1
+        self._decide("failed")
+        raise PolicyError(f"No {self.name} target answered: {last_error!r}") from last_error
+
+    async def _hedged(self, target: str, factory, timeout: float):
+        """One target's request, raced by a duplicate once it is slower than usual."""
+        loop = asyncio.get_running_loop()
+        latencies = self._latencies.setdefault(target, LatencyWindow())
+        started = loop.time()
+        end = started + timeout
+        hedge_at = self._hedge_delay(latencies)
+        hedge_at = started + hedge_at if hedge_at is not None and hedge_at < timeout else None
+
+        first = asyncio.create_task(factory())
+        starts = {first: started}
+        pending = {first}
+        error = None
+        try:
+            while True:
+                wake = min(end, hedge_at) if hedge_at is not None else end
+                done, _ = await asyncio.wait(pending, timeout=max(0.0, wake - loop.time()),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pending.discard(task)
+                    if task.exception() is None:
+                        latencies.add(loop.time() - starts[task])
+                        if task is not first:
+                            self.hedge_wins += 1
+                            self._decide("hedge_won")
+                        return task.result()
+                    error = task.exception()
+
+                now = loop.time()
+                if hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    if pending and self.hedges < self.hedge_max_ratio * self.requests:
+                        self.hedges += 1
+                        self._decide("hedged")
+                        hedge = asyncio.create_task(factory())
+                        starts[hedge] = now
+                        pending.add(hedge)
+                if not pending:
+                    raise error
+                if now >= end:
+                    raise asyncio.TimeoutError(f"{target} took longer than {timeout:.1f}s")
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def _hedge_delay(self, latencies: LatencyWindow):
+        if self.hedge_percentile <= 0:
+            return None
+        percentile = latencies.percentile(self.hedge_percentile)
+        return None if percentile is None else max(self.hedge_min_delay, percentile)
+
+    def stats(self) -> dict:
+        stats = {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "fallbacks": self.fallbacks,
+            "skipped": self.skipped,
+            "failures": self.failures,
+        }
+        targets = {}
+        for target, breaker in self._breakers.items():
+            delay = self._hedge_delay(self._latencies.get(target, LatencyWindow()))
+            targets[target] = {
+                "circuit_open": int(breaker.state != "closed"),
+                "circuit_opens": breaker.opens,
+                "hedge_delay_seconds": delay if delay is not None else 0.0,
+            }
+        if targets:
+            stats["targets"] = targets
+        return stats
@@ -0,0 +1,117 @@
+"""
+Compare retrieval-based prompts with the full knowledge prompt.
+
+Offline (default): for each question, checks whether the facts needed to answer it
+made it into the system prompt, and how large the prompt is.
+
+    python scripts/eval_prompt.py [--budget 600] [--top-k 4] [--json]
+
+With --live the questions are also sent to OpenAI (OPENAI_API_KEY) with both prompts
+and the expected keywords are looked for in the answers, alongside the prompt_tokens
+reported by the API.
+"""
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knowledge_base import KnowledgeBase, estimate_tokens, PROMPT_TOKEN_BUDGET, RETRIEVAL_TOP_K  # noqa: E402
+
+# (question, keywords the answer should contain; each entry may list alternatives)
+CASES = [
+    ("What is the total supply of Kasper?", [("28,700,000,000", "28.7 billion", "28700000000")]),
+    ("When did Kasper launch?", [("september 15", "sept 15", "15 september")]),
+    ("Who founded Kasper?", ["alberto", "andrew"]),
+    ("Where can I buy KASPER?", [("coinex", "xeggex", "biconomy", "ascendex", "kaspa market")]),
+    ("Give me the Kaspa Market link", ["kaspamarket.io"]),
+    ("Which wallets can I store Kasper in?", [("tangem", "zelcore", "kasware")]),
+    ("Was there a presale or team allocation?", [("no pre-allocation", "fair launch", "no pre")]),
+    ("What was the mint limit?", ["28,700"]),
+    ("What's planned for Q2 2025?", [("clout festival", "treasury report", "smart contract")]),
+    ("Will Kasper get listed on Binance?", [("binance", "coinbase")]),
+    ("What did Kasper do with Jarritos?", ["jarritos"]),
+    ("Why is Kaspa a good network?", [("security", "scalab", "efficien", "decentraliz")]),
+    ("What is KRC20?", [("kaspa blockchain", "token standard", "standard for creating")]),
+    ("Is Kasper on CoinMarketCap?", ["coinmarketcap"]),
+    ("What is Kaspers vision?", [("inclusive", "equal opportunit")]),
+]
+
+
+def covered(text: str, keywords: list) -> float:
+    text = text.lower()
+    hits = 0
+    for keyword in keywords:
+        options = keyword if isinstance(keyword, tuple) else (keyword,)
+        hits += any(option.lower() in text for option in options)
+    return hits / len(keywords)
+
+
+def ask_openai(system_prompt: str, question: str):
+    import httpx
+
+    response = httpx.post(
+        "https://api.openai.com/v1/chat/completions",
+        headers={"Authorization": f"Bearer {os.getenv('OPENAI_API_KEY', '')}"},
+        json={
+            "model": "gpt-4o-mini",
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": question},
+            ],
+        },
+        timeout=60,
+    )
+    response.raise_for_status()
+    data = response.json()
+    return data["choices"][0]["message"]["content"], data["usage"]["prompt_tokens"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=int, default=PROMPT_TOKEN_BUDGET, help="knowledge token budget")
+    parser.add_argument("--top-k", type=int, default=RETRIEVAL_TOP_K, help="chunks retrieved per question")
+    parser.add_argument("--live", action="store_true", help="also ask OpenAI with both prompts")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    kb = KnowledgeBase.load()
+    full_prompt = kb.system_prompt("", retrieval=False)
+    rows = []
+    for question, keywords in CASES:
+        prompt = kb.system_prompt(question, token_budget=args.budget, k=args.top_k)
+        row = {
+            "question": question,
+            "full_tokens": estimate_tokens(full_prompt),
+            "retrieval_tokens": estimate_tokens(prompt),
+            "full_coverage": covered(full_prompt, keywords),
+            "retrieval_coverage": covered(prompt, keywords),
+        }
+        if args.live:
+            full_answer, row["full_prompt_tokens"] = ask_openai(full_prompt, question)
+            answer, row["retrieval_prompt_tokens"] = ask_openai(prompt, question)
+            row["full_answer_coverage"] = covered(full_answer, keywords)
+            row["retrieval_answer_coverage"] = covered(answer, keywords)
+        rows.append(row)
+
+    metrics = [key for key in rows[0] if key != "question"]
+    summary = {key: sum(row[key] for row in rows) / len(rows) for key in metrics}
+
+    if args.json:
+        print(json.dumps({"budget": args.budget, "top_k": args.top_k, "summary": summary, "cases": rows}, indent=2))
+        return
+
+    print(f"{'question':<45} {'full tok':>8} {'retr tok':>8} {'full cov':>8} {'retr cov':>8}")
+    for row in rows:
+        print(
+            f"{row['question'][:45]:<45} {row['full_tokens']:>8} {row['retrieval_tokens']:>8} "
+            f"{row['full_coverage']:>8.2f} {row['retrieval_coverage']:>8.2f}"
+        )
+    print()
+    for key, value in summary.items():
+        print(f"mean {key}: {value:.2f}")
+
+
+if __name__ == "__main__":
+    main()
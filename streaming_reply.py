@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import asyncio
+import logging
+from contextlib import AsyncExitStack
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+# Sentences waiting for TTS; when full the LLM stream is read more slowly
+STREAM_SENTENCE_QUEUE = int(os.getenv("STREAM_SENTENCE_QUEUE", "4"))
+# Very short fragments ("Boo!") are merged with the next sentence before TTS
+STREAM_MIN_SENTENCE_CHARS = int(os.getenv("STREAM_MIN_SENTENCE_CHARS", "20"))
+STREAM_TTS_OUTPUT_FORMAT = os.getenv("STREAM_TTS_OUTPUT_FORMAT", "mp3_44100_64")
+
+SENTENCE_END = re.compile(r"[.!?…]+[\"')\]]*\s+")
+
+_DONE = object()
+
+
+class StreamError(Exception):
+    """Raised when an upstream stream ends with an error."""
+
+
+#######################################
+# Stage 1: LLM tokens
+#######################################
+async def stream_chat_tokens(upstream, headers: dict, payload: dict):
+    """Yield content deltas from an OpenAI chat completion streamed as server-sent events."""
+    payload = dict(payload, stream=True)
+    async with upstream.stream("openai", "POST", "/v1/chat/completions", headers=headers, json=payload) as response:
+        if response.status_code >= 400:
+            await response.aread()
+            raise StreamError(f"Chat stream failed with {response.status_code}: {response.text[:200]}")
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                return
+            try:
+                choice = json.loads(data)["choices"][0]
+            except (ValueError, KeyError, IndexError):
+                continue
+            delta = choice.get("delta", {}).get("content")
+            if delta:
+                yield delta
+
+
+#######################################
+# Stage 2: sentence chunks
+#######################################
+async def sentence_chunks(tokens, min_chars: int = STREAM_MIN_SENTENCE_CHARS):
+    """Group a token stream into complete sentences."""
+    buffer = ""
+    async for token in tokens:
+        buffer += token
+        start = 0
+        for match in SENTENCE_END.finditer(buffer):
+            if match.end() - start >= min_chars:
+                yield buffer[start:match.end()].strip()
+                start = match.end()
+        buffer = buffer[start:]
+    if buffer.strip():
+        yield buffer.strip()
+
+
+#######################################
+# Stage 3: streaming TTS
+#######################################
+async def stream_tts_audio(upstream, sentences, voice_id: str, headers: dict, payload: dict):
+    """Yield audio bytes for each sentence from the ElevenLabs streaming endpoint, in order."""
+    async for sentence in sentences:
+        body = dict(payload, text=sentence)
+        params = {"output_format": STREAM_TTS_OUTPUT_FORMAT} if STREAM_TTS_OUTPUT_FORMAT else None
+        async with upstream.stream(
+            "elevenlabs", "POST", f"/v1/text-to-speech/{voice_id}/stream",
+            headers=headers, json=body, params=params,
+        ) as response:
+            if response.status_code >= 400:
+                await response.aread()
+                raise StreamError(f"TTS stream failed with {response.status_code}: {response.text[:200]}")
+            async for chunk in response.aiter_bytes():
+                yield chunk
+
+
+#######################################
+# Plumbing
+#######################################
+async def bounded(source, maxsize: int):
+    """
+    Run `source` in its own task, buffering at most `maxsize` items.
+
+    This lets two stages overlap while keeping backpressure: when the consumer falls
+    behind, the producer blocks on the full queue instead of buffering without limit.
+    """
+    queue = asyncio.Queue(maxsize=maxsize)
+
+    async def produce():
+        try:
+            async for item in source:
+                await queue.put(item)
+            await queue.put(_DONE)
+        except Exception as e:
+            await queue.put(e)
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def tee_text(sentences, on_text):
+    """Pass sentences through while reporting the text accumulated so far."""
+    text = ""
+    async for sentence in sentences:
+        text = f"{text} {sentence}".strip()
+        await on_text(text, False)
+        yield sentence
+    await on_text(text, True)
+
+
+#######################################
+# Full pipeline
+#######################################
+async def stream_reply(upstream, transcoder, chat_headers: dict, chat_payload: dict,
+                       voice_id: str, tts_headers: dict, tts_payload: dict, on_text):
+    """
+    Stream a chat completion into progressive text updates and an OGG/Opus voice note.
+
+    tokens -> sentences -> (on_text) -> streaming TTS -> incremental Opus encode
+
+    `on_text(text, final)` is awaited with the reply so far after every sentence.
+    Returns the full reply text and the encoded voice note.
+    """
+    tokens = stream_chat_tokens(upstream, chat_headers, chat_payload)
+    sentences = bounded(tee_text(sentence_chunks(tokens), on_text), STREAM_SENTENCE_QUEUE)
+
+    reply_parts = []
+
+    async def record(source):
+        async for sentence in source:
+            reply_parts.append(sentence)
+            yield sentence
+
+    audio = stream_tts_audio(upstream, record(sentences), voice_id, tts_headers, tts_payload)
+    async with AsyncExitStack() as stack:
+        encoder = None
+        async for chunk in audio:
+            if encoder is None:
+                # Only take an encoder slot once audio actually arrives
+                encoder = await stack.enter_async_context(transcoder.stream())
+            await encoder.feed(chunk)
+        ogg = await encoder.finish() if encoder else b""
+
+    reply = " ".join(reply_parts)
+    if not reply.strip():
+        # Nothing was shown or spoken, so the caller refunds rather than treating it as a reply
+        raise StreamError("Chat stream ended without any text")
+    return reply, ogg
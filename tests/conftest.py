@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fake_upstreams import FakeUpstreams, FakeUpstreamConfig  # noqa: E402
+
+
+@pytest.fixture
+def kasplex():
+    """The bench's fake Kasplex; transfers only appear through `add_transfer()`."""
+    upstreams = FakeUpstreams(FakeUpstreamConfig(new_deposits_per_scan=0)).start()
+    yield upstreams
+    upstreams.stop()
@@ -0,0 +1,120 @@
+"""DepositScanner against the fake Kasplex, which pages oplist results through opScore cursors."""
+import asyncio
+
+import pytest
+
+import db_manager
+from bench.fake_upstreams import OPLIST_PAGE_SIZE
+from bench.memory_mongo import MemoryClient
+from deposit_scanner import DepositScanner
+from http_clients import UpstreamClients
+
+TELEGRAM_ID = 1
+WALLET = "kaspa:qtestwallet"
+CREDIT_RATE = 200
+
+
+@pytest.fixture
+def scan(kasplex, monkeypatch):
+    """Run `body(scanner)` with a scanner wired to the fake Kasplex and an in-memory Mongo."""
+    monkeypatch.setattr(db_manager, "AsyncIOMotorClient", MemoryClient)
+
+    def run(body, max_pages: int = 100):
+        async def main():
+            db = db_manager.DBManager("mongodb://memory")
+            await db.ensure_indexes()
+            await db.create_user(TELEGRAM_ID, WALLET, "xprv", "mnemonic", credits=0)
+            upstream = UpstreamClients({"kasplex": kasplex.base_url}, retries=0, http2=False)
+            try:
+                return await body(DepositScanner(db, upstream, CREDIT_RATE, max_pages=max_pages))
+            finally:
+                await upstream.close()
+
+        return asyncio.run(main())
+
+    return run
+
+
+def add_transfers(kasplex, count: int, start: int = 0) -> list:
+    hashes = [f"tx{i:04d}" for i in range(start, start + count)]
+    for hash_rev in hashes:
+        kasplex.add_transfer(WALLET, hash_rev)
+    return hashes
+
+
+def credited(result: dict) -> set:
+    return {tx["hashRev"] for tx in result["transactions"]}
+
+
+def test_first_scan_walks_every_page(kasplex, scan):
+    hashes = add_transfers(kasplex, 2 * OPLIST_PAGE_SIZE + 20)
+
+    async def body(scanner):
+        result = await scanner.scan_wallet(TELEGRAM_ID, WALLET)
+        state = await scanner.db_manager.get_deposit_checkpoint(WALLET)
+        return result, state, await scanner.db_manager.get_credits(TELEGRAM_ID)
+
+    result, state, credits = scan(body)
+    assert credited(result) == set(hashes)
+    assert result["credits_added"] == credits == len(hashes) * 1000 // CREDIT_RATE
+    assert kasplex.stats["oplist"].requests == 3
+    assert state == {"last_op_score": len(hashes), "resume": None}
+
+
+@pytest.mark.parametrize("max_pages", [1, 2])
+def test_capped_scan_resumes_and_sees_newer_transfers(kasplex, scan, max_pages):
+    hashes = add_transfers(kasplex, 3 * OPLIST_PAGE_SIZE + 20)
+
+    async def body(scanner):
+        seen = credited(await scanner.scan_wallet(TELEGRAM_ID, WALLET))
+        state = await scanner.db_manager.get_deposit_checkpoint(WALLET)
+        assert len(seen) == max_pages * OPLIST_PAGE_SIZE
+        assert state["last_op_score"] is None and state["resume"]
+
+        # Transfers arriving mid-walk are picked up along with the rest of the old walk
+        newer = add_transfers(kasplex, 10, start=len(hashes))
+        for _ in range(10):
+            seen |= credited(await scanner.scan_wallet(TELEGRAM_ID, WALLET))
+            state = await scanner.db_manager.get_deposit_checkpoint(WALLET)
+            if state["resume"] is None:
+                break
+        return seen, newer, state
+
+    seen, newer, state = scan(body, max_pages=max_pages)
+    assert seen == set(hashes + newer)
+    assert state == {"last_op_score": len(hashes) + len(newer), "resume": None}
+
+
+def test_pending_operation_holds_the_checkpoint_back(kasplex, scan):
+    add_transfers(kasplex, 3)
+    kasplex.add_transfer(WALLET, "pending", accepted=False)
+    add_transfers(kasplex, 2, start=3)
+
+    async def body(scanner):
+        first = await scanner.scan_wallet(TELEGRAM_ID, WALLET)
+        held = await scanner.db_manager.get_deposit_checkpoint(WALLET)
+        kasplex.accept(WALLET, "pending")
+        second = await scanner.scan_wallet(TELEGRAM_ID, WALLET)
+        done = await scanner.db_manager.get_deposit_checkpoint(WALLET)
+        return first, held, second, done
+
+    first, held, second, done = scan(body)
+    assert len(first["transactions"]) == 5 and "pending" not in credited(first)
+    # The pending transfer has opScore 4, so scanning resumes just below it
+    assert held["last_op_score"] == 3
+    assert credited(second) == {"pending"}
+    assert done["last_op_score"] == 6
+
+
+def test_repeat_scan_costs_one_request(kasplex, scan):
+    add_transfers(kasplex, OPLIST_PAGE_SIZE + 5)
+
+    async def body(scanner):
+        await scanner.scan_wallet(TELEGRAM_ID, WALLET)
+        before = kasplex.stats["oplist"].requests
+        result = await scanner.scan_wallet(TELEGRAM_ID, WALLET)
+        return result, kasplex.stats["oplist"].requests - before
+
+    result, requests = scan(body)
+    assert result == {"transactions": [], "credits_added": 0}
+    assert requests == 1
@@ -0,0 +1,149 @@
+import os
+import signal
+import asyncio
+import logging
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+# Updates processed at once; 1 restores strictly sequential handling
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "64"))
+# Seconds in-flight updates get to finish after SIGTERM before they are cancelled
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "20"))
+
+
+def serialization_key(update):
+    """Updates sharing a key run one at a time, in arrival order."""
+    if getattr(update, "effective_user", None):
+        return update.effective_user.id
+    if getattr(update, "effective_chat", None):
+        return update.effective_chat.id
+    return None
+
+
+class UserLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class UpdateDispatcher:
+    """
+    Per-user ordering on top of the Application's concurrent update processing.
+
+    The Application runs up to UPDATE_WORKERS updates at once; handlers wrapped with
+    `serialized()` additionally take a per-user lock, so one user's messages are
+    answered in the order they were sent while other users proceed in parallel.
+    asyncio locks wake waiters first-come first-served, and updates are started in
+    arrival order, so arrival order is preserved.
+
+    With a `coalescer`, handlers wrapped with `serialized(..., coalesce=True)` first
+    let it merge a burst of the user's messages, outside the lock; every other
+    serialized update from that user flushes the burst before queueing.
+
+    `install_signal_handlers()` replaces the Application's own stop signals with a
+    drain: stop fetching updates, give in-flight handlers DRAIN_TIMEOUT seconds, then
+    let the Application shut down normally.
+    """
+
+    def __init__(self, drain_timeout: float = DRAIN_TIMEOUT, coalescer=None):
+        self.drain_timeout = drain_timeout
+        self.coalescer = coalescer
+        self._locks = {}
+        self._in_flight = set()
+        self.draining = False
+        self.processed = 0
+        self.queued_behind_user = 0
+        self.peak_in_flight = 0
+        self.cancelled_on_drain = 0
+
+    def serialized(self, callback, coalesce: bool = False):
+        @wraps(callback)
+        async def wrapper(update, context):
+            # Tracked from arrival, so updates still waiting for their user's turn are drained too
+            return await self._track(self._run(callback, update, context, coalesce))
+
+        return wrapper
+
+    async def _run(self, callback, update, context, coalesce: bool = False):
+        key = serialization_key(update)
+        if key is None:
+            return await callback(update, context)
+
+        if self.coalescer is not None and self.coalescer.enabled:
+            if coalesce:
+                update = await self.coalescer.collect(key, update)
+                if update is None:
+                    # Answered by the reply to an earlier message of the burst
+                    return None
+            else:
+                await self.coalescer.flush(key)
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = UserLock()
+        if entry.lock.locked():
+            self.queued_behind_user += 1
+        entry.users += 1
+        try:
+            async with entry.lock:
+                return await callback(update, context)
+        finally:
+            entry.users -= 1
+            if not entry.users:
+                del self._locks[key]
+
+    async def _track(self, coroutine):
+        task = asyncio.current_task()
+        self._in_flight.add(task)
+        self.peak_in_flight = max(self.peak_in_flight, len(self._in_flight))
+        try:
+            return await coroutine
+        finally:
+            self._in_flight.discard(task)
+            self.processed += 1
+
+    def install_signal_handlers(self, app, signals=(signal.SIGINT, signal.SIGTERM)):
+        """Call from post_init, i.e. inside the Application's event loop."""
+        loop = asyncio.get_running_loop()
+        for sig in signals:
+            try:
+                loop.add_signal_handler(sig, lambda: asyncio.ensure_future(self.drain(app)))
+            except NotImplementedError:
+                logger.warning(f"Cannot install a drain handler for {sig!r} on this platform")
+
+    async def drain(self, app):
+        if self.draining:
+            return
+        self.draining = True
+        logger.info(f"Shutting down gracefully, draining {len(self._in_flight)} in-flight updates...")
+        if app.updater and app.updater.running:
+            # Stop taking new updates; queued ones are still processed by Application.stop()
+            await app.updater.stop()
+
+        pending = set(self._in_flight)
+        if pending:
+            _, pending = await asyncio.wait(pending, timeout=self.drain_timeout)
+        if pending:
+            logger.warning(f"Cancelling {len(pending)} updates still running after {self.drain_timeout}s")
+            self.cancelled_on_drain += len(pending)
+            for task in pending:
+                task.cancel()
+
+        # run_polling/run_webhook continue with Application.stop() and the shutdown hooks
+        asyncio.get_running_loop().stop()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._in_flight),
+            "peak_in_flight": self.peak_in_flight,
+            "active_users": len(self._locks),
+            "processed": self.processed,
+            "queued_behind_user": self.queued_behind_user,
+            "cancelled_on_drain": self.cancelled_on_drain,
+        }
@@ -0,0 +1,329 @@
+import os
+import uuid
+import signal
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+from metrics import observe
+from update_dispatcher import serialization_key, DRAIN_TIMEOUT, UPDATE_WORKERS
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+# Users are hashed onto this many shards; each shard is owned by one processor at a time
+UPDATE_SHARDS = int(os.getenv("UPDATE_SHARDS", "64"))
+# Seconds a claimed update stays invisible to other processors; renewed while it runs
+UPDATE_LEASE = float(os.getenv("UPDATE_LEASE", "30"))
+# Seconds a processor keeps its shards without a heartbeat; a crashed processor's shards move after this
+SHARD_LEASE = float(os.getenv("SHARD_LEASE", "15"))
+UPDATE_HEARTBEAT = float(os.getenv("UPDATE_HEARTBEAT", "3"))
+UPDATE_POLL_INTERVAL = float(os.getenv("UPDATE_POLL_INTERVAL", "0.2"))
+# An update that took its processor down this many times is parked as failed
+UPDATE_MAX_ATTEMPTS = int(os.getenv("UPDATE_MAX_ATTEMPTS", "3"))
+# Finished updates are kept this long so Telegram redeliveries are recognised
+UPDATE_QUEUE_TTL = int(os.getenv("UPDATE_QUEUE_TTL", str(24 * 3600)))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def shard_for(key, shards: int = UPDATE_SHARDS) -> int:
+    return key % shards if isinstance(key, int) else 0
+
+
+def new_processor_id() -> str:
+    # Unique per process start, so a restarted dyno never mistakes old leases for its own
+    return f"{os.getenv('DYNO') or socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class UpdateQueue:
+    """
+    Mongo-backed queue between the ingress and the processors.
+
+    Each update is stored under its update_id, so a redelivery from Telegram is
+    ignored, with the shard of its user. A claim leases the update for UPDATE_LEASE
+    seconds; an update whose lease runs out (its processor died) becomes visible
+    again and is retried, up to UPDATE_MAX_ATTEMPTS times.
+    """
+
+    def __init__(self, db, shards: int = UPDATE_SHARDS, lease: float = UPDATE_LEASE):
+        self.updates = db["update_queue"]
+        self.shards = db["update_shards"]
+        self.processors = db["update_processors"]
+        self.shard_count = shards
+        self.lease = lease
+        self.enqueued = 0
+        self.duplicates = 0
+
+    async def ensure_indexes(self):
+        await self.updates.create_index([("shard", 1), ("status", 1), ("_id", 1)])
+        await self.updates.create_index("done_at", expireAfterSeconds=UPDATE_QUEUE_TTL)
+        await self.processors.create_index("seen_at", expireAfterSeconds=3600)
+        try:
+            await self.shards.insert_many(
+                [{"_id": shard, "owner": None, "lease_until": datetime.min} for shard in range(self.shard_count)],
+                ordered=False,
+            )
+        except BulkWriteError:
+            pass  # Shards created by an earlier start
+
+    def document(self, update) -> dict:
+        return {
+            "_id": update.update_id,
+            "shard": shard_for(serialization_key(update), self.shard_count),
+            "update": update.to_dict(),
+            "status": QUEUED,
+            "attempts": 0,
+            "enqueued_at": datetime.utcnow(),
+        }
+
+    async def enqueue(self, update) -> bool:
+        """Store an update for the processors; False if it was already queued."""
+        try:
+            await self.updates.insert_one(self.document(update))
+        except DuplicateKeyError:
+            self.duplicates += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    async def claim(self, owner: str, shards: list):
+        """Lease the oldest visible update in `shards`, including ones whose lease ran out."""
+        now = datetime.utcnow()
+        return await self.updates.find_one_and_update(
+            {
+                "shard": {"$in": shards},
+                "$or": [
+                    {"status": QUEUED},
+                    {"status": RUNNING, "lease_until": {"$lt": now}},
+                ],
+            },
+            {
+                "$set": {"status": RUNNING, "lease_owner": owner, "lease_until": now + timedelta(seconds=self.lease)},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("_id", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def renew(self, owner: str, update_ids: list):
+        if update_ids:
+            await self.updates.update_many(
+                {"_id": {"$in": update_ids}, "lease_owner": owner},
+                {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=self.lease)}},
+            )
+
+    async def finish(self, doc: dict, status: str, error: str = None):
+        update = {"status": status, "done_at": datetime.utcnow()}
+        if error:
+            update["error"] = error
+        await self.updates.update_one({"_id": doc["_id"], "lease_owner": doc["lease_owner"]}, {"$set": update})
+
+    async def release(self, doc: dict):
+        """Make a claimed update visible again without counting the attempt."""
+        await self.updates.update_one(
+            {"_id": doc["_id"], "lease_owner": doc["lease_owner"]},
+            {"$set": {"status": QUEUED, "lease_owner": None}, "$inc": {"attempts": -1}},
+        )
+
+    async def pending(self) -> int:
+        return await self.updates.count_documents({"status": {"$in": [QUEUED, RUNNING]}})
+
+    def stats(self) -> dict:
+        return {"enqueued": self.enqueued, "duplicates": self.duplicates}
+
+
+class UpdateProcessor:
+    """
+    Claims queued updates for the shards this process owns and runs them.
+
+    Shard ownership is a lease in `update_shards`, renewed every UPDATE_HEARTBEAT
+    seconds. Each processor aims for an equal share of the shards among the processors
+    seen recently: it gives back idle shards above its share and takes over free or
+    expired ones below it, so a crashed processor's shards move to the survivors after
+    SHARD_LEASE seconds. Because one user's updates always land on one shard, they are
+    handled by one process at a time, in update_id order, and that process's user
+    cache stays warm for them.
+    """
+
+    def __init__(
+        self,
+        queue: UpdateQueue,
+        process,
+        workers: int = UPDATE_WORKERS,
+        processor_id: str = None,
+        drain_timeout: float = DRAIN_TIMEOUT,
+    ):
+        self.queue = queue
+        self.process = process
+        self.workers = max(1, workers)
+        self.processor_id = processor_id or new_processor_id()
+        self.drain_timeout = drain_timeout
+        self.owned = set()
+        self._slots = asyncio.Semaphore(self.workers)
+        self._tasks = {}
+        self._stopping = asyncio.Event()
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.shards_taken = 0
+        self.shards_released = 0
+        self.cancelled_on_drain = 0
+
+    def install_signal_handlers(self, signals=(signal.SIGINT, signal.SIGTERM)):
+        loop = asyncio.get_running_loop()
+        for sig in signals:
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except NotImplementedError:
+                logger.warning(f"Cannot install a drain handler for {sig!r} on this platform")
+
+    def stop(self):
+        if not self._stopping.is_set():
+            logger.info(f"Stopping update processor, draining {len(self._tasks)} in-flight updates...")
+            self._stopping.set()
+
+    async def run(self):
+        """Process updates until `stop()`, then drain and hand the shards back."""
+        logger.info(f"Update processor {self.processor_id} starting")
+        await self._heartbeat_once()
+        heartbeat = asyncio.create_task(self._heartbeat(), name="update-heartbeat")
+        try:
+            await self._claim_loop()
+            await self._drain()
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+            await self._release_shards()
+
+    async def _claim_loop(self):
+        while not self._stopping.is_set():
+            await self._slots.acquire()
+            doc = None
+            try:
+                if self.owned:
+                    doc = await self.queue.claim(self.processor_id, sorted(self.owned))
+            except PyMongoError as e:
+                logger.warning(f"Could not claim an update: {e}")
+
+            if doc is not None and doc["shard"] not in self.owned:
+                # The shard was given away while the claim was in flight
+                try:
+                    await self.queue.release(doc)
+                except PyMongoError as e:
+                    logger.warning(f"Could not release update {doc['_id']}: {e}")
+                doc = None
+            if doc is None:
+                self._slots.release()
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=UPDATE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task = asyncio.create_task(self._run(doc))
+            self._tasks[task] = doc
+
+    async def _run(self, doc: dict):
+        try:
+            if doc["attempts"] > UPDATE_MAX_ATTEMPTS:
+                logger.error(f"Update {doc['_id']} was interrupted {doc['attempts'] - 1} times, giving up")
+                self.failed += 1
+                await self.queue.finish(doc, FAILED, "too many attempts")
+                return
+            if doc["attempts"] > 1:
+                self.retried += 1
+            else:
+                observe("update_queue_wait", (datetime.utcnow() - doc["enqueued_at"]).total_seconds())
+            await self.process(doc["update"])
+            await self.queue.finish(doc, DONE)
+            self.completed += 1
+        except asyncio.CancelledError:
+            # Cancelled by the drain; the next owner of the shard picks it up straight away
+            await self.queue.release(doc)
+            raise
+        except Exception as e:
+            logger.error(f"Update {doc['_id']} failed: {e}")
+            self.failed += 1
+            await self.queue.finish(doc, FAILED, repr(e))
+        finally:
+            self._tasks.pop(asyncio.current_task(), None)
+            self._slots.release()
+
+    async def _drain(self):
+        pending = set(self._tasks)
+        if pending:
+            _, pending = await asyncio.wait(pending, timeout=self.drain_timeout)
+        if pending:
+            logger.warning(f"Cancelling {len(pending)} updates still running after {self.drain_timeout}s")
+            self.cancelled_on_drain += len(pending)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(UPDATE_HEARTBEAT)
+            try:
+                await self._heartbeat_once()
+            except PyMongoError as e:
+                logger.warning(f"Update processor heartbeat failed: {e}")
+
+    async def _heartbeat_once(self):
+        now = datetime.utcnow()
+        shards = self.queue.shards
+        await self.queue.processors.update_one({"_id": self.processor_id}, {"$set": {"seen_at": now}}, upsert=True)
+        live = await self.queue.processors.count_documents({"seen_at": {"$gt": now - timedelta(seconds=SHARD_LEASE)}})
+        share = -(-self.queue.shard_count // max(1, live))
+        lease_until = now + timedelta(seconds=SHARD_LEASE)
+
+        # Renew what is still ours; a shard taken over while this process stalled drops out here
+        await shards.update_many({"owner": self.processor_id}, {"$set": {"lease_until": lease_until}})
+        self.owned = set(await shards.distinct("_id", {"owner": self.processor_id}))
+        await self.queue.renew(self.processor_id, [doc["_id"] for doc in self._tasks.values()])
+
+        # Hand back idle shards above the fair share, then fill up from free or expired ones
+        busy = {doc["shard"] for doc in self._tasks.values()}
+        excess = [shard for shard in sorted(self.owned) if shard not in busy][:max(0, len(self.owned) - share)]
+        for shard in excess:
+            self.owned.discard(shard)
+            await shards.update_one({"_id": shard, "owner": self.processor_id}, {"$set": {"owner": None}})
+            self.shards_released += 1
+        while len(self.owned) < share and not self._stopping.is_set():
+            doc = await shards.find_one_and_update(
+                {"$or": [{"owner": None}, {"lease_until": {"$lt": now}}]},
+                {"$set": {"owner": self.processor_id, "lease_until": lease_until}},
+            )
+            if doc is None:
+                break
+            self.owned.add(doc["_id"])
+            self.shards_taken += 1
+
+    async def _release_shards(self):
+        self.owned = set()
+        try:
+            await self.queue.shards.update_many({"owner": self.processor_id}, {"$set": {"owner": None}})
+            await self.queue.processors.delete_one({"_id": self.processor_id})
+        except PyMongoError as e:
+            logger.warning(f"Could not release shards on shutdown: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "shards_owned": len(self.owned),
+            "in_flight": len(self._tasks),
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "shards_taken": self.shards_taken,
+            "shards_released": self.shards_released,
+            "cancelled_on_drain": self.cancelled_on_drain,
+        }
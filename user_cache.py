@@ -0,0 +1,119 @@
+import os
+import time
+from collections import OrderedDict
+
+#######################################
+# Configuration
+#######################################
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+
+# Fields kept in the cache; everything else is read from Mongo on demand
+CACHED_USER_FIELDS = ("telegram_id", "wallet_address", "credits", "version")
+
+
+class CachedUser:
+    """
+    Compact user record for hot paths.
+
+    Supports `user["credits"]` and `user.get("credits")` so handlers written against
+    the Mongo document keep working.
+    """
+
+    __slots__ = CACHED_USER_FIELDS + ("expires_at",)
+
+    def __init__(self, telegram_id, wallet_address, credits, version=0, expires_at=0.0):
+        self.telegram_id = telegram_id
+        self.wallet_address = wallet_address
+        self.credits = credits
+        self.version = version
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_document(cls, doc: dict, ttl: float):
+        return cls(
+            doc.get("telegram_id"),
+            doc.get("wallet_address"),
+            doc.get("credits", 0),
+            doc.get("version", 0),
+            time.monotonic() + ttl,
+        )
+
+    def __getitem__(self, key):
+        if key not in CACHED_USER_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class UserCache:
+    """
+    Bounded LRU of CachedUser records with a TTL.
+
+    DBManager writes through it: every write that returns the new document refreshes
+    the entry, and writes that don't invalidate it. The `version` field, incremented
+    on every user write, lets updates seen out of order (e.g. from a change stream)
+    be ignored when the cache already holds something newer.
+    """
+
+    def __init__(self, max_entries: int = USER_CACHE_MAX_ENTRIES, ttl: float = USER_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, telegram_id):
+        entry = self._entries.get(telegram_id)
+        if entry is None or entry.expires_at < time.monotonic():
+            if entry is not None:
+                del self._entries[telegram_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(telegram_id)
+        self.hits += 1
+        return entry
+
+    def put(self, doc: dict):
+        """Store the cached fields of a user document; returns the CachedUser."""
+        entry = CachedUser.from_document(doc, self.ttl)
+        current = self._entries.get(entry.telegram_id)
+        if current is not None and current.version > entry.version:
+            return current
+        self._entries[entry.telegram_id] = entry
+        self._entries.move_to_end(entry.telegram_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def refresh(self, doc: dict):
+        """Update an entry that is already cached, unless the cached copy is newer."""
+        if doc.get("telegram_id") in self._entries:
+            self.put(doc)
+
+    def clear(self):
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def invalidate(self, telegram_id):
+        if self._entries.pop(telegram_id, None) is not None:
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
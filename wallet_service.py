@@ -0,0 +1,167 @@
+import os
+import asyncio
+import logging
+import itertools
+
+from node_process import NodeProcess, RESTART_BACKOFF_MIN
+
+logger = logging.getLogger(__name__)
+
+#######################################
+# Configuration
+#######################################
+WALLET_WORKERS = int(os.getenv("WALLET_WORKERS", "2"))
+WALLET_POOL_SIZE = int(os.getenv("WALLET_POOL_SIZE", "10"))
+WALLET_REQUEST_TIMEOUT = float(os.getenv("WALLET_REQUEST_TIMEOUT", "15"))
+WALLET_SCRIPT = os.getenv("WALLET_SCRIPT", "wasm_rpc.js")
+
+
+class WalletServiceError(Exception):
+    """Raised when the Node.js wallet workers cannot serve a request."""
+
+
+class NodeWorker(NodeProcess):
+    """
+    One long-lived `node wasm_rpc.js serve` process answering wallet requests.
+
+    If the process exits or a request times out, every pending call fails and the
+    process is started again with exponential backoff (see NodeProcess).
+    """
+
+    error = WalletServiceError
+
+    def __init__(self, name: str, script: str = WALLET_SCRIPT, timeout: float = WALLET_REQUEST_TIMEOUT):
+        super().__init__(f"Wallet worker {name}", script, "serve", timeout)
+        self.name = name
+        self.timeout = timeout
+        self.ready = asyncio.Event()
+        self._ids = itertools.count(1)
+        self._pending = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    async def on_ready(self):
+        self.ready.set()
+
+    def on_exit(self):
+        self.ready.clear()
+        self._fail_pending(WalletServiceError(f"Wallet worker {self.name} exited"))
+
+    def handle(self, message: dict):
+        future = self._pending.pop(message.get("id"), None)
+        if future is None or future.done():
+            return
+        if "error" in message:
+            future.set_exception(WalletServiceError(message["error"]))
+        else:
+            future.set_result(message.get("result"))
+
+    async def call(self, method: str, params: dict = None, timeout: float = None):
+        """Send one request and wait for its response."""
+        if not self.ready.is_set():
+            raise WalletServiceError(f"Wallet worker {self.name} is not ready")
+
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        request = {"id": request_id, "method": method, "params": params or {}}
+        try:
+            await self.send(request)
+            return await asyncio.wait_for(future, timeout=timeout or self.timeout)
+        except asyncio.TimeoutError:
+            # A wedged worker would stall every later request too, so recycle it
+            logger.error(f"Wallet worker {self.name} timed out on '{method}', restarting it")
+            await self.kill()
+            raise WalletServiceError(f"Wallet request '{method}' timed out")
+        except (BrokenPipeError, ConnectionResetError) as e:
+            raise WalletServiceError(f"Wallet worker {self.name} is gone: {e}")
+        finally:
+            self._pending.pop(request_id, None)
+
+    def _fail_pending(self, error: Exception):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+
+
+class WalletService:
+    """
+    Pool of supervised Node.js wallet workers plus a buffer of pre-generated wallets.
+
+    `create_wallet()` hands out a buffered wallet when one is available and falls back
+    to a live worker request otherwise, so /start never waits on Node start-up.
+    """
+
+    def __init__(
+        self,
+        workers: int = WALLET_WORKERS,
+        pool_size: int = WALLET_POOL_SIZE,
+        request_timeout: float = WALLET_REQUEST_TIMEOUT,
+        script: str = WALLET_SCRIPT,
+    ):
+        self.workers = [NodeWorker(f"wallet-{i}", script, request_timeout) for i in range(max(1, workers))]
+        self.pool = asyncio.Queue(maxsize=max(0, pool_size))
+        self.pool_size = pool_size
+        self._tasks = []
+
+    async def start(self):
+        for worker in self.workers:
+            self._tasks.append(asyncio.create_task(worker.run(), name=f"{worker.name}-supervisor"))
+        if self.pool_size > 0:
+            self._tasks.append(asyncio.create_task(self._refill_pool(), name="wallet-pool-refill"))
+        logger.info(f"Wallet service started with {len(self.workers)} workers and a pool of {self.pool_size}")
+
+    async def stop(self):
+        for worker in self.workers:
+            await worker.stop()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def call(self, method: str, params: dict = None, timeout: float = None):
+        """Route a request to the ready worker with the fewest requests in flight."""
+        ready = [w for w in self.workers if w.ready.is_set()]
+        if not ready:
+            # Give a restarting worker a moment before failing the caller
+            waiters = [asyncio.create_task(w.ready.wait()) for w in self.workers]
+            done, pending = await asyncio.wait(
+                waiters, timeout=timeout or WALLET_REQUEST_TIMEOUT, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in pending:
+                task.cancel()
+            ready = [w for w in self.workers if w.ready.is_set()]
+            if not ready:
+                raise WalletServiceError("No wallet workers are available")
+        worker = min(ready, key=lambda w: w.in_flight)
+        return await worker.call(method, params, timeout)
+
+    async def _generate(self) -> dict:
+        wallet = await self.call("createWallet")
+        if not wallet or not wallet.get("success"):
+            error = wallet.get("error") if wallet else "empty response"
+            raise WalletServiceError(f"Wallet creation failed: {error}")
+        return wallet
+
+    async def create_wallet(self) -> dict:
+        """Return a fresh wallet, preferring the pre-generated pool."""
+        try:
+            return self.pool.get_nowait()
+        except asyncio.QueueEmpty:
+            return await self._generate()
+
+    async def _refill_pool(self):
+        while True:
+            try:
+                wallet = await self._generate()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Could not pre-generate wallet: {e}")
+                await asyncio.sleep(RESTART_BACKOFF_MIN)
+                continue
+            # Blocks while the pool is full, so workers stay idle until a wallet is taken
+            await self.pool.put(wallet)
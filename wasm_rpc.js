@@ -1,11 +1,14 @@
 // Global WebSocket shim for environments without native WebSocket support
 globalThis.WebSocket = require("websocket").w3cwebsocket;
 
+const readline = require("readline");
+
 const kaspa = require("./wasm/kaspa");
 const {
     Mnemonic,
     XPrv,
     NetworkType,
+    PublicKeyGenerator,
     initConsolePanicHook,
     RpcClient,
     Resolver,
@@ -52,18 +55,114 @@ async function createWallet() {
     }
 }
 
-// Command-line interface for creating a wallet
-if (require.main === module) {
-    (async () => {
+// Derive receive addresses m/44'/111111'/0'/0/i for i in [start, start + count) from the
+// service's account-level xpub (kpub). No private key is needed or ever seen here.
+async function deriveAddresses({ xpub, start = 0, count = 1, network = "mainnet" }) {
+    let generator;
+    try {
+        generator = PublicKeyGenerator.fromXPub(xpub);
+        const addresses = generator.receiveAddressAsStrings(network, start, start + count);
+        return { success: true, start, addresses };
+    } catch (err) {
+        return { success: false, error: err.message };
+    } finally {
+        if (generator) {
+            generator.free();
+        }
+    }
+}
+
+// Account-level kpub (m/44'/111111'/0') for SERVICE_XPUB, from the service mnemonic
+function accountXPub(phrase) {
+    const xPrv = new XPrv(new Mnemonic(phrase).toSeed());
+    return xPrv.derivePath("m/44'/111111'/0'").toXPub().intoString("kpub");
+}
+
+// Push-based deposit detection: subscribe to UTXO changes and added blocks and report
+// deposits to watched addresses (see deposit_listener.js). KASPA_RPC_URL pins a node,
+// e.g. one's own with --utxoindex; otherwise the resolver picks a public one.
+function listenForDeposits() {
+    const { listen } = require("./deposit_listener");
+    const url = process.env.KASPA_RPC_URL;
+    return listen(rpc, {
+        tick: (process.env.KRC20_TICK || "KASPER").toUpperCase(),
+        connectOptions: url ? { url } : undefined,
+    });
+}
+
+// Methods exposed to the Python wallet service over stdin/stdout
+const METHODS = {
+    createWallet,
+    deriveAddresses,
+};
+
+// Long-lived worker mode: one JSON request per stdin line, one JSON response per stdout line.
+// Requests look like {"id": 1, "method": "createWallet", "params": {}} and every response
+// echoes the id so the Python side can match it to the waiting caller.
+function serve() {
+    const send = (message) => process.stdout.write(JSON.stringify(message) + "\n");
+    const rl = readline.createInterface({ input: process.stdin, terminal: false });
+
+    rl.on("line", async (line) => {
+        if (!line.trim()) {
+            return;
+        }
+        let request;
+        try {
+            request = JSON.parse(line);
+        } catch (err) {
+            send({ id: null, error: "Invalid JSON request: " + err.message });
+            return;
+        }
+        const handler = METHODS[request.method];
+        if (!handler) {
+            send({ id: request.id, error: "Unknown method: " + request.method });
+            return;
+        }
         try {
-            const result = await createWallet();
-            // Print JSON result to stdout
-            console.log(JSON.stringify(result, null, 2));
+            const result = await handler(request.params || {});
+            send({ id: request.id, result });
         } catch (err) {
-            // Handle unexpected errors
-            console.error(
-                JSON.stringify({ success: false, error: "Unexpected error occurred: " + err.message })
-            );
+            send({ id: request.id, error: "Unexpected error occurred: " + err.message });
         }
-    })();
+    });
+
+    // The parent closed our stdin, so nobody is left to answer to
+    rl.on("close", () => process.exit(0));
+
+    send({ ready: true, pid: process.pid });
+}
+
+// Command-line interface: `node wasm_rpc.js serve` runs the worker loop,
+// `node wasm_rpc.js listen` runs the deposit listener,
+// `node wasm_rpc.js xpub` reads the service mnemonic on stdin and prints its account kpub,
+// anything else creates a single wallet and prints it
+if (require.main === module) {
+    if (process.argv[2] === "serve") {
+        serve();
+    } else if (process.argv[2] === "listen") {
+        listenForDeposits().catch((err) => {
+            console.error("Deposit listener failed to connect: " + err.message);
+            process.exit(1);
+        });
+    } else if (process.argv[2] === "xpub") {
+        const rl = readline.createInterface({ input: process.stdin, terminal: false });
+        rl.once("line", (phrase) => {
+            console.log(accountXPub(phrase.trim()));
+            rl.close();
+        });
+    } else {
+        (async () => {
+            try {
+                const result = await createWallet();
+                // Print JSON result to stdout
+                console.log(JSON.stringify(result, null, 2));
+            } catch (err) {
+                // Handle unexpected errors
+                console.error(
+                    JSON.stringify({ success: false, error: "Unexpected error occurred: " + err.message })
+                );
+            }
+        })();
+    }
 }